@@ -0,0 +1,43 @@
+"""add mapper high water marks
+
+Revision ID: 2f4c8e0a7b91
+Revises: 730a5a5d3617
+Create Date: 2026-10-16 11:02:47.530114
+
+"""
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '2f4c8e0a7b91'
+down_revision = '730a5a5d3617'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'releng_mapper_high_water_marks',
+        sa.Column('project_id', sa.Integer(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.Column('last_insert', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['project_id'], ['releng_mapper_projects.id'], ),
+        sa.PrimaryKeyConstraint('project_id')
+    )
+    # mapper creates any missing high water marks when they are needed, but
+    # that requires a scan of the project's mappings, so do it up front
+    op.execute("""
+        INSERT INTO releng_mapper_high_water_marks (project_id, count, last_insert)
+        SELECT releng_mapper_projects.id, COUNT(releng_mapper_hashes.date_added),
+               MAX(releng_mapper_hashes.date_added)
+        FROM releng_mapper_projects
+        LEFT OUTER JOIN releng_mapper_hashes
+            ON releng_mapper_hashes.project_id = releng_mapper_projects.id
+        GROUP BY releng_mapper_projects.id
+    """)
+
+
+def downgrade():
+    op.drop_table('releng_mapper_high_water_marks')
@@ -0,0 +1,100 @@
+"""add tooltool search trigrams
+
+Revision ID: 3c7e9b2d4f10
+Revises: 8d3f6a1c2e5b
+Create Date: 2026-10-16 20:41:27.503112
+
+"""
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+import structlog
+from alembic import context
+from alembic import op
+from sqlalchemy.sql import column
+from sqlalchemy.sql import table
+
+# revision identifiers, used by Alembic.
+revision = '3c7e9b2d4f10'
+down_revision = '8d3f6a1c2e5b'
+branch_labels = None
+depends_on = None
+
+logger = structlog.get_logger()
+
+# The existing batches are indexed as the index is created, using a copy of
+# the indexing code as it stood at this revision.  An offline (--sql) script
+# cannot read the batches, so after running one, build the index with
+# `relengapi tooltool-search-index`.
+
+batches = table('releng_tooltool_batches', column('id', sa.Integer),
+                column('author', sa.Text), column('message', sa.Text))
+batch_files = table('releng_tooltool_batch_files', column('batch_id', sa.Integer),
+                    column('file_id', sa.Integer), column('filename', sa.Text))
+search_trigrams = table('releng_tooltool_search_trigrams', column('trigram', sa.Unicode),
+                        column('field', sa.String), column('batch_id', sa.Integer),
+                        column('file_id', sa.Integer))
+
+
+def _trigrams(text):
+    text = text.lower()
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+def _index_existing_batches():
+    if context.is_offline_mode():
+        logger.warning("not indexing existing tooltool batches offline; "
+                       "run `relengapi tooltool-search-index` afterward")
+        return
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select([batches.c.id, batches.c.author, batches.c.message])
+            .where(batches.c.id > last_id).order_by(batches.c.id).limit(100)).fetchall()
+        if not rows:
+            break
+        texts = []
+        for b in rows:
+            texts.append(('author', b.author, b.id, None))
+            texts.append(('message', b.message, b.id, None))
+        for batch_id, file_id, filename in conn.execute(
+                sa.select([batch_files.c.batch_id, batch_files.c.file_id,
+                           batch_files.c.filename])
+                .where(batch_files.c.batch_id.in_([b.id for b in rows]))):
+            texts.append(('filename', filename, batch_id, file_id))
+        index = [{'trigram': trigram, 'field': field, 'batch_id': batch_id,
+                  'file_id': file_id}
+                 for field, text, batch_id, file_id in texts
+                 for trigram in _trigrams(text)]
+        if index:
+            conn.execute(search_trigrams.insert(), index)
+        last_id = rows[-1].id
+
+
+def upgrade():
+    op.create_table(
+        'releng_tooltool_search_trigrams',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('trigram', sa.Unicode(length=3), nullable=False),
+        sa.Column('field', sa.Enum('author', 'message', 'filename'), nullable=False),
+        sa.Column('batch_id', sa.Integer(), nullable=False),
+        sa.Column('file_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['batch_id'], ['releng_tooltool_batches.id'], ),
+        sa.ForeignKeyConstraint(['file_id'], ['releng_tooltool_files.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_releng_tooltool_search_trigrams_batch_id',
+                    'releng_tooltool_search_trigrams', ['batch_id'], unique=False)
+    op.create_index('ix_releng_tooltool_search_trigrams_trigram',
+                    'releng_tooltool_search_trigrams', ['trigram', 'field'], unique=False)
+    # index the existing batches, so that they can be found right away
+    _index_existing_batches()
+
+
+def downgrade():
+    op.drop_index('ix_releng_tooltool_search_trigrams_trigram',
+                  table_name='releng_tooltool_search_trigrams')
+    op.drop_index('ix_releng_tooltool_search_trigrams_batch_id',
+                  table_name='releng_tooltool_search_trigrams')
+    op.drop_table('releng_tooltool_search_trigrams')
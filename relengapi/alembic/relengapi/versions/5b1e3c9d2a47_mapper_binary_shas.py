@@ -0,0 +1,230 @@
+"""store mapper SHAs as binary, and drop unused indexes
+
+Revision ID: 5b1e3c9d2a47
+Revises: 2f4c8e0a7b91
+Create Date: 2026-10-16 12:20:05.817270
+
+"""
+from __future__ import absolute_import
+
+import binascii
+
+import sqlalchemy as sa
+from alembic import context
+from alembic import op
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import column
+from sqlalchemy.sql import table
+
+# revision identifiers, used by Alembic.
+revision = '5b1e3c9d2a47'
+down_revision = '2f4c8e0a7b91'
+branch_labels = None
+depends_on = None
+
+# On MySQL, this migration uses online DDL, so that the hashes table remains
+# readable and writable while it is copied.  Mappings inserted (by the
+# previous version of mapper) while the binary columns are being populated
+# are converted by a trigger, which remains in place until the columns have
+# been swapped; only the swap itself must be coordinated with the deployment
+# of the new code.
+#
+# Other databases (SQLite and Postgres) copy the mappings into a new table,
+# during which mappings must not be inserted.
+#
+# In either case the existing mappings are converted a batch at a time,
+# walking the (project_id, hg_changeset) unique index, so that no single
+# transaction locks the whole table.  An offline (--sql) script cannot read
+# the mappings to find the batches, so it converts them in a single
+# statement instead.
+
+HASHES = 'releng_mapper_hashes'
+BATCH_SIZE = 10000
+
+
+def _dialect():
+    return op.get_context().dialect.name
+
+
+def _alter(*clauses):
+    op.execute("ALTER TABLE %s %s, ALGORITHM=INPLACE, LOCK=NONE"
+               % (HASHES, ', '.join(clauses)))
+
+
+def _mysql_backfill(set_clause):
+    if context.is_offline_mode():
+        op.execute("UPDATE %s SET %s" % (HASHES, set_clause))
+        return
+    # DDL commits implicitly on MySQL, so any transaction alembic holds is
+    # only nominal; commit each batch so that its row locks are released
+    conn = op.get_bind()
+    project_ids = [id for (id,) in conn.execute(
+        sa.text("SELECT id FROM releng_mapper_projects ORDER BY id"))]
+    for project_id in project_ids:
+        low = ''
+        while True:
+            # the last hg_changeset of the next batch, or None if the rest of
+            # the project fits in this one
+            high = conn.execute(sa.text(
+                "SELECT hg_changeset FROM %s WHERE project_id = :id "
+                "AND hg_changeset > :low ORDER BY hg_changeset "
+                "LIMIT 1 OFFSET :offset" % HASHES),
+                {'id': project_id, 'low': low, 'offset': BATCH_SIZE - 1}).scalar()
+            where = "project_id = :id AND hg_changeset > :low"
+            if high is not None:
+                where += " AND hg_changeset <= :high"
+            conn.execute(sa.text("UPDATE %s SET %s WHERE %s" % (HASHES, set_clause, where)),
+                         {'id': project_id, 'low': low, 'high': high})
+            conn.execute(sa.text("COMMIT"))
+            if high is None:
+                break
+            low = high
+
+
+def _sha_type(binary):
+    if not binary:
+        return sa.String(40)
+    if _dialect() == 'postgresql':
+        return postgresql.BYTEA()
+    return sa.BINARY(20)
+
+
+def _copy_offline(binary):
+    # (SQLite only has unhex from version 3.41)
+    if _dialect() == 'postgresql':
+        convert = "decode(%s, 'hex')" if binary else "encode(%s, 'hex')"
+    else:
+        convert = "unhex(%s)" if binary else "lower(hex(%s))"
+    op.execute("INSERT INTO %s_new (hg_changeset, git_commit, project_id, date_added) "
+               "SELECT %s, %s, project_id, date_added FROM %s"
+               % (HASHES, convert % 'hg_changeset', convert % 'git_commit', HASHES))
+
+
+def _copy_hashes(binary):
+    """Replace the hashes table with a copy whose SHA columns are binary (or
+    hex, if `binary` is false), converting the mappings in Python (or in SQL,
+    offline)."""
+    op.create_table(
+        HASHES + '_new',
+        sa.Column('hg_changeset', _sha_type(binary), nullable=False),
+        sa.Column('git_commit', _sha_type(binary), nullable=False),
+        sa.Column('project_id', sa.Integer(), nullable=False),
+        sa.Column('date_added', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['project_id'], ['releng_mapper_projects.id'], ),
+    )
+    if context.is_offline_mode():
+        _copy_offline(binary)
+        _replace_hashes()
+        return
+
+    old_type, new_type = (sa.String, sa.LargeBinary) if binary else (sa.LargeBinary, sa.String)
+    old = table(HASHES, column('hg_changeset', old_type), column('git_commit', old_type),
+                column('project_id', sa.Integer), column('date_added', sa.Integer))
+    new = table(HASHES + '_new', column('hg_changeset', new_type),
+                column('git_commit', new_type), column('project_id', sa.Integer),
+                column('date_added', sa.Integer))
+    conn = op.get_bind()
+    if binary:
+        convert = binascii.unhexlify
+    else:
+        def convert(value):
+            return binascii.hexlify(str(value))
+
+    last = None
+    while True:
+        q = sa.select([old.c.hg_changeset, old.c.git_commit, old.c.project_id,
+                       old.c.date_added])
+        if last:
+            q = q.where(sa.or_(old.c.project_id > last[0], sa.and_(
+                old.c.project_id == last[0], old.c.hg_changeset > last[1])))
+        rows = conn.execute(
+            q.order_by(old.c.project_id, old.c.hg_changeset).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        conn.execute(new.insert(), [
+            {'hg_changeset': convert(row.hg_changeset), 'git_commit': convert(row.git_commit),
+             'project_id': row.project_id, 'date_added': row.date_added}
+            for row in rows])
+        last = rows[-1].project_id, rows[-1].hg_changeset
+    _replace_hashes()
+
+
+def _replace_hashes():
+    # the old table's indexes go with it, so the new indexes can take their
+    # names (index names are per-database in SQLite)
+    op.drop_table(HASHES)
+    op.rename_table(HASHES + '_new', HASHES)
+    op.create_index('project_id__date_added__hg_changeset', HASHES,
+                    ['project_id', 'date_added', 'hg_changeset'], unique=False)
+    op.create_index('project_id__hg_changeset', HASHES,
+                    ['project_id', 'hg_changeset'], unique=True)
+    op.create_index('project_id__git_commit', HASHES,
+                    ['project_id', 'git_commit'], unique=True)
+
+
+def upgrade():
+    if _dialect() != 'mysql':
+        _copy_hashes(binary=True)
+        return
+
+    _alter(
+        "DROP INDEX hg_changeset",
+        "DROP INDEX git_commit",
+        "DROP INDEX project_id")
+    _alter(
+        "ADD COLUMN hg_changeset_bin BINARY(20) NULL",
+        "ADD COLUMN git_commit_bin BINARY(20) NULL")
+    op.execute("CREATE TRIGGER releng_mapper_hashes_bin "
+               "BEFORE INSERT ON releng_mapper_hashes FOR EACH ROW "
+               "SET NEW.hg_changeset_bin = UNHEX(NEW.hg_changeset), "
+               "NEW.git_commit_bin = UNHEX(NEW.git_commit)")
+    _mysql_backfill("hg_changeset_bin = UNHEX(hg_changeset), "
+                    "git_commit_bin = UNHEX(git_commit)")
+    # the trigger stays in place while the columns are swapped, so that rows
+    # inserted during the swap are converted too.  Once the swap completes,
+    # the trigger refers to a column that no longer exists, so any insert by
+    # the previous version of mapper fails (rather than storing a bad row)
+    # until the trigger is dropped just below.
+    _alter(
+        "DROP INDEX project_id__date_added__hg_changeset",
+        "DROP INDEX project_id__hg_changeset",
+        "DROP INDEX project_id__git_commit",
+        "DROP COLUMN hg_changeset",
+        "DROP COLUMN git_commit",
+        "CHANGE COLUMN hg_changeset_bin hg_changeset BINARY(20) NOT NULL FIRST",
+        "CHANGE COLUMN git_commit_bin git_commit BINARY(20) NOT NULL AFTER hg_changeset",
+        "ADD INDEX project_id__date_added__hg_changeset (project_id, date_added, hg_changeset)",
+        "ADD UNIQUE INDEX project_id__hg_changeset (project_id, hg_changeset)",
+        "ADD UNIQUE INDEX project_id__git_commit (project_id, git_commit)")
+    op.execute("DROP TRIGGER releng_mapper_hashes_bin")
+
+
+def downgrade():
+    if _dialect() != 'mysql':
+        _copy_hashes(binary=False)
+        op.create_index('hg_changeset', HASHES, ['hg_changeset'], unique=False)
+        op.create_index('git_commit', HASHES, ['git_commit'], unique=False)
+        op.create_index('project_id', HASHES, ['project_id'], unique=False)
+        return
+
+    # (downgrading is not online: deploy the previous version of mapper
+    # first, and do not insert mappings until this completes)
+    _alter(
+        "ADD COLUMN hg_changeset_hex VARCHAR(40) NULL",
+        "ADD COLUMN git_commit_hex VARCHAR(40) NULL")
+    _mysql_backfill("hg_changeset_hex = LOWER(HEX(hg_changeset)), "
+                    "git_commit_hex = LOWER(HEX(git_commit))")
+    _alter(
+        "DROP INDEX project_id__date_added__hg_changeset",
+        "DROP INDEX project_id__hg_changeset",
+        "DROP INDEX project_id__git_commit",
+        "DROP COLUMN hg_changeset",
+        "DROP COLUMN git_commit",
+        "CHANGE COLUMN hg_changeset_hex hg_changeset VARCHAR(40) NOT NULL FIRST",
+        "CHANGE COLUMN git_commit_hex git_commit VARCHAR(40) NOT NULL AFTER hg_changeset",
+        "ADD INDEX project_id__date_added__hg_changeset (project_id, date_added, hg_changeset)",
+        "ADD UNIQUE INDEX project_id__hg_changeset (project_id, hg_changeset)",
+        "ADD UNIQUE INDEX project_id__git_commit (project_id, git_commit)",
+        "ADD INDEX hg_changeset (hg_changeset)",
+        "ADD INDEX git_commit (git_commit)",
+        "ADD INDEX project_id (project_id)")
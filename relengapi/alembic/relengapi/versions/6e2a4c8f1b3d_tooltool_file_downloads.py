@@ -0,0 +1,37 @@
+"""add tooltool file downloads
+
+Revision ID: 6e2a4c8f1b3d
+Revises: 3c7e9b2d4f10
+Create Date: 2026-10-16 22:07:52.184305
+
+"""
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '6e2a4c8f1b3d'
+down_revision = '3c7e9b2d4f10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'releng_tooltool_file_downloads',
+        sa.Column('file_id', sa.Integer(), nullable=False),
+        sa.Column('region', sa.Enum('us-east-1', 'us-west-1', 'us-west-2'), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.Column('last_access', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['file_id'], ['releng_tooltool_files.id'], ),
+        sa.PrimaryKeyConstraint('file_id', 'region')
+    )
+    op.create_index('ix_releng_tooltool_file_downloads_last_access',
+                    'releng_tooltool_file_downloads', ['last_access'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_releng_tooltool_file_downloads_last_access',
+                  table_name='releng_tooltool_file_downloads')
+    op.drop_table('releng_tooltool_file_downloads')
@@ -0,0 +1,30 @@
+"""index mapper hashes by project, date added and hg changeset
+
+Revision ID: 730a5a5d3617
+Revises: 993e4d841aa
+Create Date: 2026-10-16 10:12:31.114508
+
+"""
+from __future__ import absolute_import
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '730a5a5d3617'
+down_revision = '993e4d841aa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the new index covers everything the old one did, and also the ordering
+    # used by the mapfile sync endpoint
+    op.create_index('project_id__date_added__hg_changeset', 'releng_mapper_hashes',
+                    ['project_id', 'date_added', 'hg_changeset'], unique=False)
+    op.drop_index('project_id__date_added', table_name='releng_mapper_hashes')
+
+
+def downgrade():
+    op.create_index('project_id__date_added', 'releng_mapper_hashes',
+                    ['project_id', 'date_added'], unique=False)
+    op.drop_index('project_id__date_added__hg_changeset', table_name='releng_mapper_hashes')
@@ -0,0 +1,44 @@
+"""add mapper import jobs
+
+Revision ID: 8d3f6a1c2e5b
+Revises: 5b1e3c9d2a47
+Create Date: 2026-10-16 15:41:09.218734
+
+"""
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '8d3f6a1c2e5b'
+down_revision = '5b1e3c9d2a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'releng_mapper_import_jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('project_id', sa.Integer(), nullable=False),
+        sa.Column('ignore_dups', sa.Boolean(), nullable=False),
+        sa.Column('src_url', sa.Text(), nullable=True),
+        sa.Column('filename', sa.String(length=255), nullable=True),
+        sa.Column('size', sa.BigInteger(), nullable=True),
+        sa.Column('state', sa.String(length=16), nullable=False),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('offset', sa.BigInteger(), nullable=False),
+        sa.Column('processed', sa.Integer(), nullable=False),
+        sa.Column('inserted', sa.Integer(), nullable=False),
+        sa.Column('skipped', sa.Integer(), nullable=False),
+        sa.Column('elapsed', sa.Float(), nullable=False),
+        sa.Column('created', sa.Integer(), nullable=False),
+        sa.Column('updated', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['project_id'], ['releng_mapper_projects.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('releng_mapper_import_jobs')
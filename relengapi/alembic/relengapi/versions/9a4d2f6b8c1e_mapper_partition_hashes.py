@@ -0,0 +1,59 @@
+"""partition mapper hashes by project, if MAPPER_PARTITION_HASHES is set
+
+Revision ID: 9a4d2f6b8c1e
+Revises: 6e2a4c8f1b3d
+Create Date: 2026-10-17 10:12:38.540917
+
+"""
+from __future__ import absolute_import
+
+import os
+
+import structlog
+from alembic import context
+from alembic import op
+
+from relengapi.blueprints.mapper import partition
+
+# revision identifiers, used by Alembic.
+revision = '9a4d2f6b8c1e'
+down_revision = '6e2a4c8f1b3d'
+branch_labels = None
+depends_on = None
+
+logger = structlog.get_logger()
+
+# The partitioned layout is opt-in, so this migration does nothing unless
+# MAPPER_PARTITION_HASHES is set in the environment it runs in.  To change the
+# setting later, downgrade to 6e2a4c8f1b3d (which reverts to a single table, if
+# the table is partitioned) and upgrade again.  Either way, the table is
+# rebuilt, during which mappings can be read but not inserted.  The statements
+# depend on the projects and partitions in the database, so an offline (--sql)
+# script leaves the table alone; `relengapi mapper-partition [--undo]` prints
+# the statements to run instead.
+
+
+def upgrade():
+    if not os.environ.get('MAPPER_PARTITION_HASHES'):
+        logger.info("MAPPER_PARTITION_HASHES is not set; "
+                    "leaving the mapper hashes table unpartitioned")
+        return
+    if context.is_offline_mode():
+        logger.warning("not partitioning the mapper hashes table offline; "
+                       "apply the output of `relengapi mapper-partition` instead")
+        return
+    for statement in partition.partition_statements(op.get_bind()):
+        op.execute(statement)
+
+
+def downgrade():
+    if context.is_offline_mode():
+        logger.warning("not checking for a partitioned mapper hashes table offline; "
+                       "if it is, apply the output of `relengapi mapper-partition "
+                       "--undo` instead")
+        return
+    conn = op.get_bind()
+    if partition.partitioned_projects(conn) is None:
+        return
+    for statement in partition.unpartition_statements(conn.dialect.name):
+        op.execute(statement)
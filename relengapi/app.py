@@ -23,6 +23,7 @@ from relengapi.lib import celery
 from relengapi.lib import db
 from relengapi.lib import introspection
 from relengapi.lib import layout
+from relengapi.lib import locality
 from relengapi.lib import logging as relengapi_logging
 from relengapi.lib import memcached
 from relengapi.lib import monkeypatches
@@ -113,6 +114,7 @@ def create_app(cmdline=False, test_config=None):
     api.init_app(app)
     aws.init_app(app)
     memcached.init_app(app)
+    locality.init_app(app)
 
     app.relengapi_blueprints = {}
     for bp in blueprints:
@@ -179,4 +181,12 @@ def create_app(cmdline=False, test_config=None):
                                                 version=relengapi_dist.version)
         return VersionInfo(distributions=dists, blueprints=blueprints)
 
+    @app.route('/region-picks')
+    @api.apimethod({unicode: {unicode: int}})
+    def region_picks():
+        """Get the number of times this process has selected each region for
+        a client, keyed by region and then by the reason for the selection
+        (``preferred``, ``nearest``, ``fallback`` or ``random``)."""
+        return app.locality.picks_by_region()
+
     return app
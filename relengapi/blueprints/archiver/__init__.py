@@ -5,7 +5,6 @@
 from __future__ import absolute_import
 
 import datetime
-from random import randint
 
 import sqlalchemy as sa
 import structlog
@@ -20,6 +19,7 @@ from relengapi.blueprints.archiver.tasks import create_and_upload_archive
 from relengapi.blueprints.archiver.types import MozharnessArchiveTask
 from relengapi.lib import api
 from relengapi.lib import badpenny
+from relengapi.lib import locality
 from relengapi.lib.time import now
 
 bp = Blueprint('archiver', __name__)
@@ -168,9 +168,8 @@ def get_archive(src_url, key, preferred_region):
     with a url location returned immediately for obtaining task state updates.
     """
     buckets = current_app.config['ARCHIVER_S3_BUCKETS']
-    random_region = buckets.keys()[randint(0, len(buckets.keys()) - 1)]
-    # use preferred region if available otherwise choose a valid one at random
-    region = preferred_region if preferred_region and preferred_region in buckets else random_region
+    # use preferred region if available otherwise choose the nearest valid one
+    region = locality.select_region(buckets, preferred_region)
     bucket = buckets[region]
     s3 = current_app.aws.connect_to('s3', region)
     session = current_app.db.session(tables.DB_DECLARATIVE_BASE)
@@ -4,23 +4,42 @@
 
 from __future__ import absolute_import
 
+import base64
+import binascii
 import calendar
+import datetime
+import errno
+import hashlib
+import itertools
+import json
+import os
 import re
+import tempfile
 import time
+import urlparse
 
 import dateutil.parser
+import requests
 import sqlalchemy as sa
 import structlog
 from flask import Blueprint
 from flask import Response
 from flask import abort
+from flask import current_app
 from flask import g
 from flask import jsonify
 from flask import request
+from flask import stream_with_context
+from flask import url_for
 from sqlalchemy import orm
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm.exc import MultipleResultsFound
 from sqlalchemy.orm.exc import NoResultFound
+from werkzeug.exceptions import HTTPException
 
+from relengapi.blueprints.mapper import partition
+from relengapi.blueprints.mapper import snapshot
+from relengapi.lib import celery
 from relengapi.lib import db
 from relengapi.lib.permissions import p
 
@@ -30,6 +49,42 @@ logger = structlog.get_logger()
 # logging.basicConfig(level=logging.DEBUG)
 bp = Blueprint('mapper', __name__)
 
+# number of mappings inserted with each multi-row INSERT statement; SQLite
+# allows at most 999 parameters per statement, and each row has four
+INSERT_CHUNK_SIZE = 1000
+SQLITE_INSERT_CHUNK_SIZE = 999 // 4
+
+# size of the blocks in which map file uploads are read, and the longest line
+# they may contain (a mapfile line is 81 characters)
+READ_BLOCK_SIZE = 64 * 1024
+MAX_LINE_LENGTH = 1024
+
+# number of full SHAs looked up with each query by get_revs, and number of
+# abbreviated SHAs (each of which is a separate subquery)
+LOOKUP_CHUNK_SIZE = 500
+PREFIX_LOOKUP_CHUNK_SIZE = 100
+
+# number of rows fetched at a time when streaming map files
+STREAM_BATCH_SIZE = 1000
+
+# default and maximum number of mappings returned by each mapfile sync request
+SYNC_PAGE_SIZE = 10000
+SYNC_MAX_PAGE_SIZE = 100000
+
+# default number of seconds before its position from which mapfile sync
+# re-scans, when mappings were committed behind that position some time after
+# their date_added was stamped; this should exceed the longest insert
+# transaction (MAPPER_SYNC_RESCAN_WINDOW)
+SYNC_RESCAN_WINDOW = 3600
+
+# seconds after which an import job that has made no progress is assumed to
+# have lost its worker, and may be resumed; workers record that they are
+# still running a job at least every IMPORT_HEARTBEAT_INTERVAL seconds
+IMPORT_STALLED_AFTER = 600
+IMPORT_HEARTBEAT_INTERVAL = 60
+
+_is_mapfile_line = re.compile(r'^[a-f0-9]{40} [a-f0-9]{40}$').match
+
 p.mapper.mapping.insert.doc("Allows new hg-git mappings to be inserted "
                             "into mapper db (hashes table)")
 p.mapper.project.insert.doc("Allows new projects to be inserted into "
@@ -39,6 +94,30 @@ p.mapper.project.insert.doc("Allows new projects to be inserted into "
 # - http://flask.pocoo.org/docs/patterns/apierrors/
 
 
+class BinarySha(sa.types.TypeDecorator):
+
+    """A SHA1 hash, stored as 20 binary bytes but presented to Python as the
+    usual 40-character hex string, halving the size of the column and of
+    every index containing it.  Binary SHAs sort in the same order as their
+    hex strings."""
+
+    impl = sa.types.BINARY(20)
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':  # pragma: no cover
+            # (not covered: postgres has no BINARY type, and the tests use SQLite)
+            return dialect.type_descriptor(postgresql.BYTEA())
+        return dialect.type_descriptor(self.impl)
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            return binascii.unhexlify(value)
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            return binascii.hexlify(value)
+
+
 class Project(db.declarative_base(DB_DECLARATIVE_BASE)):
 
     """Object-relational mapping between python class Project
@@ -55,8 +134,8 @@ class Hash(db.declarative_base(DB_DECLARATIVE_BASE)):
     and database table "hashes"
     """
     __tablename__ = 'releng_mapper_hashes'
-    hg_changeset = sa.Column(sa.String(40), nullable=False)
-    git_commit = sa.Column(sa.String(40), nullable=False)
+    hg_changeset = sa.Column(BinarySha, nullable=False)
+    git_commit = sa.Column(BinarySha, nullable=False)
     project_id = sa.Column(
         sa.Integer, sa.ForeignKey('releng_mapper_projects.id'), nullable=False)
     project = orm.relationship(Project, primaryjoin=(project_id == Project.id))
@@ -71,13 +150,11 @@ class Hash(db.declarative_base(DB_DECLARATIVE_BASE)):
                                     'date_added', 'project_name')})
 
     __table_args__ = (
-        # TODO: (needs verification) all queries specifying a hash are for
-        # (project, hash), so these aren't used
-        sa.Index('hg_changeset', 'hg_changeset'),
-        sa.Index('git_commit', 'git_commit'),
-        # TODO: this index is a prefix of others and will never be used
-        sa.Index('project_id', 'project_id'),
-        sa.Index('project_id__date_added', 'project_id', 'date_added'),
+        # all queries specifying a hash are for (project, hash), and every
+        # index begins with project_id, so there are no single-column indexes
+        # used for mapfile/since and mapfile/sync, and to summarize a project
+        sa.Index('project_id__date_added__hg_changeset',
+                 'project_id', 'date_added', 'hg_changeset'),
         sa.Index('project_id__hg_changeset', 'project_id',
                  'hg_changeset', unique=True),
         sa.Index(
@@ -91,6 +168,73 @@ class Hash(db.declarative_base(DB_DECLARATIVE_BASE)):
     }
 
 
+class HighWaterMark(db.declarative_base(DB_DECLARATIVE_BASE)):
+
+    """Object-relational mapping between python class HighWaterMark
+    and database table "high_water_marks", which summarizes each project's
+    mappings so that clients can be told cheaply whether anything changed
+    """
+    __tablename__ = 'releng_mapper_high_water_marks'
+    project_id = sa.Column(
+        sa.Integer, sa.ForeignKey('releng_mapper_projects.id'), primary_key=True)
+    # number of mappings in the project
+    count = sa.Column(sa.Integer, nullable=False)
+    # time of the latest insert, or NULL if there are no mappings
+    last_insert = sa.Column(sa.Integer, nullable=True)
+    project = orm.relationship(Project, primaryjoin=(project_id == Project.id))
+
+
+class ImportJob(db.declarative_base(DB_DECLARATIVE_BASE)):
+
+    """Object-relational mapping between python class ImportJob
+    and database table "import_jobs", which tracks the progress of each
+    asynchronous map file import so that it can be reported and resumed
+    """
+    __tablename__ = 'releng_mapper_import_jobs'
+    id = sa.Column(sa.Integer, primary_key=True)
+    project_id = sa.Column(
+        sa.Integer, sa.ForeignKey('releng_mapper_projects.id'), nullable=False)
+    project = orm.relationship(Project, primaryjoin=(project_id == Project.id))
+    ignore_dups = sa.Column(sa.Boolean, nullable=False)
+    # URL to download the map file from, for jobs that were not uploaded
+    src_url = sa.Column(sa.Text, nullable=True)
+    # name of the map file in MAPPER_IMPORT_DIR, or NULL until downloaded
+    filename = sa.Column(sa.String(255), nullable=True)
+    size = sa.Column(sa.BigInteger, nullable=True)
+    # PENDING, STARTED, SUCCESS or FAILURE
+    state = sa.Column(sa.String(16), nullable=False)
+    error = sa.Column(sa.Text, nullable=True)
+    # position in the map file up to which mappings have been committed
+    offset = sa.Column(sa.BigInteger, nullable=False)
+    processed = sa.Column(sa.Integer, nullable=False)
+    inserted = sa.Column(sa.Integer, nullable=False)
+    skipped = sa.Column(sa.Integer, nullable=False)
+    # seconds spent loading mappings, not counting time queued or downloading
+    elapsed = sa.Column(sa.Float, nullable=False)
+    created = sa.Column(sa.Integer, nullable=False)
+    updated = sa.Column(sa.Integer, nullable=False)
+
+    def to_json(self):
+        rate = self.processed / self.elapsed if self.elapsed else None
+        return {
+            'id': self.id,
+            'project': self.project.name,
+            'ignore_dups': self.ignore_dups,
+            'src_url': self.src_url,
+            'state': self.state,
+            'error': self.error,
+            'size': self.size,
+            'offset': self.offset,
+            'processed': self.processed,
+            'inserted': self.inserted,
+            'skipped': self.skipped,
+            'elapsed': self.elapsed,
+            'rows_per_second': rate,
+            'created': self.created,
+            'updated': self.updated,
+        }
+
+
 def _project_filter(projects_arg):
     """Helper method that returns the SQLAlchemy filter expression for the
     project name(s) specified. This can be a comma-separated list, which is
@@ -108,8 +252,177 @@ def _project_filter(projects_arg):
         return Project.name == projects_arg
 
 
+def _hash_filter(session, projects_arg):
+    """Helper method that returns the SQLAlchemy filter expression selecting
+    the mappings for the project name(s) specified.  The project ids are
+    looked up first, rather than joining the hashes table with the projects
+    table, so that the database can restrict a query to the projects' own
+    partitions if the hashes table is partitioned.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        projects_arg: Comma-separated list of project names
+
+    Returns:
+        A SQLAlchemy filter expression on the Hash table
+    """
+    ids = [id for (id,) in session.query(Project.id).filter(_project_filter(projects_arg))]
+    if not ids:
+        return sa.false()
+    elif len(ids) == 1:
+        return Hash.project_id == ids[0]
+    else:
+        return Hash.project_id.in_(ids)
+
+
+def _bump_high_water_mark(session, project_id, count):
+    """Helper method to record the insertion of mappings in the project's high
+    water mark, as part of the transaction inserting them.
+
+    If the project has no high water mark, nothing is done; one will be
+    created from the hashes table when it is next needed.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        project_id: Id of the project
+        count: Number of mappings inserted
+    """
+    if not count:
+        return
+    now = int(time.time())
+    tbl = HighWaterMark.__table__
+    session.execute(tbl.update().where(tbl.c.project_id == project_id).values(
+        count=tbl.c.count + count,
+        last_insert=sa.case([(tbl.c.last_insert > now, tbl.c.last_insert)], else_=now)))
+
+
+def _high_water_marks(session, projects_arg):
+    """Helper method to get the high water marks for the named projects,
+    creating any that are missing.  This does not touch the hashes table,
+    unless high water marks must be created.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        projects_arg: Comma-separated list of project names
+
+    Returns:
+        A list of HighWaterMark objects for the projects that exist
+    """
+    project_ids = [r.id for r in session.query(Project.id).filter(
+        _project_filter(projects_arg))]
+    return _project_marks(session, project_ids).values()
+
+
+def _project_marks(session, project_ids):
+    """Helper method to get the high water marks for the given projects,
+    creating any that are missing, as for _high_water_marks.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        project_ids: List of ids of existing projects
+
+    Returns:
+        A dictionary of HighWaterMark objects, keyed by project id
+    """
+    if not project_ids:
+        return {}
+    marks = session.query(HighWaterMark).filter(
+        HighWaterMark.project_id.in_(project_ids)).all()
+    missing = set(project_ids) - set(m.project_id for m in marks)
+    if missing:
+        q = session.query(Hash.project_id, sa.func.count(Hash.date_added),
+                          sa.func.max(Hash.date_added))
+        q = q.filter(Hash.project_id.in_(missing)).group_by(Hash.project_id)
+        found = {project_id: (count, latest) for project_id, count, latest in q}
+        for project_id in missing:
+            count, latest = found.get(project_id, (0, None))
+            session.add(HighWaterMark(
+                project_id=project_id, count=count,
+                last_insert=int(latest) if latest is not None else None))
+        try:
+            session.commit()
+        except sa.exc.IntegrityError:
+            # another request created them first
+            session.rollback()
+        marks = session.query(HighWaterMark).filter(
+            HighWaterMark.project_id.in_(project_ids)).all()
+    return {m.project_id: m for m in marks}
+
+
+def _check_modified(session, projects_arg):
+    """Helper method to compute the validators for a response that depends
+    only on the mappings in the named projects, and to check them against
+    the request's conditional headers.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        projects_arg: Comma-separated list of project names
+
+    Returns:
+        A tuple (etag, last_modified, not_modified), where not_modified is a
+        304 response if the client's copy is current, and otherwise None;
+        etag is None if none of the projects exist
+    """
+    marks = _high_water_marks(session, projects_arg)
+    if not marks:
+        return None, None, None
+    state = ','.join('%d:%d:%s' % (m.project_id, m.count, m.last_insert)
+                     for m in sorted(marks, key=lambda m: m.project_id))
+    etag = hashlib.md5(state).hexdigest()
+    if _accepts_gzip():
+        # the gzipped response is a different representation
+        etag += '-gzip'
+    last_insert = max(m.last_insert for m in marks)
+    last_modified = None
+    if last_insert is not None:
+        last_modified = datetime.datetime.utcfromtimestamp(last_insert)
+
+    if request.if_none_match:
+        modified = not request.if_none_match.contains(etag)
+    elif request.if_modified_since and last_modified:
+        modified = last_modified > request.if_modified_since
+    else:
+        modified = True
+    if modified:
+        return etag, last_modified, None
+    response = _validated(Response(status=304), etag, last_modified)
+    response.vary.add('Accept-Encoding')
+    return etag, last_modified, response
+
+
+def _validated(response, etag, last_modified):
+    """Helper method to add the validators returned by _check_modified to a
+    response."""
+    if etag:
+        response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+
+def _mapfile_lines(query):
+    """Helper method to generate map file lines from a SQLAlchemy query.
+
+    The query is executed with a server-side cursor where the database
+    supports one, so rows are fetched in batches as they are consumed rather
+    than all being loaded into memory first.
+
+    Args:
+        query: SQLAlchemy query over the Hash table
+
+    Returns:
+        A generator of lines: 40 characters git commit SHA, a space,
+        40 characters hg changeset SHA, a newline
+    """
+    query = query.with_entities(Hash.git_commit, Hash.hg_changeset)
+    query = query.execution_options(stream_results=True).yield_per(STREAM_BATCH_SIZE)
+    return ('%s %s\n' % row for row in query)
+
+
 def _stream_mapfile(query):
-    """Helper method to build a map file from a SQLAlchemy query.
+    """Helper method to build a map file from a SQLAlchemy query, in a single
+    pass over the results.
+
     Args:
         query: SQLAlchemy query
 
@@ -118,19 +431,206 @@ def _stream_mapfile(query):
           40 characters hg changeset SHA, a newline (streamed); or
         * HTTP 404: if the query returns no results
     """
-    # this helps keep memory use down a little, but the DBAPI still loads
-    # the entire result set into memory..
-    # http://docs.sqlalchemy.org/en/latest/orm/query.html#sqlalchemy.orm.query.Query.yield_per
-    query = query.yield_per(100)
+    lines = _mapfile_lines(query)
+    first = next(lines, None)
+    if first is None:
+        abort(404, 'No mappings found')
+    chunks = snapshot.buffered(itertools.chain([first], lines))
+    gzip = _accepts_gzip()
+    if gzip:
+        chunks = snapshot.gzipped(chunks)
+    # the request context (and with it the DB session and cursor) must stay
+    # alive until all of the rows have been read
+    return _mapfile_response(stream_with_context(chunks), gzip)
+
+
+def _accepts_gzip():
+    """Helper method to determine whether the client accepts gzip-encoded
+    responses."""
+    return request.accept_encodings['gzip'] > 0
+
+
+def _mapfile_response(chunks, gzipped=False):
+    """Helper method to build a streamed map file response.
+
+    Args:
+        chunks: Iterable of response body strings
+        gzipped: Boolean; True if the chunks are gzip-encoded
+
+    Returns:
+        A Response object
+    """
+    response = Response(chunks, mimetype='text/plain')
+    response.vary.add('Accept-Encoding')
+    if gzipped:
+        response.content_encoding = 'gzip'
+    return response
+
+
+def _project_state(session, project_id):
+    """Helper method to summarize the mappings for a project, for comparison
+    with a snapshot.  This reads the project's high water mark, which is
+    updated in the same transaction as every insert, rather than scanning
+    its mappings.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        project_id: Id of the project
+
+    Returns:
+        A tuple (number of mappings, time of the latest insert)
+    """
+    mark = _project_marks(session, [project_id])[project_id]
+    return mark.count, mark.last_insert
 
-    if query.count() == 0:
+
+def _stream_snapshot(session, store, proj):
+    """Helper method to serve the full map file for a single project from its
+    snapshot, rebuilding the snapshot from the database if it is stale.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        store: SnapshotStore
+        proj: Project object
+
+    Returns:
+        * Text output, as for _stream_mapfile; or
+        * HTTP 404: if the project has no mappings
+    """
+    count, latest = _project_state(session, proj.id)
+    if not count:
         abort(404, 'No mappings found')
 
-    def contents():
-        for r in query:
-            yield '%s %s' % (r.git_commit, r.hg_changeset) + "\n"
-    if contents:
-        return Response(contents(), mimetype='text/plain')
+    gzip = _accepts_gzip()
+    snap = store.open(proj.id)
+    if snap and snap.matches(count, latest):
+        if gzip and snap.has_gzip:
+            return _mapfile_response(snap.gzip_chunks(), gzipped=True)
+        if not gzip and not store.needs_compaction(snap):
+            return _mapfile_response(snap.chunks())
+        # merge the delta into a new base (and gzipped copy) while serving
+        # this request, since it must be compressed anyway
+        lines = snap.lines()
+    else:
+        if snap:
+            snap.close()
+        logger.info("mapfile snapshot for project %s is stale; rebuilding" % proj.name)
+        q = session.query(Hash).filter(Hash.project_id == proj.id)
+        lines = _mapfile_lines(q.order_by(Hash.hg_changeset))
+    chunks = snapshot.buffered(store.tee(proj.id, lines, count, latest))
+    if gzip:
+        chunks = snapshot.gzipped(chunks)
+    # the request context (and with it the DB session and transaction) must
+    # stay alive until the rebuild is complete
+    return _mapfile_response(stream_with_context(chunks), gzip)
+
+
+def _project_mapfile_lines(session, project_id):
+    """Helper method to generate the map file lines for a single project,
+    sorted by hg changeset, by walking the project_id__hg_changeset index a
+    page at a time.
+
+    Each page is a separate, fully-fetched query, so several projects can be
+    read at once over a single database connection (which is not possible
+    with server-side cursors).
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        project_id: Id of the project
+
+    Returns:
+        A generator of lines, as for _mapfile_lines
+    """
+    q = session.query(Hash.git_commit, Hash.hg_changeset)
+    q = q.filter(Hash.project_id == project_id)
+    last = None
+    while True:
+        page = q if last is None else q.filter(Hash.hg_changeset > last)
+        rows = page.order_by(Hash.hg_changeset).limit(STREAM_BATCH_SIZE).all()
+        for row in rows:
+            yield '%s %s\n' % tuple(row)
+        if len(rows) < STREAM_BATCH_SIZE:
+            return
+        last = rows[-1].hg_changeset
+
+
+def _stream_merged_mapfile(session, store, projects_arg):
+    """Helper method to serve the full map file for several projects, by
+    merging each project's sorted mappings rather than having the database
+    sort all of them together.  A project's snapshot is used if it is up to
+    date, and otherwise its mappings are read from the database (rebuilding
+    the snapshot as they are).
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        store: SnapshotStore, or None if snapshots are disabled
+        projects_arg: Comma-delimited project names string
+
+    Returns:
+        * Text output, as for _stream_mapfile; or
+        * HTTP 404: if the projects have no mappings
+    """
+    sources = []
+    projects = session.query(Project).filter(_project_filter(projects_arg)).all()
+    marks = _project_marks(session, [proj.id for proj in projects])
+    for proj in projects:
+        count, latest = marks[proj.id].count, marks[proj.id].last_insert
+        if not count:
+            continue
+        snap = store.open(proj.id) if store else None
+        if snap and snap.matches(count, latest):
+            sources.append(snap.lines())
+            continue
+        if snap:
+            snap.close()
+        lines = _project_mapfile_lines(session, proj.id)
+        if store:
+            lines = store.tee(proj.id, lines, count, latest)
+        sources.append(lines)
+    if not sources:
+        abort(404, 'No mappings found')
+
+    chunks = snapshot.buffered(snapshot.merged(*sources))
+    gzip = _accepts_gzip()
+    if gzip:
+        chunks = snapshot.gzipped(chunks)
+    # the request context (and with it the DB session) must stay alive until
+    # all of the mappings have been read
+    return _mapfile_response(stream_with_context(chunks), gzip)
+
+
+def _update_snapshot(session, proj, lines, num_lines):
+    """Helper method to append newly-inserted mappings to a project's snapshot,
+    if snapshots are enabled.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        proj: Project object
+        lines: Iterable of map file lines that were inserted (and committed)
+        num_lines: Number of lines in `lines`
+    """
+    store = current_app.mapper_snapshots
+    if not store or not num_lines:
+        return
+    count, latest = _project_state(session, proj.id)
+    if not store.append(proj.id, lines, num_lines, count, latest):
+        logger.info("mapfile snapshot for project %s is out of date; it will be "
+                    "rebuilt on the next request" % proj.name)
+
+
+def _sha_prefix_filter(column, prefix):
+    """Helper method that returns the SQLAlchemy filter expression for SHAs
+    beginning with the given (well-formed) prefix.  Binary SHAs cannot be
+    matched with LIKE, so this is expressed as a range.
+
+    Args:
+        column: Hash.git_commit or Hash.hg_changeset
+        prefix: Revision or partial revision string
+
+    Returns:
+        A SQLAlchemy filter expression
+    """
+    return column.between((prefix + '0' * 40)[:40], (prefix + 'f' * 40)[:40])
 
 
 def _check_well_formed_sha(vcs, sha, exact_length=40):
@@ -203,39 +703,224 @@ def _add_hash(session, git_commit, hg_changeset, project):
     session.add(h)
 
 
+def _project_ids(session, store, projects_arg):
+    """Helper method to find the ids of the named projects, caching them in
+    the snapshot store.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        store: SnapshotStore
+        projects_arg: Comma-separated list of project names
+
+    Returns:
+        A list of project ids (omitting any projects that do not exist)
+    """
+    names = projects_arg.split(',')
+    missing = [n for n in names if n not in store.project_ids]
+    if missing:
+        q = session.query(Project.name, Project.id).filter(Project.name.in_(missing))
+        store.project_ids.update(q)
+    return [store.project_ids[n] for n in names if n in store.project_ids]
+
+
+def _index_states(session, store, projects):
+    """Helper method to find the state of the named projects, against which
+    their snapshot indexes are checked before they are used.  This reads only
+    the projects' high water marks.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        store: SnapshotStore
+        projects: Comma-delimited project names(s) string
+
+    Returns:
+        A list of (project id, number of mappings, time of the latest insert)
+        tuples
+    """
+    project_ids = _project_ids(session, store, projects)
+    marks = _project_marks(session, project_ids)
+    return [(id, marks[id].count, marks[id].last_insert) for id in project_ids]
+
+
+def _index_lookup(store, states, vcs_type, commit):
+    """Helper method to look up a (possibly abbreviated) SHA in the snapshot
+    indexes of the given projects.
+
+    Args:
+        store: SnapshotStore
+        states: Project states, from _index_states
+        vcs_type: 'git' or 'hg'
+        commit: Revision or partial revision string
+
+    Returns:
+        A set of up to two (git_commit, hg_changeset) tuples, or None if any
+        of the projects' indexes is missing or out of date, in which case the
+        database must be consulted
+    """
+    found = set()
+    for project_id, count, latest in states:
+        matches = store.lookup(project_id, vcs_type, commit, count, latest)
+        if matches is None:
+            return None
+        found.update(matches)
+        if len(found) > 1:
+            break
+    return found
+
+
 @bp.route('/<projects>/rev/<vcs_type>/<commit>')
 def get_rev(projects, vcs_type, commit):
     # (documentation in relengapi/docs/usage/mapper.rst)
     _check_well_formed_sha(vcs_type, commit, exact_length=None)  # can raise http 400
-    q = Hash.query.join(Project).filter(_project_filter(projects))
+    session = g.db.session(DB_DECLARATIVE_BASE)
+    store = current_app.mapper_snapshots
+    if store:
+        found = _index_lookup(store, _index_states(session, store, projects),
+                              vcs_type, commit)
+        # an up-to-date index is as good as the database, misses included
+        if found is not None:
+            if not found:
+                _rev_not_found(projects, vcs_type, commit)
+            elif len(found) > 1:
+                _rev_ambiguous(projects, vcs_type, commit)
+            return "%s %s" % found.pop()
+    q = session.query(Hash).filter(_hash_filter(session, projects))
     if vcs_type == "git":
-        q = q.filter(sa.text("git_commit like :cspatttern")).params(
-            cspatttern=commit + "%")
+        q = q.filter(_sha_prefix_filter(Hash.git_commit, commit))
     elif vcs_type == "hg":
-        q = q.filter(sa.text("hg_changeset like :cspatttern")).params(
-            cspatttern=commit + "%")
+        q = q.filter(_sha_prefix_filter(Hash.hg_changeset, commit))
     try:
         row = q.one()
         return "%s %s" % (row.git_commit, row.hg_changeset)
     except NoResultFound:
-        if vcs_type == "git":
-            abort(404, "No hg changeset found for git commit id %s in project(s) %s"
-                  % (commit, projects))
-        elif vcs_type == "hg":
-            abort(404, "No git commit found for hg changeset %s in project(s) %s"
-                  % (commit, projects))
+        _rev_not_found(projects, vcs_type, commit)
     except MultipleResultsFound:
-        abort(500, "Internal error - multiple results returned for %s commit %s"
-              "in project %s - this should not be possible in database"
-              % (vcs_type, commit, projects))
+        _rev_ambiguous(projects, vcs_type, commit)
+
+
+def _rev_not_found(projects, vcs_type, commit):
+    if vcs_type == "git":
+        abort(404, "No hg changeset found for git commit id %s in project(s) %s"
+              % (commit, projects))
+    elif vcs_type == "hg":
+        abort(404, "No git commit found for hg changeset %s in project(s) %s"
+              % (commit, projects))
+
+
+def _rev_ambiguous(projects, vcs_type, commit):
+    abort(500, "Internal error - multiple results returned for %s commit %s"
+          "in project %s - this should not be possible in database"
+          % (vcs_type, commit, projects))
+
+
+def _lookup_full_revs(session, hash_filter, column, revs):
+    """Helper method to find the mappings for a set of full (40 character)
+    SHAs with a single query.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        hash_filter: Filter expression for the projects, from _hash_filter
+        column: Hash.git_commit or Hash.hg_changeset
+        revs: List of full SHAs
+
+    Returns:
+        An iterable of (rev, git_commit, hg_changeset) tuples
+    """
+    q = session.query(column, Hash.git_commit, Hash.hg_changeset)
+    q = q.filter(hash_filter).filter(column.in_(revs)).distinct()
+    return q
+
+
+def _lookup_prefix_revs(session, hash_filter, column, revs):
+    """Helper method to find the mappings for a set of abbreviated SHAs with a
+    single query.  At most two distinct mappings are returned for each SHA,
+    which is enough to tell whether it is ambiguous.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        hash_filter: Filter expression for the projects, from _hash_filter
+        column: Hash.git_commit or Hash.hg_changeset
+        revs: List of abbreviated SHAs
+
+    Returns:
+        An iterable of (rev, git_commit, hg_changeset) tuples
+    """
+    selects = []
+    for rev in revs:
+        sel = sa.select([sa.literal(rev).label('rev'), Hash.git_commit, Hash.hg_changeset])
+        sel = sel.where(hash_filter)
+        sel = sel.where(_sha_prefix_filter(column, rev)).distinct().limit(2)
+        # SQLite does not allow LIMIT on the members of a compound select,
+        # so each is wrapped in a subquery
+        selects.append(sel.alias().select())
+    return session.execute(sa.union_all(*selects))
+
+
+@bp.route('/<projects>/rev/<vcs_type>', methods=('POST',))
+def get_revs(projects, vcs_type):
+    # (documentation in relengapi/docs/usage/mapper.rst)
+    revs = request.get_json(silent=True)
+    if not isinstance(revs, list) or not all(isinstance(r, basestring) for r in revs):
+        abort(400, "Request body must be a JSON list of SHAs")
+    for rev in revs:
+        _check_well_formed_sha(vcs_type, rev, exact_length=None)  # can raise http 400
+    revs = sorted(set(revs))
+    column = Hash.git_commit if vcs_type == 'git' else Hash.hg_changeset
+
+    session = g.db.session(DB_DECLARATIVE_BASE)
+    matches = {}
+    store = current_app.mapper_snapshots
+    if store:
+        states = _index_states(session, store, projects)
+        for rev in revs:
+            # an up-to-date index is as good as the database, misses included
+            found = _index_lookup(store, states, vcs_type, rev)
+            if found is not None:
+                matches[rev] = found
+    full = [r for r in revs if len(r) == 40 and r not in matches]
+    prefixes = [r for r in revs if len(r) < 40 and r not in matches]
+    if full or prefixes:
+        hash_filter = _hash_filter(session, projects)
+    for i in range(0, len(full), LOOKUP_CHUNK_SIZE):
+        for rev, git_commit, hg_changeset in _lookup_full_revs(
+                session, hash_filter, column, full[i:i + LOOKUP_CHUNK_SIZE]):
+            matches.setdefault(rev, set()).add((git_commit, hg_changeset))
+    for i in range(0, len(prefixes), PREFIX_LOOKUP_CHUNK_SIZE):
+        for rev, git_commit, hg_changeset in _lookup_prefix_revs(
+                session, hash_filter, column, prefixes[i:i + PREFIX_LOOKUP_CHUNK_SIZE]):
+            matches.setdefault(rev, set()).add((git_commit, hg_changeset))
+
+    mappings = {}
+    not_found = []
+    ambiguous = []
+    for rev in revs:
+        found = matches.get(rev)
+        if not found:
+            not_found.append(rev)
+        elif len(found) > 1:
+            ambiguous.append(rev)
+        else:
+            mappings[rev] = "%s %s" % found.pop()
+    return jsonify(mappings=mappings, not_found=not_found, ambiguous=ambiguous)
 
 
 @bp.route('/<projects>/mapfile/full')
 def get_full_mapfile(projects):
     # (documentation in relengapi/docs/usage/mapper.rst)
-    q = Hash.query.join(Project).filter(_project_filter(projects))
+    session = g.db.session(DB_DECLARATIVE_BASE)
+    etag, last_modified, not_modified = _check_modified(session, projects)
+    if not_modified:
+        return not_modified
+    store = current_app.mapper_snapshots
+    if ',' in projects:
+        return _validated(_stream_merged_mapfile(session, store, projects),
+                          etag, last_modified)
+    if store:
+        proj = _get_project(session, projects)  # can raise HTTP 404 or HTTP 500
+        return _validated(_stream_snapshot(session, store, proj), etag, last_modified)
+    q = session.query(Hash).filter(_hash_filter(session, projects))
     q = q.order_by(Hash.hg_changeset)
-    return _stream_mapfile(q)
+    return _validated(_stream_mapfile(q), etag, last_modified)
 
 
 @bp.route('/<projects>/mapfile/since/<since>')
@@ -247,10 +932,106 @@ def get_mapfile_since(projects, since):
         abort(400, 'Invalid date %s specified; see https://labix.org/python-dateutil: %s'
               % (since, e.message))
     since_epoch = calendar.timegm(since_dt.utctimetuple())
-    q = Hash.query.join(Project).filter(_project_filter(projects))
+    session = g.db.session(DB_DECLARATIVE_BASE)
+    etag, last_modified, not_modified = _check_modified(session, projects)
+    if not_modified:
+        return not_modified
+    q = session.query(Hash).filter(_hash_filter(session, projects))
     q = q.order_by(Hash.hg_changeset)
     q = q.filter(Hash.date_added > since_epoch)
-    return _stream_mapfile(q)
+    return _validated(_stream_mapfile(q), etag, last_modified)
+
+
+def _encode_sync_cursor(date_added, hg_changeset, project_id, seen):
+    return base64.urlsafe_b64encode(json.dumps(
+        [date_added, hg_changeset, project_id, seen]))
+
+
+def _decode_sync_cursor(cursor):
+    """Helper method to decode a cursor returned by get_mapfile_sync.
+
+    Args:
+        cursor: Opaque cursor string
+
+    Returns:
+        A tuple (date_added, hg_changeset, project_id, seen): the last mapping
+        returned before the cursor, and the number of mappings up to and
+        including it.  For a cursor re-scanning recent mappings, hg_changeset
+        and project_id are None, the cursor is before every mapping with at
+        least the given date_added, and seen counts the mappings before that.
+
+    Exceptions:
+        HTTP 400: Invalid cursor
+    """
+    try:
+        date_added, hg_changeset, project_id, seen = json.loads(
+            base64.urlsafe_b64decode(str(cursor)))
+        if not isinstance(date_added, (int, long, float)) or \
+                not isinstance(seen, (int, long)):
+            raise ValueError
+        if hg_changeset is not None or project_id is not None:
+            if not isinstance(project_id, (int, long)):
+                raise ValueError
+            _check_well_formed_sha('hg', hg_changeset)  # can raise http 400
+    except (TypeError, ValueError):
+        abort(400, "Invalid cursor %s" % cursor)
+    return date_added, hg_changeset, project_id, seen
+
+
+@bp.route('/<projects>/mapfile/sync')
+def get_mapfile_sync(projects):
+    # (documentation in relengapi/docs/usage/mapper.rst)
+    try:
+        limit = int(request.args.get('limit', SYNC_PAGE_SIZE))
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= SYNC_MAX_PAGE_SIZE:
+        abort(400, "limit must be between 1 and %d" % SYNC_MAX_PAGE_SIZE)
+    session = g.db.session(DB_DECLARATIVE_BASE)
+    # (read before the mappings, so that any mapping counted is returned)
+    total = sum(m.count for m in _high_water_marks(session, projects))
+    hash_filter = _hash_filter(session, projects)
+    q = session.query(Hash.date_added, Hash.hg_changeset, Hash.project_id, Hash.git_commit)
+    q = q.filter(hash_filter)
+    cursor = request.args.get('cursor')
+    position = (0, None, None)
+    seen = 0
+    if cursor:
+        date_added, hg_changeset, project_id, seen = _decode_sync_cursor(cursor)
+        position = (date_added, hg_changeset, project_id)
+        if hg_changeset is None:
+            q = q.filter(Hash.date_added >= date_added)
+        else:
+            # resume after the last mapping returned, in (date_added,
+            # hg_changeset, project_id) order; row-value comparisons are not
+            # supported everywhere, so this is spelled out
+            q = q.filter(sa.or_(
+                Hash.date_added > date_added,
+                sa.and_(Hash.date_added == date_added, sa.or_(
+                    Hash.hg_changeset > hg_changeset,
+                    sa.and_(Hash.hg_changeset == hg_changeset,
+                            Hash.project_id > project_id)))))
+    q = q.order_by(Hash.date_added, Hash.hg_changeset, Hash.project_id)
+    rows = q.limit(limit).all()
+    complete = len(rows) < limit
+    if rows:
+        position = tuple(rows[-1][:3])
+    seen += len(rows)
+    if complete and total > seen:
+        # date_added is stamped before the mapping is committed, so a mapping
+        # may become visible behind the position already reached; the high
+        # water marks, updated as mappings are committed, show that there are
+        # such mappings.  The next call then re-scans a window before the
+        # position, which returns them (and repeats some others).
+        window = current_app.config.get('MAPPER_SYNC_RESCAN_WINDOW', SYNC_RESCAN_WINDOW)
+        since = position[0] - window
+        rescanned = session.query(sa.func.count(Hash.date_added)).filter(
+            hash_filter).filter(Hash.date_added >= since).scalar()
+        cursor = _encode_sync_cursor(since, None, None, total - rescanned)
+    else:
+        cursor = _encode_sync_cursor(*(position + (seen,)))
+    return jsonify(mappings=['%s %s' % (r.git_commit, r.hg_changeset) for r in rows],
+                   cursor=cursor, complete=complete)
 
 
 @bp.route('/projects', methods=('GET',))
@@ -259,19 +1040,261 @@ def get_projects():
     session = g.db.session(DB_DECLARATIVE_BASE)
     q = session.query(Project)
     rows = q.all()
-    return jsonify(projects=[x.name for x in rows])
+    response = jsonify(projects=[x.name for x in rows])
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def _parse_mapfile_lines(lines, project):
+    """Helper method to split map file lines into (git_commit, hg_changeset)
+    pairs.  The lines are checked with a single regular expression pass; the
+    individual checks are only used to describe a malformed line.
+
+    Args:
+        lines: List of map file lines
+        project: Single project name string (for error messages)
+
+    Returns:
+        A list of (git_commit, hg_changeset) tuples
+
+    Exceptions:
+        HTTP 400: Malformed line or SHA
+    """
+    lines = [line.rstrip() for line in lines]
+    bad = next((line for line in lines if not _is_mapfile_line(line)), None)
+    if bad is not None:
+        try:
+            (git_commit, hg_changeset) = bad.split(' ')
+        except ValueError:
+            logger.error(
+                "Received input line: '%s' for project %s", bad, project)
+            logger.error("Was expecting an input line such as "
+                         "'686a558fad7954d8481cfd6714cdd56b491d2988 "
+                         "fef90029cb654ad9848337e262078e403baf0c7a'")
+            logger.error("i.e. where the first hash is a git commit SHA "
+                         "and the second hash is a mercurial changeset SHA")
+            abort(400, "Input line '%s' received for project %s did not contain a space"
+                  % (bad, project))
+        _check_well_formed_sha('git', git_commit)  # can raise http 400
+        _check_well_formed_sha('hg', hg_changeset)  # can raise http 400
+    return [tuple(line.split(' ')) for line in lines]
+
+
+def _insert_statement(dialect_name, ignore_dups):
+    """Helper method to build a multi-row INSERT for the hashes table.
+
+    Args:
+        dialect_name: Name of the SQLAlchemy dialect in use
+        ignore_dups: Boolean; if True, the statement should skip rows that
+        duplicate existing mappings
+
+    Returns:
+        An Insert object, or None if the database cannot skip duplicates in
+        a multi-row INSERT
+    """
+    ins = Hash.__table__.insert()
+    if not ignore_dups:
+        return ins
+    if dialect_name == 'mysql':
+        return ins.prefix_with('IGNORE')
+    elif dialect_name == 'sqlite':
+        return ins.prefix_with('OR IGNORE')
+    return None
+
+
+def _new_pairs(session, project_id, pairs):
+    """Helper method to find which of a chunk of git-hg mappings would not be
+    skipped as duplicates, so that exactly those can be appended to the
+    project's snapshot.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        project_id: Id of the project
+        pairs: List of (git_commit, hg_changeset) tuples
+
+    Returns:
+        A list of the (git_commit, hg_changeset) tuples that neither exist
+        in the database nor duplicate an earlier tuple in the list
+    """
+    q = session.query(Hash.git_commit, Hash.hg_changeset)
+    q = q.filter(Hash.project_id == project_id)
+    q = q.filter(sa.or_(Hash.git_commit.in_([git for git, _ in pairs]),
+                        Hash.hg_changeset.in_([hg for _, hg in pairs])))
+    seen_git = set()
+    seen_hg = set()
+    for git_commit, hg_changeset in q:
+        seen_git.add(git_commit)
+        seen_hg.add(hg_changeset)
+    new = []
+    for git_commit, hg_changeset in pairs:
+        if git_commit in seen_git or hg_changeset in seen_hg:
+            continue
+        seen_git.add(git_commit)
+        seen_hg.add(hg_changeset)
+        new.append((git_commit, hg_changeset))
+    return new
+
+
+def _insert_chunk(session, project_id, pairs, ignore_dups):
+    """Helper method to insert a chunk of git-hg mappings in one statement.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        project_id: Id of the project
+        pairs: List of (git_commit, hg_changeset) tuples
+        ignore_dups: Boolean; if True, skip mappings that already exist
+
+    Returns:
+        The number of mappings inserted
+
+    Exceptions:
+        IntegrityError: ignore_dups=False and there are duplicate entries
+    """
+    date_added = time.time()
+
+    def rows(pairs):
+        return [{'git_commit': git_commit, 'hg_changeset': hg_changeset,
+                 'project_id': project_id, 'date_added': date_added}
+                for git_commit, hg_changeset in pairs]
+    ins = _insert_statement(session.get_bind().dialect.name, ignore_dups)
+    if ins is None:  # pragma: no cover
+        # (not covered: the tests use SQLite, which supports INSERT OR IGNORE)
+        # no native way to skip duplicates, so the existing mappings are
+        # filtered out with one query first; if a concurrent insert gets in
+        # between, the chunk is filtered again
+        while True:
+            new = _new_pairs(session, project_id, pairs)
+            if not new:
+                return 0
+            try:
+                with session.begin_nested():
+                    session.execute(Hash.__table__.insert().values(rows(new)))
+                return len(new)
+            except sa.exc.IntegrityError:
+                continue
+    return session.execute(ins.values(rows(pairs))).rowcount
+
+
+def _read_lines(stream, project):
+    """Helper method to generate lines from a file-like object, reading it in
+    fixed-size blocks so that memory use does not depend on its size.
+
+    Args:
+        stream: File-like object
+        project: Single project name string (for error messages)
+
+    Returns:
+        A generator of lines, without their trailing newlines
+
+    Exceptions:
+        HTTP 400: A line is implausibly long
+    """
+    partial = ''
+    while True:
+        block = stream.read(READ_BLOCK_SIZE)
+        if not block:
+            break
+        lines = (partial + block).split('\n')
+        partial = lines.pop()
+        if len(partial) > MAX_LINE_LENGTH:
+            abort(400, "Input line received for project %s is too long" % project)
+        for line in lines:
+            yield line
+    if partial:
+        yield partial
+
+
+def _load_mapfile(session, proj, stream, ignore_dups):
+    """Helper method to insert the mappings in a map file, reading, checking
+    and inserting them a chunk at a time.  Each chunk is inserted with a
+    single multi-row INSERT, and when ignoring duplicates each chunk is
+    committed on its own.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        proj: Project object
+        stream: File-like object containing the map file
+        ignore_dups: Boolean; if False, abort on duplicate entries without
+        inserting anything
+
+    Returns:
+        A tuple (number of mappings inserted, number skipped)
+
+    Exceptions:
+        HTTP 400: Malformed SHA
+        HTTP 409: ignore_dups=False and there are duplicate entries
+    """
+    project = proj.name
+    project_id = proj.id
+    if session.get_bind().dialect.name == 'sqlite':
+        chunk_size = SQLITE_INSERT_CHUNK_SIZE
+    else:
+        chunk_size = INSERT_CHUNK_SIZE
+
+    # inserted lines are spooled to disk until they are committed, then
+    # appended to the project's snapshot
+    spool = tempfile.TemporaryFile() if current_app.mapper_snapshots else None
+    spooled = 0
+    inserted = skipped = 0
+    lines = _read_lines(stream, project)
+    try:
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                break
+            pairs = _parse_mapfile_lines(chunk, project)  # can raise HTTP 400
+            if spool and ignore_dups:
+                # leave out the duplicates, so that we know which mappings
+                # are inserted
+                candidates = _new_pairs(session, project_id, pairs)
+            else:
+                candidates = pairs
+            count = 0
+            if candidates:
+                count = _insert_chunk(session, project_id, candidates, ignore_dups)
+                _bump_high_water_mark(session, project_id, count)
+            if ignore_dups:
+                session.commit()
+            inserted += count
+            skipped += len(pairs) - count
+            logger.info("project %s: processed %d mappings (%d inserted, %d skipped)"
+                        % (project, inserted + skipped, inserted, skipped))
+            if spool and count:
+                if count == len(candidates):
+                    spool.writelines('%s %s\n' % pair for pair in candidates)
+                    spooled += count
+                else:
+                    # a concurrent insert raced with this one, so we can't
+                    # tell which lines were inserted
+                    spool.close()
+                    spool = None
+        session.commit()
+    except sa.exc.IntegrityError:
+        session.rollback()
+        abort(409, "Some of the given mappings for project %s already exist"
+              % project)
+
+    if spool:
+        spool.seek(0)
+        _update_snapshot(session, proj, spool, spooled)
+        spool.close()
+    return inserted, skipped
 
 
 def _insert_many(project, ignore_dups=False):
     """Update the database with many git-hg mappings.
 
+    The request body is read and inserted incrementally, so memory use does
+    not depend on its size.
+
     Args:
         project: Single project name string
         ignore_dups: Boolean; if False, abort on duplicate entries without inserting
         anything
 
     Returns:
-        An empty json response body
+        A json response body giving the number of mappings inserted and
+        skipped
 
     Exceptions:
         HTTP 400: Request content-type is not 'text/plain'
@@ -285,36 +1308,8 @@ def _insert_many(project, ignore_dups=False):
             400, "HTTP request header 'Content-Type' must be set to 'text/plain'")
     session = g.db.session(DB_DECLARATIVE_BASE)
     proj = _get_project(session, project)  # can raise HTTP 404 or HTTP 500
-    for line in request.stream.readlines():
-        line = line.rstrip()
-        try:
-            (git_commit, hg_changeset) = line.split(' ')
-        except ValueError:
-            logger.error(
-                "Received input line: '%s' for project %s", line, project)
-            logger.error("Was expecting an input line such as "
-                         "'686a558fad7954d8481cfd6714cdd56b491d2988 "
-                         "fef90029cb654ad9848337e262078e403baf0c7a'")
-            logger.error("i.e. where the first hash is a git commit SHA "
-                         "and the second hash is a mercurial changeset SHA")
-            abort(400, "Input line '%s' received for project %s did not contain a space"
-                  % (line, project))
-            # header/footer won't match this format
-            continue
-        _add_hash(session, git_commit, hg_changeset, proj)  # can raise HTTP 400
-        if ignore_dups:
-            try:
-                session.commit()
-            except sa.exc.IntegrityError:
-                session.rollback()
-    if not ignore_dups:
-        try:
-            session.commit()
-        except sa.exc.IntegrityError:
-            session.rollback()
-            abort(409, "Some of the given mappings for project %s already exist"
-                  % project)
-    return jsonify()
+    inserted, skipped = _load_mapfile(session, proj, request.stream, ignore_dups)
+    return jsonify(inserted=inserted, skipped=skipped)
 
 
 @bp.route('/<project>/insert', methods=('POST',))
@@ -331,6 +1326,389 @@ def insert_many_ignore_dups(project):
     return _insert_many(project, ignore_dups=True)  # can raise HTTP 400, 404, 500
 
 
+def _import_dir():
+    """Helper method to find (and if necessary create) the directory in which
+    map files are kept while they are imported.
+
+    Returns:
+        The directory's path
+
+    Exceptions:
+        HTTP 500: MAPPER_IMPORT_DIR is not configured
+    """
+    directory = current_app.config.get('MAPPER_IMPORT_DIR')
+    if not directory:
+        abort(500, "Map file import jobs are not enabled (MAPPER_IMPORT_DIR is not set)")
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return directory
+
+
+def _spool_mapfile(stream, progress=None):
+    """Helper method to copy a map file into the import directory.
+
+    Args:
+        stream: File-like object containing the map file
+        progress: Function to call after each block is copied (optional)
+
+    Returns:
+        A tuple (name of the file in the import directory, size in bytes)
+    """
+    fd, path = tempfile.mkstemp(prefix='import-', suffix='.map', dir=_import_dir())
+    with os.fdopen(fd, 'wb') as f:
+        while True:
+            block = stream.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            f.write(block)
+            if progress:
+                progress()
+        size = f.tell()
+    return os.path.basename(path), size
+
+
+def _check_import_url(url):
+    """Helper method to check that a map file may be downloaded from the given
+    URL: it must be an https URL on one of the hosts listed in
+    MAPPER_IMPORT_URL_HOSTS, so that the server cannot be made to fetch
+    arbitrary URLs.
+
+    Args:
+        url: URL of the map file
+
+    Exceptions:
+        HTTP 400: The URL is not allowed
+    """
+    hosts = current_app.config.get('MAPPER_IMPORT_URL_HOSTS', [])
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme != 'https' or parsed.hostname not in hosts:
+        abort(400, "Map files can only be imported from https URLs on %s"
+              % (', '.join(hosts) or "no hosts (MAPPER_IMPORT_URL_HOSTS is not set)"))
+
+
+def _download_mapfile(url, progress=None):
+    """Helper method to download a map file into the import directory.
+    Redirects are not followed, since they could lead anywhere.
+
+    Args:
+        url: URL of the map file
+        progress: Function to call after each block is downloaded (optional)
+
+    Returns:
+        A tuple (name of the file in the import directory, size in bytes)
+
+    Exceptions:
+        requests.exceptions.RequestException: The download failed
+    """
+    resp = requests.get(url, stream=True, timeout=60, allow_redirects=False)
+    try:
+        resp.raise_for_status()
+        if resp.is_redirect:
+            raise requests.exceptions.HTTPError(
+                "%s redirects to %s" % (url, resp.headers.get('Location')), response=resp)
+        resp.raw.decode_content = True
+        return _spool_mapfile(resp.raw, progress)
+    finally:
+        resp.close()
+
+
+class ImportSuperseded(Exception):
+
+    """Another worker has claimed an import job."""
+
+
+def _claim_import(session, job):
+    """Helper method to claim an import job for this worker, by setting its
+    state to STARTED, provided that no one else has changed its state or
+    updated time since it was read.  The new updated time is always later
+    than the old, so it identifies this worker's claim.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        job: ImportJob object
+
+    Returns:
+        The job's new updated time, or None if the job was not claimed
+    """
+    claimed = max(int(time.time()), job.updated + 1)
+    tbl = ImportJob.__table__
+    result = session.execute(tbl.update().where(tbl.c.id == job.id).where(
+        tbl.c.state == job.state).where(tbl.c.updated == job.updated).values(
+        state='STARTED', error=None, updated=claimed))
+    session.commit()
+    return claimed if result.rowcount == 1 else None
+
+
+def _renew_claim(session, job_id, claimed, **values):
+    """Helper method to record that this worker is still running an import
+    job, as part of the current transaction.  The job is only updated if no
+    one else has changed it since this worker last did.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        job_id: Id of the job
+        claimed: The job's updated time, as last set by this worker
+        values: Other columns to update
+
+    Returns:
+        The job's new updated time
+
+    Exceptions:
+        ImportSuperseded: The job has been resumed, and perhaps claimed by
+        another worker
+    """
+    now = max(int(time.time()), claimed)
+    tbl = ImportJob.__table__
+    result = session.execute(tbl.update().where(tbl.c.id == job_id).where(
+        tbl.c.state == 'STARTED').where(tbl.c.updated == claimed).values(
+        updated=now, **values))
+    if result.rowcount != 1:
+        raise ImportSuperseded("import job %d has been claimed by another worker" % job_id)
+    return now
+
+
+def _run_import(session, job, stream, renew):
+    """Helper method to insert the mappings in a map file for an import job,
+    starting at the job's offset.  Each chunk is committed together with the
+    job's progress, so that an interrupted job can resume exactly where it
+    stopped.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        job: ImportJob object
+        stream: File-like object containing the map file, positioned at the
+        job's offset
+        renew: Function to renew this worker's claim on the job, as part of
+        the current transaction
+
+    Exceptions:
+        HTTP 400: Malformed SHA
+        IntegrityError: job.ignore_dups is False and there are duplicate
+        entries
+        ImportSuperseded: Another worker has claimed the job
+    """
+    project = job.project.name
+    if session.get_bind().dialect.name == 'sqlite':
+        chunk_size = SQLITE_INSERT_CHUNK_SIZE
+    else:
+        chunk_size = INSERT_CHUNK_SIZE
+
+    lines = _read_lines(stream, project)
+    while True:
+        started = time.time()
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            break
+        pairs = _parse_mapfile_lines(chunk, project)  # can raise HTTP 400
+        count = _insert_chunk(session, job.project_id, pairs, job.ignore_dups)
+        _bump_high_water_mark(session, job.project_id, count)
+        # _read_lines strips exactly one newline from each line
+        job.offset += sum(len(line) + 1 for line in chunk)
+        job.processed += len(pairs)
+        job.inserted += count
+        job.skipped += len(pairs) - count
+        job.elapsed += time.time() - started
+        renew()  # can raise ImportSuperseded
+        session.commit()
+        logger.info("import job %d for project %s: processed %d mappings "
+                    "(%d inserted, %d skipped)"
+                    % (job.id, project, job.processed, job.inserted, job.skipped))
+
+
+def _fail_import(session, job_id, claimed, error):
+    """Helper method to roll back the current chunk of an import job, and
+    record that the job has failed, unless another worker has claimed it."""
+    session.rollback()
+    try:
+        _renew_claim(session, job_id, claimed, state='FAILURE', error=error)
+    except ImportSuperseded:
+        session.rollback()
+        return
+    session.commit()
+
+
+@celery.task(acks_late=True, ignore_result=True)
+def import_mapfile(job_id, stalled_only=False):
+    """A celery task that imports the map file for the import job with id
+    <job_id>, downloading it first if necessary.
+
+    Progress is committed as each chunk is inserted, so the task can be run
+    again to resume a job that was interrupted.  Since it is acknowledged
+    only once it completes, a job whose worker dies is picked up by another
+    worker: if the job still appears to be running, the task checks again
+    once it would be considered stalled, with stalled_only set, and then
+    only takes over a job that is still STARTED.
+
+    Each worker claims the job before starting, and checks that its claim
+    still stands whenever it records progress, so at most one worker can be
+    importing a job at a time.
+    """
+    session = current_app.db.session(DB_DECLARATIVE_BASE)
+    job = session.query(ImportJob).get(job_id)
+    if job is None or job.state == 'SUCCESS':
+        return
+    if job.state == 'STARTED' and job.updated > time.time() - IMPORT_STALLED_AFTER:
+        import_mapfile.apply_async((job_id,), {'stalled_only': True},
+                                   countdown=IMPORT_STALLED_AFTER)
+        return
+    if stalled_only and job.state != 'STARTED':
+        return
+    project = job.project.name
+    claim = {'updated': _claim_import(session, job), 'renewed': time.time()}
+    if claim['updated'] is None:
+        logger.info("import job %d was claimed by another worker" % job_id)
+        return
+
+    def renew(**values):
+        claim['updated'] = _renew_claim(session, job_id, claim['updated'], **values)
+        claim['renewed'] = time.time()
+
+    def heartbeat():
+        # called as each block of the map file is downloaded
+        if time.time() - claim['renewed'] >= IMPORT_HEARTBEAT_INTERVAL:
+            renew()
+            session.commit()
+
+    try:
+        if job.filename is None:
+            filename, size = _download_mapfile(job.src_url, heartbeat)
+            renew(filename=filename, size=size)
+            session.commit()
+        path = os.path.join(_import_dir(), job.filename)
+        with open(path, 'rb') as f:
+            f.seek(job.offset)
+            _run_import(session, job, f, renew)
+        renew(state='SUCCESS')
+        session.commit()
+    except ImportSuperseded:
+        session.rollback()
+        logger.warning("import job %d for project %s was claimed by another worker; "
+                       "stopping" % (job_id, project))
+        return
+    except HTTPException as e:
+        _fail_import(session, job_id, claim['updated'], e.description)
+        return
+    except sa.exc.IntegrityError:
+        _fail_import(session, job_id, claim['updated'], "Some of the given mappings "
+                     "for project %s already exist" % project)
+        return
+    except Exception as e:
+        logger.exception("import job %d for project %s failed" % (job_id, project))
+        _fail_import(session, job_id, claim['updated'], str(e))
+        return
+    os.unlink(path)
+
+
+def _import_job_response(job, status_code=200):
+    response = jsonify(job.to_json())
+    response.status_code = status_code
+    response.headers['Location'] = url_for('mapper.get_import_job', job_id=job.id)
+    return response
+
+
+def _create_import_job(project, ignore_dups):
+    """Create an import job for a map file, and queue it to be run
+    asynchronously.
+
+    The map file is either the request body, or downloaded from the URL given
+    in a JSON request body.
+
+    Args:
+        project: Single project name string
+        ignore_dups: Boolean; if False, the job fails at the first chunk
+        containing a duplicate entry
+
+    Returns:
+        A json response body describing the job, with status 202
+
+    Exceptions:
+        HTTP 400: Request content-type is not 'text/plain' or
+        'application/json', or no URL is given
+        HTTP 404: Project not found
+        HTTP 500: Multiple projects found with matching project name, or
+        import jobs are not enabled
+    """
+    session = g.db.session(DB_DECLARATIVE_BASE)
+    proj = _get_project(session, project)  # can raise HTTP 404 or HTTP 500
+    now = int(time.time())
+    job = ImportJob(project=proj, ignore_dups=ignore_dups, state='PENDING',
+                    offset=0, processed=0, inserted=0, skipped=0, elapsed=0,
+                    created=now, updated=now)
+    if request.content_type == 'text/plain':
+        job.filename, job.size = _spool_mapfile(request.stream)  # can raise HTTP 500
+    elif request.content_type == 'application/json':
+        body = request.get_json(silent=True)
+        url = body.get('url') if isinstance(body, dict) else None
+        if not isinstance(url, basestring):
+            abort(400, "Request body must be a JSON object with a 'url'")
+        _check_import_url(url)  # can raise HTTP 400
+        _import_dir()  # can raise HTTP 500
+        job.src_url = url
+    else:
+        abort(400, "HTTP request header 'Content-Type' must be set to 'text/plain' "
+              "or 'application/json'")
+    session.add(job)
+    session.commit()
+    response = _import_job_response(job, 202)
+    import_mapfile.delay(job.id)
+    return response
+
+
+@bp.route('/<project>/import', methods=('POST',))
+@p.mapper.mapping.insert.require()
+def import_no_dups(project):
+    # (documentation in relengapi/docs/usage/mapper.rst)
+    return _create_import_job(project, ignore_dups=False)  # can raise HTTP 400, 404, 500
+
+
+@bp.route('/<project>/import/ignoredups', methods=('POST',))
+@p.mapper.mapping.insert.require()
+def import_ignore_dups(project):
+    # (documentation in relengapi/docs/usage/mapper.rst)
+    return _create_import_job(project, ignore_dups=True)  # can raise HTTP 400, 404, 500
+
+
+def _get_import_job(session, job_id):
+    job = session.query(ImportJob).get(job_id)
+    if job is None:
+        abort(404, "Import job %d not found" % job_id)
+    return job
+
+
+@bp.route('/import/<int:job_id>')
+def get_import_job(job_id):
+    # (documentation in relengapi/docs/usage/mapper.rst)
+    session = g.db.session(DB_DECLARATIVE_BASE)
+    return _import_job_response(_get_import_job(session, job_id))  # can raise HTTP 404
+
+
+@bp.route('/import/<int:job_id>/resume', methods=('POST',))
+@p.mapper.mapping.insert.require()
+def resume_import_job(job_id):
+    # (documentation in relengapi/docs/usage/mapper.rst)
+    session = g.db.session(DB_DECLARATIVE_BASE)
+    job = _get_import_job(session, job_id)  # can raise HTTP 404
+    if job.state == 'SUCCESS':
+        abort(409, "Import job %d has already completed" % job_id)
+    if job.state == 'STARTED' and job.updated > time.time() - IMPORT_STALLED_AFTER:
+        abort(409, "Import job %d is still running" % job_id)
+    # only requeue the job if no worker has updated it since it was read
+    tbl = ImportJob.__table__
+    result = session.execute(tbl.update().where(tbl.c.id == job_id).where(
+        tbl.c.state == job.state).where(tbl.c.updated == job.updated).values(
+        state='PENDING', updated=max(int(time.time()), job.updated + 1)))
+    session.commit()
+    if result.rowcount != 1:
+        abort(409, "Import job %d is still running" % job_id)
+    session.refresh(job)
+    response = _import_job_response(job, 202)
+    import_mapfile.delay(job.id)
+    return response
+
+
 @bp.route('/<project>/insert/<git_commit>/<hg_changeset>', methods=('POST',))
 @p.mapper.mapping.insert.require()
 def insert_one(project, git_commit, hg_changeset):
@@ -338,10 +1716,12 @@ def insert_one(project, git_commit, hg_changeset):
     session = g.db.session(DB_DECLARATIVE_BASE)
     proj = _get_project(session, project)  # can raise HTTP 404 or HTTP 500
     _add_hash(session, git_commit, hg_changeset, proj)  # can raise HTTP 400
+    _bump_high_water_mark(session, proj.id, 1)
     try:
         session.commit()
-        q = Hash.query.join(Project).filter(_project_filter(project))
-        q = q.filter(sa.text("git_commit == :commit")).params(commit=git_commit)
+        _update_snapshot(session, proj, ['%s %s\n' % (git_commit, hg_changeset)], 1)
+        q = session.query(Hash).filter(Hash.project_id == proj.id)
+        q = q.filter(Hash.git_commit == git_commit)
         return q.one().as_json()
     except sa.exc.IntegrityError:
         abort(409, "Provided mapping %s %s for project %s already exists and "
@@ -354,16 +1734,67 @@ def insert_one(project, git_commit, hg_changeset):
               "the database multiple times" % (git_commit, hg_changeset, project))
 
 
+def _create_project(session, name):
+    """Helper method to create a project, with its high water mark and, if
+    MAPPER_PARTITION_HASHES is set, its partition of the hashes table, so that
+    mappings can be inserted as soon as the project exists.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        name: Name of the project
+
+    Returns:
+        The new Project object
+
+    Exceptions:
+        sa.exc.DBAPIError: The project could not be created
+    """
+    partitioned = current_app.config.get('MAPPER_PARTITION_HASHES')
+    p = Project(name=name)
+    session.add(p)
+    session.add(HighWaterMark(project=p, count=0))
+    try:
+        session.flush()
+        project_id = p.id
+        conn = session.connection()
+        mysql = conn.dialect.name == 'mysql'
+        if partitioned and not mysql:
+            # Postgres DDL is transactional, so the partition is committed
+            # along with the project
+            partition.add_partition(conn, project_id)
+        session.commit()
+    except sa.exc.DBAPIError:
+        session.rollback()
+        raise
+    if partitioned and mysql:
+        # MySQL commits implicitly before any DDL, so the partition is added
+        # once the project, and so its id, is committed; if that fails, the
+        # project is removed again.  Each project's id is its own, so
+        # concurrent creations cannot touch one another's partitions.
+        try:
+            partition.add_partition(session.connection(), project_id)
+        except sa.exc.DBAPIError:
+            session.rollback()
+            session.query(HighWaterMark).filter_by(project_id=project_id).delete()
+            session.query(Project).filter_by(id=project_id).delete()
+            session.commit()
+            raise
+    return p
+
+
 @bp.route('/<project>', methods=('POST',))
 @p.mapper.project.insert.require()
 def add_project(project):
     # (documentation in relengapi/docs/usage/mapper.rst)
     session = g.db.session(DB_DECLARATIVE_BASE)
-    p = Project(name=project)
-    session.add(p)
     try:
-        session.commit()
-    except (sa.exc.IntegrityError, sa.exc.ProgrammingError):
+        _create_project(session, project)
+    except (sa.exc.IntegrityError, sa.exc.ProgrammingError, sa.exc.OperationalError):
         abort(409, "Project %s could not be inserted into the database" %
               project)
     return jsonify()
+
+
+@bp.record
+def init_blueprint(state):
+    snapshot.init_app(state.app)
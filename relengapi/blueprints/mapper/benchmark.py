@@ -0,0 +1,212 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import datetime
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import structlog
+from flask import current_app
+
+from relengapi.lib import subcommands
+
+logger = structlog.get_logger()
+
+# A benchmark harness for mapper: it creates a synthetic project in the
+# configured database (SQLite or MySQL), and times inserts, lookups and
+# mapfile downloads through mapper's own code paths, printing the results as
+# JSON so that runs can be compared.  The project is deleted afterward.
+#
+# The blueprint imports this module, by way of the partition module (so that
+# the subcommand is registered), so mapper itself is imported by each
+# function that needs it.
+
+
+def _sha(kind, seed, i):
+    return hashlib.sha1('%s-%s-%d' % (kind, seed, i)).hexdigest()
+
+
+def _write_mapfile(seed, start, stop):
+    """Write a map file with synthetic mappings numbered [start, stop) to a
+    temporary file, returning the file positioned at its start."""
+    f = tempfile.TemporaryFile()
+    for i in xrange(start, stop):
+        f.write('%s %s\n' % (_sha('git', seed, i), _sha('hg', seed, i)))
+    f.seek(0)
+    return f
+
+
+def latency_summary(times):
+    """Summarize a list of latencies, in seconds, as milliseconds."""
+    times = sorted(times)
+    if not times:
+        return None
+
+    def at(fraction):
+        return times[min(len(times) - 1, int(len(times) * fraction))] * 1000
+    return {
+        'count': len(times),
+        'median_ms': at(0.5),
+        'p95_ms': at(0.95),
+        'max_ms': times[-1] * 1000,
+    }
+
+
+def _time_insert(app, project, mapfile, ignore_dups):
+    from relengapi.blueprints import mapper
+    mapfile.seek(0, os.SEEK_END)
+    size = mapfile.tell()
+    mapfile.seek(0)
+    with app.test_request_context('/mapper/%s/insert' % project, method='POST',
+                                  input_stream=mapfile, content_type='text/plain',
+                                  content_length=size):
+        app.preprocess_request()
+        start = time.time()
+        response = mapper._insert_many(project, ignore_dups=ignore_dups)
+        elapsed = time.time() - start
+    result = json.loads(response.data)
+    rows = result['inserted'] + result['skipped']
+    result.update({
+        'seconds': elapsed,
+        'rows_per_second': rows / elapsed if elapsed else None,
+    })
+    return result
+
+
+def _time_lookups(client, project, shas):
+    times = []
+    for sha in shas:
+        start = time.time()
+        rv = client.get('/mapper/%s/rev/git/%s' % (project, sha))
+        times.append(time.time() - start)
+        if rv.status_code != 200:
+            raise RuntimeError("lookup of %s failed with status %d" % (sha, rv.status_code))
+    return latency_summary(times)
+
+
+def _time_download(client, url, gzip=False):
+    headers = [('Accept-Encoding', 'gzip')] if gzip else []
+    start = time.time()
+    rv = client.get(url, headers=headers, buffered=False)
+    first_byte = None
+    size = 0
+    try:
+        for chunk in rv.response:
+            if first_byte is None:
+                first_byte = time.time() - start
+            size += len(chunk)
+    finally:
+        rv.close()
+    return {
+        'status': rv.status_code,
+        'bytes': size,
+        'time_to_first_byte_ms': first_byte * 1000 if first_byte is not None else None,
+        'total_ms': (time.time() - start) * 1000,
+    }
+
+
+def _delete_project(session, name):
+    from relengapi.blueprints import mapper
+    proj = session.query(mapper.Project).filter(mapper.Project.name == name).first()
+    if not proj:
+        return
+    for table in mapper.Hash, mapper.HighWaterMark, mapper.ImportJob:
+        session.query(table).filter(table.project_id == proj.id).delete()
+    session.delete(proj)
+    session.commit()
+
+
+def run_benchmark(app, rows=100000, lookups=1000, repeat=3, keep=False):
+    """Run the mapper benchmarks against a new synthetic project with 2 * `rows`
+    mappings, returning the results as a JSON-compatible dictionary."""
+    from relengapi.blueprints import mapper
+    seed = uuid.uuid4().hex[:8]
+    project = 'benchmark-%s' % seed
+    session = app.db.session(mapper.DB_DECLARATIVE_BASE)
+    results = {
+        'config': {
+            'rows': rows,
+            'lookups': lookups,
+            'repeat': repeat,
+            'dialect': session.get_bind().dialect.name,
+            'snapshots': bool(app.mapper_snapshots),
+        },
+        'started': datetime.datetime.utcnow().isoformat() + 'Z',
+    }
+    client = app.test_client()
+    mapper._create_project(session, project)
+    try:
+        first = _write_mapfile(seed, 0, rows)
+        second = _write_mapfile(seed, rows, 2 * rows)
+        logger.info("benchmark: inserting %d mappings into %s" % (rows, project))
+        results['insert'] = _time_insert(app, project, first, ignore_dups=False)
+        # date_added is stored as a whole number of seconds (rounded, on
+        # MySQL), so wait until the second batch's will all be after `since`
+        since = int(time.time()) + 1
+        time.sleep(since + 1 - time.time())
+        results['insert_ignoredups'] = _time_insert(app, project, second, ignore_dups=True)
+        results['insert_ignoredups_existing'] = _time_insert(
+            app, project, first, ignore_dups=True)
+        first.close()
+        second.close()
+
+        step = max(1, 2 * rows // lookups) if lookups else 1
+        sample = [_sha('git', seed, i) for i in xrange(0, 2 * rows, step)][:lookups]
+        logger.info("benchmark: looking up %d mappings" % len(sample))
+        results['get_rev_full'] = _time_lookups(client, project, sample)
+        results['get_rev_prefix'] = _time_lookups(client, project, [s[:12] for s in sample])
+
+        full = '/mapper/%s/mapfile/full' % project
+        since_url = '/mapper/%s/mapfile/since/%s' % (
+            project, datetime.datetime.utcfromtimestamp(since).isoformat() + '+00:00')
+        for name, url, gzip in [('mapfile_full', full, False),
+                                ('mapfile_full_gzip', full, True),
+                                ('mapfile_since', since_url, False)]:
+            logger.info("benchmark: downloading %s" % url)
+            results[name] = [_time_download(client, url, gzip) for _ in range(repeat)]
+    finally:
+        if not keep:
+            _delete_project(app.db.session(mapper.DB_DECLARATIVE_BASE), project)
+    results['project'] = project
+    return results
+
+
+def _write_results(results, output):
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+class MapperBenchmarkSubcommand(subcommands.Subcommand):
+
+    def make_parser(self, subparsers):
+        parser = subparsers.add_parser(
+            'mapper-benchmark',
+            help='Measure mapper performance with a synthetic project, printing JSON')
+        parser.add_argument('--rows', type=int, default=100000,
+                            help="Number of mappings in each inserted batch (default 100000)")
+        parser.add_argument('--lookups', type=int, default=1000,
+                            help="Number of mappings to look up (default 1000)")
+        parser.add_argument('--repeat', type=int, default=3,
+                            help="Number of times to download each mapfile (default 3)")
+        parser.add_argument('--keep', action='store_true',
+                            help="Keep the synthetic project afterward")
+        parser.add_argument('--output', metavar='FILE',
+                            help="Write the results to FILE rather than stdout")
+        return parser
+
+    def run(self, parser, args):
+        results = run_benchmark(current_app, rows=args.rows, lookups=args.lookups,
+                                repeat=args.repeat, keep=args.keep)
+        if args.output:
+            with open(args.output, 'w') as output:
+                _write_results(results, output)
+        else:
+            _write_results(results, sys.stdout)
@@ -0,0 +1,252 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import json
+import time
+
+import sqlalchemy as sa
+import structlog
+from flask import current_app
+
+from relengapi.blueprints.mapper import benchmark
+from relengapi.lib import subcommands
+
+logger = structlog.get_logger()
+
+# Mapper can optionally keep each project's mappings in its own partition of
+# the hashes table (MySQL and Postgres), so that the indexes of a small
+# project are not buried in those of a huge one.  Every index on the table
+# begins with project_id, so the partitioning key is part of every unique
+# key, as both databases require.  MySQL does not support foreign keys on
+# partitioned tables, so there the foreign key to the projects table is
+# dropped.  The layout is opt-in: with MAPPER_PARTITION_HASHES set in the
+# environment, the Alembic migration 9a4d2f6b8c1e converts the table, and with
+# it set in the configuration, mapper adds a partition for each new project.
+# Other databases are left unpartitioned.
+
+HASHES_TABLE = 'releng_mapper_hashes'
+PROJECTS_TABLE = 'releng_mapper_projects'
+
+INDEXES = [
+    ('INDEX', 'project_id__date_added__hg_changeset', 'project_id, date_added, hg_changeset'),
+    ('UNIQUE INDEX', 'project_id__hg_changeset', 'project_id, hg_changeset'),
+    ('UNIQUE INDEX', 'project_id__git_commit', 'project_id, git_commit'),
+]
+
+
+def _partition(project_id):
+    return 'PARTITION p%d VALUES IN (%d)' % (project_id, project_id)
+
+
+def partition_statement(project_ids):
+    """Return the statement to partition the hashes table by project, with a
+    partition for each of the given projects (MySQL)."""
+    return 'ALTER TABLE %s PARTITION BY LIST (project_id) (%s)' % (
+        HASHES_TABLE, ', '.join(_partition(id) for id in sorted(project_ids)))
+
+
+def add_partition_statement(project_id):
+    """Return the statement to add a partition for a new project (MySQL)."""
+    return 'ALTER TABLE %s ADD PARTITION (%s)' % (HASHES_TABLE, _partition(project_id))
+
+
+def pg_add_partition_statement(project_id):
+    """Return the statement to add a partition for a new project (Postgres)."""
+    return 'CREATE TABLE %s_p%d PARTITION OF %s FOR VALUES IN (%d)' % (
+        HASHES_TABLE, project_id, HASHES_TABLE, project_id)
+
+
+def _pg_copy_statements(old, partition_by):
+    # replace the hashes table (renamed to `old`) with a copy, whose indexes
+    # take the names of the old table's once it is dropped
+    return [
+        'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)%s'
+        % (HASHES_TABLE, old, partition_by),
+    ], [
+        'INSERT INTO %s SELECT * FROM %s' % (HASHES_TABLE, old),
+        'DROP TABLE %s' % old,
+    ] + ['CREATE %s %s ON %s (%s)' % (kind, name, HASHES_TABLE, columns)
+         for kind, name, columns in INDEXES] + [
+        'ALTER TABLE %s ADD FOREIGN KEY (project_id) REFERENCES %s (id)'
+        % (HASHES_TABLE, PROJECTS_TABLE),
+    ]
+
+
+def pg_partition_statements(project_ids):
+    """Return the statements to partition the hashes table by project, with a
+    partition for each of the given projects (Postgres)."""
+    old = HASHES_TABLE + '_unpartitioned'
+    create, copy = _pg_copy_statements(old, ' PARTITION BY LIST (project_id)')
+    return ['ALTER TABLE %s RENAME TO %s' % (HASHES_TABLE, old)] + create + [
+        pg_add_partition_statement(id) for id in sorted(project_ids)] + copy
+
+
+def unpartition_statements(dialect):
+    """Return the statements to revert to a single hashes table."""
+    if dialect == 'postgresql':
+        old = HASHES_TABLE + '_partitioned'
+        create, copy = _pg_copy_statements(old, '')
+        return ['ALTER TABLE %s RENAME TO %s' % (HASHES_TABLE, old)] + create + copy
+    return [
+        'ALTER TABLE %s REMOVE PARTITIONING' % HASHES_TABLE,
+        'ALTER TABLE %s ADD FOREIGN KEY (project_id) REFERENCES %s (id)'
+        % (HASHES_TABLE, PROJECTS_TABLE),
+    ]
+
+
+def partitioned_projects(conn):
+    """Return the set of project ids with a partition of the hashes table, or
+    None if the table is not partitioned."""
+    dialect = conn.dialect.name
+    if dialect == 'mysql':
+        rows = conn.execute(sa.text(
+            "SELECT partition_name FROM information_schema.partitions "
+            "WHERE table_schema = DATABASE() AND table_name = :table "
+            "AND partition_name IS NOT NULL"), {'table': HASHES_TABLE}).fetchall()
+        if not rows:
+            return None
+        return set(int(name[1:]) for (name,) in rows)
+    elif dialect == 'postgresql':
+        # a partitioned table can have no partitions, on Postgres
+        if conn.execute(sa.text(
+                "SELECT 1 FROM pg_partitioned_table JOIN pg_class "
+                "ON pg_class.oid = partrelid WHERE relname = :table "
+                "AND pg_table_is_visible(pg_class.oid)"),
+                {'table': HASHES_TABLE}).scalar() is None:
+            return None
+        rows = conn.execute(sa.text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = inhparent "
+            "JOIN pg_class child ON child.oid = inhrelid "
+            "WHERE parent.relname = :table AND pg_table_is_visible(parent.oid)"),
+            {'table': HASHES_TABLE}).fetchall()
+        return set(int(name[len(HASHES_TABLE) + 2:]) for (name,) in rows)
+    return None
+
+
+def _foreign_keys(conn):
+    rows = conn.execute(sa.text(
+        "SELECT constraint_name FROM information_schema.referential_constraints "
+        "WHERE constraint_schema = DATABASE() AND table_name = :table "
+        "AND referenced_table_name = :referenced"),
+        {'table': HASHES_TABLE, 'referenced': PROJECTS_TABLE}).fetchall()
+    return [name for (name,) in rows]
+
+
+def add_partition(conn, project_id):
+    """Add a partition for a new project, if the hashes table is partitioned,
+    returning True if one was added.
+
+    On Postgres, the partition is created in the connection's current
+    transaction, so it should be called after the project has been flushed
+    and before it is committed.  MySQL commits implicitly before any DDL, so
+    there it should be called once the project has been committed."""
+    projects = partitioned_projects(conn)
+    if projects is None or project_id in projects:
+        return False
+    logger.info("adding mapper hashes partition for project id %d" % project_id)
+    if conn.dialect.name == 'postgresql':
+        conn.execute(pg_add_partition_statement(project_id))
+    else:
+        conn.execute(add_partition_statement(project_id))
+    return True
+
+
+def partition_statements(conn):
+    """Return the statements needed to bring the hashes table into the
+    partitioned layout: converting it if it is not partitioned, or adding any
+    missing partitions if it is.  On databases other than MySQL and Postgres,
+    the table is left as it is."""
+    dialect = conn.dialect.name
+    if dialect not in ('mysql', 'postgresql'):
+        logger.warning("mapper partitioning is not supported on %s; "
+                       "leaving the hashes table unpartitioned" % dialect)
+        return []
+    project_ids = set(id for (id,) in conn.execute(
+        sa.text("SELECT id FROM %s" % PROJECTS_TABLE)))
+    partitioned = partitioned_projects(conn)
+    if dialect == 'postgresql':
+        if partitioned is None:
+            return pg_partition_statements(project_ids)
+        return [pg_add_partition_statement(id) for id in sorted(project_ids - partitioned)]
+    if partitioned is None:
+        if not project_ids:
+            # MySQL cannot partition a table into no partitions
+            logger.warning("there are no mapper projects yet; "
+                           "leaving the hashes table unpartitioned")
+            return []
+        return ['ALTER TABLE %s DROP FOREIGN KEY %s' % (HASHES_TABLE, name)
+                for name in _foreign_keys(conn)] + [partition_statement(project_ids)]
+    return [add_partition_statement(id) for id in sorted(project_ids - partitioned)]
+
+
+def benchmark_lookups(session, project, samples=1000):
+    """Time lookups of full and abbreviated git SHAs in the given project,
+    returning a dictionary of latency statistics in milliseconds."""
+    project_id = session.execute(
+        sa.text("SELECT id FROM %s WHERE name = :name" % PROJECTS_TABLE),
+        {'name': project}).scalar()
+    if project_id is None:
+        raise ValueError("no such project %s" % project)
+    # the SHAs are read in their stored (binary) form, and bound as such to
+    # the lookup queries below
+    shas = [str(sha) for (sha,) in session.execute(sa.text(
+        "SELECT git_commit FROM %s WHERE project_id = :id LIMIT :limit" % HASHES_TABLE),
+        {'id': project_id, 'limit': samples})]
+    full = sa.text("SELECT hg_changeset FROM %s WHERE project_id = :id "
+                   "AND git_commit = :sha" % HASHES_TABLE).bindparams(
+        sa.bindparam('sha', type_=sa.LargeBinary))
+    prefix = sa.text("SELECT hg_changeset FROM %s WHERE project_id = :id "
+                     "AND git_commit BETWEEN :low AND :high LIMIT 2" % HASHES_TABLE).bindparams(
+        sa.bindparam('low', type_=sa.LargeBinary), sa.bindparam('high', type_=sa.LargeBinary))
+    results = {'project': project, 'samples': len(shas)}
+    for name, query, params in [
+            ('full', full, lambda sha: {'id': project_id, 'sha': sha}),
+            ('prefix', prefix, lambda sha: {'id': project_id,
+                                            'low': sha[:3] + '\x00' * 17,
+                                            'high': sha[:3] + '\xff' * 17})]:
+        times = []
+        for sha in shas:
+            start = time.time()
+            session.execute(query, params(sha)).fetchall()
+            times.append(time.time() - start)
+        results[name] = benchmark.latency_summary(times)
+    session.rollback()
+    return results
+
+
+class MapperPartitionSubcommand(subcommands.Subcommand):
+
+    def make_parser(self, subparsers):
+        parser = subparsers.add_parser(
+            'mapper-partition',
+            help='Show the SQL to partition the mapper hashes table by project, '
+                 'or benchmark lookups')
+        parser.add_argument('--undo', action='store_true',
+                            help="Show the SQL to revert to a single, unpartitioned hashes table")
+        parser.add_argument('--benchmark', metavar='PROJECT', action='append', default=[],
+                            help="Instead, print lookup latencies for PROJECT as JSON")
+        return parser
+
+    def run(self, parser, args):
+        # the table is converted by an Alembic migration; this only shows the
+        # SQL involved, so that it can be reviewed beforehand, or applied by
+        # hand where the migrations are run offline
+        session = current_app.db.session('relengapi')
+        if args.benchmark:
+            for project in args.benchmark:
+                print json.dumps(benchmark_lookups(session, project), sort_keys=True)
+            return
+        conn = session.connection()
+        if args.undo:
+            statements = []
+            if partitioned_projects(conn) is not None:
+                statements = unpartition_statements(conn.dialect.name)
+        else:
+            statements = partition_statements(conn)
+        for statement in statements:
+            print statement + ';'
+        session.rollback()
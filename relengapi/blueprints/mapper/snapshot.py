@@ -0,0 +1,488 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import binascii
+import bisect
+import contextlib
+import fcntl
+import heapq
+import json
+import mmap
+import os
+import tempfile
+import threading
+import uuid
+import zlib
+
+import structlog
+
+logger = structlog.get_logger()
+
+# size of the blocks in which snapshot contents are read and streamed
+BLOCK_SIZE = 64 * 1024
+
+# default number of lines the delta can grow to before the next read merges it
+# into the base file
+DEFAULT_MAX_DELTA = 10000
+
+# zlib compression level for gzipped mapfiles
+GZIP_LEVEL = 6
+
+# size of each record in the SHA index files
+INDEX_RECORD_SIZE = 40
+
+# number of index records sorted in memory at a time when building the git
+# index; larger indexes are sorted in runs, which are then merged
+SORT_RUN_RECORDS = 250000
+
+
+def _hg_key(line):
+    # mapfile lines are "<git sha> <hg sha>\n", and are sorted by hg sha
+    return line[41:81]
+
+
+def _index_record(key, value):
+    # index records are a 20-byte binary key SHA followed by the 20-byte
+    # binary SHA it maps to
+    return binascii.unhexlify(key) + binascii.unhexlify(value)
+
+
+def _read_records(f):
+    while True:
+        record = f.read(INDEX_RECORD_SIZE)
+        if not record:
+            return
+        yield record
+
+
+def merged(*iterables):
+    """Lazily merge iterables of mapfile lines, each sorted by hg changeset,
+    into a single sorted iterable.  Only the next line of each iterable is
+    held in memory."""
+    decorated = [((_hg_key(l), l) for l in lines) for lines in iterables]
+    return (line for _, line in heapq.merge(*decorated))
+
+
+def buffered(lines, size=BLOCK_SIZE):
+    """Group an iterable of lines into strings of roughly `size` bytes, so that
+    the WSGI server writes large chunks rather than one small write per line."""
+    buf = []
+    buflen = 0
+    for line in lines:
+        buf.append(line)
+        buflen += len(line)
+        if buflen >= size:
+            yield ''.join(buf)
+            buf = []
+            buflen = 0
+    if buf:
+        yield ''.join(buf)
+
+
+class Snapshot(object):
+
+    """An open, consistent view of a single project's snapshot.  The base file
+    and the delta are captured together, so concurrent appends or rebuilds do
+    not affect a snapshot once it is open."""
+
+    def __init__(self, count, latest, base, delta, gz=None):
+        self.count = count
+        self.latest = latest
+        self._base = base
+        self._gz = gz
+        self.delta = sorted(delta, key=_hg_key)
+
+    def matches(self, count, latest):
+        """Return True if this snapshot reflects a project with the given
+        number of mappings and latest insert time."""
+        return self.count == count and self.latest == latest
+
+    def close(self):
+        self._base.close()
+        if self._gz:
+            self._gz.close()
+
+    @property
+    def has_gzip(self):
+        """True if a gzipped copy of the full mapfile is available."""
+        return self._gz is not None and not self.delta
+
+    def lines(self):
+        """Generate the mapfile lines, sorted by hg changeset."""
+        try:
+            if not self.delta:
+                for line in self._base:
+                    yield line
+                return
+            for line in merged(self._base, self.delta):
+                yield line
+        finally:
+            self.close()
+
+    def chunks(self):
+        """Generate the mapfile contents in large blocks, suitable for use as a
+        response body."""
+        if self.delta:
+            for chunk in buffered(self.lines()):
+                yield chunk
+            return
+        for block in self._read_blocks(self._base):
+            yield block
+
+    def gzip_chunks(self):
+        """Generate the gzipped mapfile contents in large blocks.  Only valid
+        if `has_gzip` is true."""
+        assert self.has_gzip
+        for block in self._read_blocks(self._gz):
+            yield block
+
+    def _read_blocks(self, f):
+        try:
+            while True:
+                block = f.read(BLOCK_SIZE)
+                if not block:
+                    break
+                yield block
+        finally:
+            self.close()
+
+
+def _gzip_compressor():
+    # wbits > 16 selects the gzip container format
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzipped(chunks):
+    """Compress an iterable of strings into a gzip stream, yielding each
+    compressed block as it becomes available."""
+    compressor = _gzip_compressor()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class SortedShas(object):
+
+    """A read-only, memory-mapped file of index records sorted by key."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # mmap cannot map an empty file
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else ''
+        self._count = size // INDEX_RECORD_SIZE
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        if self._map:
+            self._map.close()
+
+    def _key(self, i):
+        offset = i * INDEX_RECORD_SIZE
+        return self._map[offset:offset + 20]
+
+    def find(self, prefix, limit):
+        """Return up to `limit` (key, value) pairs of hex SHAs, for the keys
+        beginning with the hex string `prefix`."""
+        low_key = binascii.unhexlify((prefix + '0' * 40)[:40])
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < low_key:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = []
+        for i in xrange(lo, min(lo + limit, self._count)):
+            offset = i * INDEX_RECORD_SIZE
+            record = binascii.hexlify(self._map[offset:offset + INDEX_RECORD_SIZE])
+            if not record.startswith(prefix):
+                break
+            found.append((record[:40], record[40:]))
+        return found
+
+
+class ShaIndex(object):
+
+    """The SHA index for one generation of a project's snapshot: the sorted
+    git and hg index files, plus the mappings in the delta, which are read
+    incrementally as they are appended."""
+
+    def __init__(self, generation, git_path, hg_path):
+        self.generation = generation
+        self._git = SortedShas(git_path)
+        try:
+            self._hg = SortedShas(hg_path)
+        except EnvironmentError:
+            self._git.close()
+            raise
+        self._delta_offset = 0
+        self._delta = {'git': [], 'hg': []}
+
+    def close(self):
+        self._git.close()
+        self._hg.close()
+
+    def read_delta(self, path):
+        """Add any lines appended to the delta file since it was last read."""
+        try:
+            with open(path) as f:
+                f.seek(self._delta_offset)
+                data = f.read()
+        except IOError:
+            return
+        # only consume whole lines
+        data = data[:data.rfind('\n') + 1]
+        self._delta_offset += len(data)
+        for line in data.splitlines():
+            git, hg = line.split(' ')
+            bisect.insort(self._delta['git'], (git, hg))
+            bisect.insort(self._delta['hg'], (hg, git))
+
+    def lookup(self, vcs, prefix, limit=2):
+        """Return a set of up to `limit` (git commit, hg changeset) tuples for
+        the mappings whose `vcs` SHA begins with `prefix`."""
+        found = (self._git if vcs == 'git' else self._hg).find(prefix, limit)
+        delta = self._delta[vcs]
+        i = bisect.bisect_left(delta, (prefix,))
+        while i < len(delta) and len(found) < limit and delta[i][0].startswith(prefix):
+            found.append(delta[i])
+            i += 1
+        if vcs == 'git':
+            return set(found[:limit])
+        return set((git, hg) for hg, git in found[:limit])
+
+
+class SnapshotStore(object):
+
+    """A directory of precomputed mapfiles, one per project, named by project
+    id.  Each project has
+
+     * ``<id>.map`` -- the base mapfile, sorted by hg changeset;
+     * ``<id>.delta`` -- mapfile lines inserted since the base was written,
+       in insertion order;
+     * ``<id>.json`` -- the number of mappings and latest insert time
+       represented by the base and delta together; and
+     * ``<id>.gz`` -- the base file, gzipped;
+     * ``<id>.gitidx`` and ``<id>.hgidx`` -- the mappings in the base file,
+       as fixed-width binary records sorted by git commit and hg changeset
+       respectively, for looking up SHAs; and
+     * ``<id>.lock`` -- a lock file guarding changes to the others.
+
+    Whether a snapshot is fresh is up to the caller, which compares the
+    recorded count and latest insert time with the project's high water mark.
+    """
+
+    def __init__(self, directory, max_delta=DEFAULT_MAX_DELTA):
+        self.directory = directory
+        self.max_delta = max_delta
+        # memory-mapped indexes, by project id
+        self._indexes = {}
+        self._indexes_lock = threading.Lock()
+        # project ids, by name; projects are never renamed or deleted
+        self.project_ids = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, project_id, ext):
+        return os.path.join(self.directory, '{}.{}'.format(project_id, ext))
+
+    @contextlib.contextmanager
+    def _lock(self, project_id, mode=fcntl.LOCK_EX):
+        with open(self._path(project_id, 'lock'), 'a') as f:
+            fcntl.flock(f, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_meta(self, project_id):
+        try:
+            with open(self._path(project_id, 'json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_meta(self, project_id, meta):
+        self._replace(project_id, 'json', json.dumps(meta))
+
+    def _replace(self, project_id, ext, contents):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.rename(tmp, self._path(project_id, ext))
+
+    def open(self, project_id):
+        """Open the snapshot for the given project, returning None if there is
+        no snapshot."""
+        with self._lock(project_id, fcntl.LOCK_SH):
+            meta = self._read_meta(project_id)
+            if meta is None:
+                return None
+            try:
+                base = open(self._path(project_id, 'map'))
+            except IOError:
+                return None
+            try:
+                with open(self._path(project_id, 'delta')) as f:
+                    delta = f.readlines()
+            except IOError:
+                delta = []
+            try:
+                gz = open(self._path(project_id, 'gz'), 'rb')
+            except IOError:
+                gz = None
+        return Snapshot(meta['count'], meta['latest'], base, delta, gz)
+
+    def append(self, project_id, lines, num_lines, count, latest):
+        """Add `num_lines` newly-inserted mapfile lines, from the iterable
+        `lines`, to the project's snapshot.  The `count` and `latest` arguments
+        describe the project in the database *after* the insert; if the
+        snapshot did not reflect every other mapping in the project, the lines
+        are not appended and the snapshot is left to be rebuilt.  Returns True
+        if the lines were appended."""
+        if not num_lines:
+            return True
+        with self._lock(project_id):
+            meta = self._read_meta(project_id)
+            if meta is None or meta['count'] + num_lines != count:
+                return False
+            with open(self._path(project_id, 'delta'), 'a') as f:
+                f.writelines(lines)
+            meta['count'] = count
+            meta['latest'] = max(meta['latest'], latest)
+            meta['delta'] = meta.get('delta', 0) + num_lines
+            self._write_meta(project_id, meta)
+        return True
+
+    def _open_index(self, project_id, count, latest):
+        with self._lock(project_id, fcntl.LOCK_SH):
+            meta = self._read_meta(project_id)
+            if meta is None or 'generation' not in meta:
+                return None
+            if meta['count'] != count or meta['latest'] != latest:
+                return None
+            with self._indexes_lock:
+                index = self._indexes.get(project_id)
+                if not index or index.generation != meta['generation']:
+                    if index:
+                        index.close()
+                        del self._indexes[project_id]
+                    try:
+                        index = ShaIndex(meta['generation'],
+                                         self._path(project_id, 'gitidx'),
+                                         self._path(project_id, 'hgidx'))
+                    except EnvironmentError:
+                        return None
+                    self._indexes[project_id] = index
+                index.read_delta(self._path(project_id, 'delta'))
+                return index
+
+    def lookup(self, project_id, vcs, prefix, count, latest, limit=2):
+        """Look up the mappings whose `vcs` ('git' or 'hg') SHA begins with
+        `prefix` in the project's index, returning a set of up to `limit`
+        (git commit, hg changeset) tuples.
+
+        The `count` and `latest` arguments describe the project in the
+        database, as for `append`.  If the index does not reflect exactly
+        those mappings -- because it has not been brought up to date with
+        mappings inserted elsewhere -- or there is no index, None is
+        returned, and the database must be consulted."""
+        index = self._open_index(project_id, count, latest)
+        if index is None:
+            return None
+        return index.lookup(vcs, prefix, limit)
+
+    def _write_git_index(self, hg_index_path):
+        # re-sort the records of the hg index (which is written in the base
+        # file's order) by git commit, a run of records at a time so that
+        # memory use does not depend on the size of the project
+        runs = []
+        try:
+            with open(hg_index_path, 'rb') as f:
+                while True:
+                    data = f.read(SORT_RUN_RECORDS * INDEX_RECORD_SIZE)
+                    if not data:
+                        break
+                    run = tempfile.TemporaryFile(dir=self.directory)
+                    run.writelines(sorted(data[i + 20:i + 40] + data[i:i + 20]
+                                          for i in xrange(0, len(data), INDEX_RECORD_SIZE)))
+                    run.seek(0)
+                    runs.append(run)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.writelines(heapq.merge(*[_read_records(r) for r in runs]))
+            return tmp
+        finally:
+            for run in runs:
+                run.close()
+
+    def needs_compaction(self, snapshot):
+        return len(snapshot.delta) > self.max_delta
+
+    def tee(self, project_id, lines, count, latest):
+        """Yield each of the given (sorted) lines, while writing them to a new
+        base file.  Once all lines have been consumed, the new file replaces
+        the project's snapshot, recorded as containing `count` mappings with
+        the given latest insert time.  If another rebuild is already in progress,
+        the lines are simply passed through."""
+        with open(self._path(project_id, 'rebuild'), 'a') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                for line in lines:
+                    yield line
+                return
+
+            tmps = {}
+            written = 0
+            try:
+                fd, tmps['map'] = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                ifd, tmps['hgidx'] = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                gzfd, tmps['gz'] = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                compressor = _gzip_compressor()
+                with os.fdopen(fd, 'w') as f, os.fdopen(ifd, 'wb') as idx, \
+                        os.fdopen(gzfd, 'wb') as gz:
+                    for line in lines:
+                        f.write(line)
+                        idx.write(_index_record(line[41:81], line[:40]))
+                        gz.write(compressor.compress(line))
+                        written += 1
+                        yield line
+                    gz.write(compressor.flush())
+                if written != count:
+                    logger.warning("snapshot rebuild for project {} saw {} mappings; "
+                                   "expected {}".format(project_id, written, count))
+                    return
+                tmps['gitidx'] = self._write_git_index(tmps['hgidx'])
+                with self._lock(project_id):
+                    for ext, tmp in tmps.iteritems():
+                        os.rename(tmp, self._path(project_id, ext))
+                    self._replace(project_id, 'delta', '')
+                    self._write_meta(project_id,
+                                     {'count': count, 'latest': latest, 'delta': 0,
+                                      'generation': uuid.uuid4().hex})
+                logger.info("rebuilt mapfile snapshot for project {} with {} "
+                            "mappings".format(project_id, count))
+            finally:
+                for tmp in tmps.itervalues():
+                    if os.path.exists(tmp):
+                        os.unlink(tmp)
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def init_app(app):
+    directory = app.config.get('MAPPER_SNAPSHOT_DIR')
+    if directory:
+        app.mapper_snapshots = SnapshotStore(
+            directory,
+            max_delta=app.config.get('MAPPER_SNAPSHOT_MAX_DELTA', DEFAULT_MAX_DELTA))
+    else:
+        app.mapper_snapshots = None
@@ -0,0 +1,40 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import json
+
+from nose.tools import eq_
+
+from relengapi.blueprints.mapper import DB_DECLARATIVE_BASE
+from relengapi.blueprints.mapper import Project
+from relengapi.blueprints.mapper import benchmark
+from relengapi.lib.testing.context import TestContext
+
+test_context = TestContext(databases=[DB_DECLARATIVE_BASE])
+
+
+def test_latency_summary():
+    eq_(benchmark.latency_summary([]), None)
+    summary = benchmark.latency_summary([0.003, 0.001, 0.002])
+    eq_(summary, {'count': 3, 'median_ms': 2.0, 'p95_ms': 3.0, 'max_ms': 3.0})
+
+
+@test_context
+def test_run_benchmark(app):
+    results = benchmark.run_benchmark(app, rows=10, lookups=4, repeat=2)
+    # the results can be serialized
+    json.dumps(results)
+    eq_(results['config']['dialect'], 'sqlite')
+    eq_((results['insert']['inserted'], results['insert']['skipped']), (10, 0))
+    eq_(results['insert_ignoredups']['inserted'], 10)
+    eq_(results['insert_ignoredups_existing']['skipped'], 10)
+    eq_(results['get_rev_full']['count'], 4)
+    eq_(results['get_rev_prefix']['count'], 4)
+    eq_([r['status'] for r in results['mapfile_full']], [200, 200])
+    eq_(results['mapfile_full'][0]['bytes'], 20 * 82)
+    eq_(results['mapfile_since'][0]['bytes'], 10 * 82)
+    # the synthetic project is deleted afterward
+    eq_(app.db.session(DB_DECLARATIVE_BASE).query(Project).count(), 0)
@@ -5,15 +5,25 @@
 from __future__ import absolute_import
 
 import json
+import os
+import shutil
+import StringIO
+import tempfile
+import time
+import zlib
 
 import mock
 from nose.tools import eq_
 from sqlalchemy.orm.exc import MultipleResultsFound
 from sqlalchemy.orm.exc import NoResultFound
 
+from relengapi.blueprints import mapper
 from relengapi.blueprints.mapper import DB_DECLARATIVE_BASE
 from relengapi.blueprints.mapper import Hash
+from relengapi.blueprints.mapper import HighWaterMark
+from relengapi.blueprints.mapper import ImportJob
 from relengapi.blueprints.mapper import Project
+from relengapi.blueprints.mapper import snapshot
 from relengapi.lib import auth
 from relengapi.lib.permissions import p
 from relengapi.lib.testing.context import TestContext
@@ -25,11 +35,22 @@ SHA2R = ''.join(reversed(SHA2))
 SHA3 = '333333333d7c41c8f101b5b1e3438d95d0fcfa7a'
 SHA3R = ''.join(reversed(SHA3))
 
+SHA4 = '444444444d7c41c8f101b5b1e3438d95d0fcfa7a'
+SHA4R = ''.join(reversed(SHA4))
+
 SHAFILE = "%s %s\n%s %s\n%s %s\n" % (
     SHA1, SHA1R,
     SHA2, SHA2R,
     SHA3, SHA3R)
 
+snapshot_dir = tempfile.mkdtemp()
+import_dir = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(snapshot_dir)
+    shutil.rmtree(import_dir)
+
 
 def db_setup(app):
     session = app.db.session(DB_DECLARATIVE_BASE)
@@ -41,12 +62,23 @@ def db_setup(app):
 def db_teardown(app):
     session = app.db.session(DB_DECLARATIVE_BASE)
     session.query(Hash).delete()
+    session.query(HighWaterMark).delete()
+    session.query(ImportJob).delete()
     session.query(Project).delete()
     session.commit()
 
 
+def snapshot_db_teardown(app):
+    db_teardown(app)
+    app.mapper_snapshots.project_ids.clear()
+    for filename in os.listdir(snapshot_dir):
+        os.unlink(os.path.join(snapshot_dir, filename))
+
+
 def set_projects(app, new_list=[]):
     session = app.db.session(DB_DECLARATIVE_BASE)
+    session.query(HighWaterMark).delete()
+    session.query(ImportJob).delete()
     session.query(Project).delete()
     for new_proj in new_list:
         project = Project(name=new_proj)
@@ -71,6 +103,27 @@ test_context = TestContext(databases=[DB_DECLARATIVE_BASE],
                            db_teardown=db_teardown,
                            reuse_app=True)
 
+snapshot_test_context = test_context.specialize(
+    config={'MAPPER_SNAPSHOT_DIR': snapshot_dir},
+    db_teardown=snapshot_db_teardown)
+
+
+def import_db_teardown(app):
+    db_teardown(app)
+    for filename in os.listdir(import_dir):
+        os.unlink(os.path.join(import_dir, filename))
+
+import_test_context = test_context.specialize(
+    config={
+        'MAPPER_IMPORT_DIR': import_dir,
+        'MAPPER_IMPORT_URL_HOSTS': ['example.com'],
+        'CELERY_BROKER_URL': 'memory://',
+        'CELERY_BACKEND': 'cache',
+        'CELERY_CACHE_BACKEND': 'memory',
+        'CELERY_ALWAYS_EAGER': True,
+    },
+    db_teardown=import_db_teardown)
+
 
 def insert_some_hashes(app):
     session = app.db.session(DB_DECLARATIVE_BASE)
@@ -84,6 +137,23 @@ def insert_some_hashes(app):
     session.commit()
 
 
+def add_hash_elsewhere(app, git_commit, hg_changeset, date_added=12348):
+    # insert a mapping and update the project's high water mark, without
+    # going through this host's snapshots
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    project = session.query(Project).filter(Project.name == 'proj').one()
+    session.add(Hash(git_commit=git_commit, hg_changeset=hg_changeset,
+                     project=project, date_added=date_added))
+    mapper._bump_high_water_mark(session, project.id, 1)
+    session.commit()
+
+
+def snapshot_path(app, ext):
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    project = session.query(Project).filter(Project.name == 'proj').one()
+    return os.path.join(snapshot_dir, '%d.%s' % (project.id, ext))
+
+
 def hash_pair_exists(app, git, hg):
     session = app.db.session(DB_DECLARATIVE_BASE)
     try:
@@ -118,6 +188,26 @@ def test_get_rev_abbreviated(app, client):
     eq_(rv.data, '%s %s' % (SHA1, SHA1R))
 
 
+@test_context
+def test_get_rev_abbreviated_odd_length(app, client):
+    insert_some_hashes(app)
+    rv = client.get('/mapper/proj/rev/hg/%s' % SHA3R[:35])
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s' % (SHA3, SHA3R))
+    rv = client.get('/mapper/proj/rev/git/3')
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s' % (SHA3, SHA3R))
+
+
+@test_context
+def test_shas_stored_as_binary(app, client):
+    insert_some_hashes(app)
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    rows = session.execute('select length(git_commit), length(hg_changeset) '
+                           'from releng_mapper_hashes').fetchall()
+    eq_(set(tuple(r) for r in rows), set([(20, 20)]))
+
+
 @test_context
 def test_get_rev_missing(app, client):
     insert_some_hashes(app)
@@ -142,6 +232,99 @@ def test_get_rev_weird_vcs(app, client):
     # TODO: check that return is JSON, once it is
 
 
+def post_revs(client, url, revs):
+    return client.post(url, content_type='application/json', data=json.dumps(revs))
+
+
+@test_context
+def test_get_revs_git(app, client):
+    insert_some_hashes(app)
+    rv = post_revs(client, '/mapper/proj/rev/git', [SHA1, SHA2[:8], SHA4, 'abcdef'])
+    eq_(rv.status_code, 200)
+    eq_(json.loads(rv.data), {
+        'mappings': {SHA1: '%s %s' % (SHA1, SHA1R), SHA2[:8]: '%s %s' % (SHA2, SHA2R)},
+        'not_found': [SHA4, 'abcdef'],
+        'ambiguous': [],
+    })
+
+
+@test_context
+def test_get_revs_hg(app, client):
+    insert_some_hashes(app)
+    rv = post_revs(client, '/mapper/proj/rev/hg', [SHA3R, SHA1R[:39]])
+    eq_(rv.status_code, 200)
+    eq_(json.loads(rv.data)['mappings'], {
+        SHA3R: '%s %s' % (SHA3, SHA3R), SHA1R[:39]: '%s %s' % (SHA1, SHA1R)})
+
+
+@test_context
+def test_get_revs_ambiguous(app, client):
+    insert_some_hashes(app)
+    # the reversed SHAs share a long common prefix
+    rv = post_revs(client, '/mapper/proj/rev/hg', ['a7af', SHA3R[:36]])
+    eq_(rv.status_code, 200)
+    eq_(json.loads(rv.data), {
+        'mappings': {SHA3R[:36]: '%s %s' % (SHA3, SHA3R)},
+        'not_found': [],
+        'ambiguous': ['a7af'],
+    })
+
+
+@test_context
+def test_get_revs_multiple_projects(app, client):
+    insert_some_hashes(app)
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    other = Project(name='other')
+    session.add(other)
+    # the same mapping in both projects is not ambiguous, but a different one is
+    session.add(Hash(git_commit=SHA1, hg_changeset=SHA1R, project=other, date_added=1))
+    session.add(Hash(git_commit=SHA2, hg_changeset=SHA4R, project=other, date_added=1))
+    session.commit()
+    rv = post_revs(client, '/mapper/proj,other/rev/git', [SHA1, SHA2])
+    eq_(rv.status_code, 200)
+    eq_(json.loads(rv.data), {
+        'mappings': {SHA1: '%s %s' % (SHA1, SHA1R)},
+        'not_found': [],
+        'ambiguous': [SHA2],
+    })
+
+
+@test_context
+def test_get_revs_chunks(app, client):
+    insert_some_hashes(app)
+    with mock.patch('relengapi.blueprints.mapper.LOOKUP_CHUNK_SIZE', 2):
+        with mock.patch('relengapi.blueprints.mapper.PREFIX_LOOKUP_CHUNK_SIZE', 2):
+            rv = post_revs(client, '/mapper/proj/rev/git',
+                           [SHA1, SHA2, SHA3, SHA1[:6], SHA2[:6], SHA3[:6]])
+    eq_(rv.status_code, 200)
+    eq_(len(json.loads(rv.data)['mappings']), 6)
+
+
+@test_context
+def test_get_revs_empty(app, client):
+    rv = post_revs(client, '/mapper/proj/rev/git', [])
+    eq_(rv.status_code, 200)
+    eq_(json.loads(rv.data), {'mappings': {}, 'not_found': [], 'ambiguous': []})
+
+
+@test_context
+def test_get_revs_malformed(app, client):
+    rv = post_revs(client, '/mapper/proj/rev/git', [SHA1, 'xyz'])
+    eq_(rv.status_code, 400)
+
+
+@test_context
+def test_get_revs_weird_vcs(app, client):
+    rv = post_revs(client, '/mapper/proj/rev/darcs', [SHA1])
+    eq_(rv.status_code, 400)
+
+
+@test_context
+def test_get_revs_not_a_list(app, client):
+    rv = post_revs(client, '/mapper/proj/rev/git', {'revs': [SHA1]})
+    eq_(rv.status_code, 400)
+
+
 @test_context
 def test_get_mapfile(app, client):
     insert_some_hashes(app)
@@ -153,6 +336,45 @@ def test_get_mapfile(app, client):
     ))
 
 
+@test_context
+def test_get_mapfile_small_batches(app, client):
+    insert_some_hashes(app)
+    with mock.patch('relengapi.blueprints.mapper.STREAM_BATCH_SIZE', 1):
+        rv = client.get('/mapper/proj/mapfile/full')
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s\n%s %s\n%s %s\n' % (
+        SHA3, SHA3R, SHA1, SHA1R, SHA2, SHA2R,
+    ))
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def get_gzipped(client, url):
+    rv = client.get(url, headers=[('Accept-Encoding', 'gzip, deflate')])
+    eq_(rv.status_code, 200)
+    eq_(rv.headers['Content-Encoding'], 'gzip')
+    eq_(rv.headers['Vary'], 'Accept-Encoding')
+    return gunzip(rv.data)
+
+
+@test_context
+def test_get_mapfile_gzip(app, client):
+    insert_some_hashes(app)
+    eq_(get_gzipped(client, '/mapper/proj/mapfile/full'),
+        '%s %s\n%s %s\n%s %s\n' % (SHA3, SHA3R, SHA1, SHA1R, SHA2, SHA2R))
+
+
+@test_context
+def test_get_mapfile_not_gzipped(app, client):
+    insert_some_hashes(app)
+    rv = client.get('/mapper/proj/mapfile/full', headers=[('Accept-Encoding', 'identity')])
+    eq_(rv.status_code, 200)
+    assert 'Content-Encoding' not in rv.headers
+    eq_(rv.headers['Vary'], 'Accept-Encoding')
+
+
 @test_context
 def test_get_mapfile_no_rows(client):
     rv = client.get('/mapper/proj/mapfile/full')
@@ -166,6 +388,311 @@ def test_get_mapfile_no_project(app, client):
     eq_(rv.status_code, 404)
 
 
+@snapshot_test_context
+def test_get_mapfile_snapshot_built(app, client):
+    insert_some_hashes(app)
+    expected = '%s %s\n%s %s\n%s %s\n' % (
+        SHA3, SHA3R, SHA1, SHA1R, SHA2, SHA2R,
+    )
+    rv = client.get('/mapper/proj/mapfile/full')
+    eq_(rv.status_code, 200)
+    eq_(rv.data, expected)
+    eq_(open(snapshot_path(app, 'map')).read(), expected)
+
+
+@snapshot_test_context
+def test_get_mapfile_snapshot_served(app, client):
+    insert_some_hashes(app)
+    client.get('/mapper/proj/mapfile/full')
+    # alter the snapshot behind the server's back to show that it is used
+    open(snapshot_path(app, 'map'), 'w').write('from the snapshot\n')
+    rv = client.get('/mapper/proj/mapfile/full')
+    eq_(rv.status_code, 200)
+    eq_(rv.data, 'from the snapshot\n')
+
+
+@snapshot_test_context
+def test_get_mapfile_snapshot_appended(app, client):
+    insert_some_hashes(app)
+    client.get('/mapper/proj/mapfile/full')
+    rv = client.post('/mapper/proj/insert/%s/%s' % (SHA4, SHA4R))
+    eq_(rv.status_code, 200)
+    eq_(open(snapshot_path(app, 'delta')).read(), '%s %s\n' % (SHA4, SHA4R))
+    rv = client.get('/mapper/proj/mapfile/full')
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s\n%s %s\n%s %s\n%s %s\n' % (
+        SHA3, SHA3R, SHA4, SHA4R, SHA1, SHA1R, SHA2, SHA2R,
+    ))
+
+
+@snapshot_test_context
+def test_get_mapfile_snapshot_compacted(app, client):
+    insert_some_hashes(app)
+    client.get('/mapper/proj/mapfile/full')
+    client.post('/mapper/proj/insert/%s/%s' % (SHA4, SHA4R))
+    expected = '%s %s\n%s %s\n%s %s\n%s %s\n' % (
+        SHA3, SHA3R, SHA4, SHA4R, SHA1, SHA1R, SHA2, SHA2R,
+    )
+    with mock.patch.object(app.mapper_snapshots, 'max_delta', 0):
+        rv = client.get('/mapper/proj/mapfile/full')
+    eq_(rv.data, expected)
+    eq_(open(snapshot_path(app, 'map')).read(), expected)
+    eq_(open(snapshot_path(app, 'delta')).read(), '')
+
+
+@snapshot_test_context
+def test_get_mapfile_snapshot_gzip(app, client):
+    insert_some_hashes(app)
+    expected = '%s %s\n%s %s\n%s %s\n' % (SHA3, SHA3R, SHA1, SHA1R, SHA2, SHA2R)
+    eq_(get_gzipped(client, '/mapper/proj/mapfile/full'), expected)
+    eq_(gunzip(open(snapshot_path(app, 'gz')).read()), expected)
+    # alter the compressed snapshot behind the server's back to show that it
+    # is used
+    open(snapshot_path(app, 'gz'), 'w').write(''.join(snapshot.gzipped(['cached'])))
+    eq_(get_gzipped(client, '/mapper/proj/mapfile/full'), 'cached')
+
+
+@snapshot_test_context
+def test_get_mapfile_snapshot_gzip_delta(app, client):
+    insert_some_hashes(app)
+    client.get('/mapper/proj/mapfile/full')
+    client.post('/mapper/proj/insert/%s/%s' % (SHA4, SHA4R))
+    expected = '%s %s\n%s %s\n%s %s\n%s %s\n' % (
+        SHA3, SHA3R, SHA4, SHA4R, SHA1, SHA1R, SHA2, SHA2R,
+    )
+    # the delta is merged into the snapshot, and the gzipped copy updated
+    eq_(get_gzipped(client, '/mapper/proj/mapfile/full'), expected)
+    eq_(open(snapshot_path(app, 'delta')).read(), '')
+    eq_(gunzip(open(snapshot_path(app, 'gz')).read()), expected)
+
+
+@snapshot_test_context
+def test_get_mapfile_snapshot_stale(app, client):
+    insert_some_hashes(app)
+    client.get('/mapper/proj/mapfile/full')
+    # add a mapping without updating the snapshot, as another host would
+    add_hash_elsewhere(app, SHA4, SHA4R)
+    expected = '%s %s\n%s %s\n%s %s\n%s %s\n' % (
+        SHA3, SHA3R, SHA4, SHA4R, SHA1, SHA1R, SHA2, SHA2R,
+    )
+    rv = client.get('/mapper/proj/mapfile/full')
+    eq_(rv.data, expected)
+    eq_(open(snapshot_path(app, 'map')).read(), expected)
+
+
+@snapshot_test_context
+def test_get_mapfile_snapshot_high_water_mark(app, client):
+    insert_some_hashes(app)
+    expected = client.get('/mapper/proj/mapfile/full').data
+    # freshness is judged by the high water mark alone, so the snapshot is
+    # still served when the mappings disappear behind the server's back
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    session.query(Hash).delete()
+    session.commit()
+    eq_(client.get('/mapper/proj/mapfile/full').data, expected)
+
+
+def add_other_project(app):
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    other = Project(name='other')
+    session.add(other)
+    session.add(Hash(git_commit=SHA4, hg_changeset=SHA4R, project=other, date_added=1))
+    session.add(Hash(git_commit=SHA1, hg_changeset=SHA1R, project=other, date_added=1))
+    session.commit()
+
+MERGED_MAPFILE = '%s %s\n%s %s\n%s %s\n%s %s\n%s %s\n' % (
+    SHA3, SHA3R, SHA4, SHA4R, SHA1, SHA1R, SHA1, SHA1R, SHA2, SHA2R,
+)
+
+
+@test_context
+def test_get_mapfile_multiple_projects(app, client):
+    insert_some_hashes(app)
+    add_other_project(app)
+    rv = client.get('/mapper/proj,other,notaproj/mapfile/full')
+    eq_(rv.status_code, 200)
+    eq_(rv.data, MERGED_MAPFILE)
+
+
+@test_context
+def test_get_mapfile_multiple_projects_pages(app, client):
+    insert_some_hashes(app)
+    add_other_project(app)
+    with mock.patch('relengapi.blueprints.mapper.STREAM_BATCH_SIZE', 1):
+        rv = client.get('/mapper/proj,other/mapfile/full')
+    eq_(rv.data, MERGED_MAPFILE)
+
+
+@test_context
+def test_get_mapfile_multiple_projects_gzip(app, client):
+    insert_some_hashes(app)
+    add_other_project(app)
+    eq_(get_gzipped(client, '/mapper/proj,other/mapfile/full'), MERGED_MAPFILE)
+
+
+@test_context
+def test_get_mapfile_multiple_projects_no_rows(app, client):
+    rv = client.get('/mapper/proj,other/mapfile/full')
+    eq_(rv.status_code, 404)
+
+
+@snapshot_test_context
+def test_get_mapfile_multiple_projects_snapshots(app, client):
+    insert_some_hashes(app)
+    add_other_project(app)
+    # the first request builds the snapshots
+    eq_(client.get('/mapper/proj,other/mapfile/full').data, MERGED_MAPFILE)
+    eq_(open(snapshot_path(app, 'map')).read(), '%s %s\n%s %s\n%s %s\n' % (
+        SHA3, SHA3R, SHA1, SHA1R, SHA2, SHA2R,
+    ))
+    # alter a snapshot behind the server's back to show that it is used
+    open(snapshot_path(app, 'map'), 'w').write('%s %s\n' % (SHA2, SHA2R))
+    eq_(client.get('/mapper/proj,other/mapfile/full').data, '%s %s\n%s %s\n%s %s\n' % (
+        SHA4, SHA4R, SHA1, SHA1R, SHA2, SHA2R,
+    ))
+
+
+@snapshot_test_context
+def test_get_mapfile_snapshot_no_rows(client):
+    rv = client.get('/mapper/proj/mapfile/full')
+    eq_(rv.status_code, 404)
+
+
+@snapshot_test_context
+def test_get_mapfile_snapshot_no_project(client):
+    rv = client.get('/mapper/notaproj/mapfile/full')
+    eq_(rv.status_code, 404)
+
+
+@snapshot_test_context
+def test_insert_multi_snapshot(app, client):
+    insert_some_hashes(app)
+    client.get('/mapper/proj/mapfile/full')
+    rv = client.post('/mapper/proj/insert/ignoredups', content_type='text/plain',
+                     data='%s %s\n' % (SHA4, SHA4R))
+    eq_(rv.status_code, 200)
+    eq_(open(snapshot_path(app, 'delta')).read(), '%s %s\n' % (SHA4, SHA4R))
+
+
+@snapshot_test_context
+def test_insert_multi_ignoredups_snapshot(app, client):
+    insert_some_hashes(app)
+    client.get('/mapper/proj/mapfile/full')
+    rv = client.post('/mapper/proj/insert/ignoredups', content_type='text/plain',
+                     data='%s %s\n%s %s\n' % (SHA1, SHA1R, SHA4, SHA4R))
+    eq_(rv.status_code, 200)
+    eq_(json.loads(rv.data), {'inserted': 1, 'skipped': 1})
+    eq_(open(snapshot_path(app, 'delta')).read(), '%s %s\n' % (SHA4, SHA4R))
+    rv = client.get('/mapper/proj/mapfile/full')
+    eq_(rv.data, '%s %s\n%s %s\n%s %s\n%s %s\n' % (
+        SHA3, SHA3R, SHA4, SHA4R, SHA1, SHA1R, SHA2, SHA2R,
+    ))
+
+
+@snapshot_test_context
+def test_insert_multi_ignoredups_snapshot_race(app, client):
+    insert_some_hashes(app)
+    client.get('/mapper/proj/mapfile/full')
+    # simulate another insert of SHA1 between the check for duplicates and
+    # the insert
+    with mock.patch('relengapi.blueprints.mapper._new_pairs', lambda s, i, pairs: pairs):
+        rv = client.post('/mapper/proj/insert/ignoredups', content_type='text/plain',
+                         data='%s %s\n%s %s\n' % (SHA1, SHA1R, SHA4, SHA4R))
+    eq_(rv.status_code, 200)
+    # it's not clear which mappings were inserted, so the snapshot is left
+    # alone and rebuilt on the next request
+    eq_(open(snapshot_path(app, 'delta')).read(), '')
+    rv = client.get('/mapper/proj/mapfile/full')
+    eq_(rv.data, '%s %s\n%s %s\n%s %s\n%s %s\n' % (
+        SHA3, SHA3R, SHA4, SHA4R, SHA1, SHA1R, SHA2, SHA2R,
+    ))
+
+
+def delete_hashes(app):
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    session.query(Hash).delete()
+    session.commit()
+
+
+@snapshot_test_context
+def test_get_rev_from_index(app, client):
+    insert_some_hashes(app)
+    client.get('/mapper/proj/mapfile/full')
+    client.post('/mapper/proj/insert/%s/%s' % (SHA4, SHA4R))
+    # remove the mappings from the database to show that the index is used
+    delete_hashes(app)
+    rv = client.get('/mapper/proj/rev/git/%s' % SHA1[:8])
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s' % (SHA1, SHA1R))
+    rv = client.get('/mapper/proj/rev/hg/%s' % SHA4R)
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s' % (SHA4, SHA4R))
+    rv = post_revs(client, '/mapper/proj/rev/hg', [SHA2R, 'a7af'])
+    eq_(json.loads(rv.data), {
+        'mappings': {SHA2R: '%s %s' % (SHA2, SHA2R)},
+        'not_found': [],
+        'ambiguous': ['a7af'],
+    })
+
+
+@snapshot_test_context
+def test_get_rev_index_fresh_misses(app, client):
+    """With an up-to-date index, missing and ambiguous SHAs are reported
+    without consulting the database"""
+    insert_some_hashes(app)
+    client.get('/mapper/proj/mapfile/full')
+    with mock.patch.object(mapper, '_hash_filter', side_effect=AssertionError):
+        rv = client.get('/mapper/proj/rev/git/abcdef')
+        eq_(rv.status_code, 404)
+        rv = client.get('/mapper/proj/rev/hg/a7af')
+        eq_(rv.status_code, 500)
+        rv = post_revs(client, '/mapper/proj/rev/git', ['abcdef', SHA1])
+        eq_(json.loads(rv.data), {
+            'mappings': {SHA1: '%s %s' % (SHA1, SHA1R)},
+            'not_found': ['abcdef'],
+            'ambiguous': [],
+        })
+
+
+@snapshot_test_context
+def test_get_rev_index_miss(app, client):
+    insert_some_hashes(app)
+    client.get('/mapper/proj/mapfile/full')
+    # mappings inserted elsewhere are not in the index, so are found in the db
+    add_hash_elsewhere(app, SHA4, SHA4R)
+    rv = client.get('/mapper/proj/rev/git/%s' % SHA4)
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s' % (SHA4, SHA4R))
+    rv = post_revs(client, '/mapper/proj/rev/git', [SHA4[:10], SHA1])
+    eq_(json.loads(rv.data)['mappings'], {
+        SHA4[:10]: '%s %s' % (SHA4, SHA4R), SHA1: '%s %s' % (SHA1, SHA1R)})
+    rv = client.get('/mapper/proj/rev/git/abcdef')
+    eq_(rv.status_code, 404)
+
+
+@snapshot_test_context
+def test_get_rev_index_stale(app, client):
+    insert_some_hashes(app)
+    client.get('/mapper/proj/mapfile/full')
+    # a mapping inserted elsewhere makes an abbreviated SHA that is unique in
+    # the index ambiguous in the database, which is consulted instead
+    add_hash_elsewhere(app, SHA1[:6] + SHA4[6:], SHA4R)
+    rv = post_revs(client, '/mapper/proj/rev/git', [SHA1[:6], SHA2[:6]])
+    eq_(json.loads(rv.data), {
+        'mappings': {SHA2[:6]: '%s %s' % (SHA2, SHA2R)},
+        'not_found': [],
+        'ambiguous': [SHA1[:6]],
+    })
+
+
+@snapshot_test_context
+def test_get_rev_no_index(app, client):
+    insert_some_hashes(app)
+    rv = client.get('/mapper/proj/rev/git/%s' % SHA1)
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s' % (SHA1, SHA1R))
+
+
 @test_context
 def test_get_mapfile_since(app, client):
     insert_some_hashes(app)
@@ -174,6 +701,127 @@ def test_get_mapfile_since(app, client):
     eq_(rv.data, '%s %s\n' % (SHA3, SHA3R))
 
 
+def sync(client, url):
+    rv = client.get(url)
+    eq_(rv.status_code, 200)
+    return json.loads(rv.data)
+
+
+@test_context
+def test_get_mapfile_sync(app, client):
+    insert_some_hashes(app)
+    eq_(sync(client, '/mapper/proj/mapfile/sync')['mappings'], [
+        '%s %s' % (SHA1, SHA1R), '%s %s' % (SHA2, SHA2R), '%s %s' % (SHA3, SHA3R)])
+
+
+@test_context
+def test_get_mapfile_sync_pages(app, client):
+    insert_some_hashes(app)
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    project = session.query(Project).filter(Project.name == 'proj').one()
+    # same date_added as SHA3, but a lower hg changeset
+    session.add(Hash(git_commit='0' * 40, hg_changeset='0' * 40, project=project,
+                     date_added=12347))
+    session.commit()
+    first = sync(client, '/mapper/proj/mapfile/sync?limit=3')
+    eq_(first['mappings'], [
+        '%s %s' % (SHA1, SHA1R), '%s %s' % (SHA2, SHA2R), '%s %s' % ('0' * 40, '0' * 40)])
+    eq_(first['complete'], False)
+    second = sync(client, '/mapper/proj/mapfile/sync?limit=3&cursor=' + first['cursor'])
+    eq_(second['mappings'], ['%s %s' % (SHA3, SHA3R)])
+    eq_(second['complete'], True)
+
+    # nothing new yet
+    third = sync(client, '/mapper/proj/mapfile/sync?cursor=' + second['cursor'])
+    eq_(third['mappings'], [])
+    eq_(third['complete'], True)
+
+    # a new mapping is picked up from the cursor, even if it was stamped
+    # before the previous call (but committed after it)
+    session.add(Hash(git_commit=SHA4, hg_changeset=SHA4R, project=project,
+                     date_added=int(time.time()) - 60))
+    session.commit()
+    fourth = sync(client, '/mapper/proj/mapfile/sync?cursor=' + third['cursor'])
+    eq_(fourth['mappings'], ['%s %s' % (SHA4, SHA4R)])
+
+    # with nothing committed behind the cursor, nothing is returned again
+    fifth = sync(client, '/mapper/proj/mapfile/sync?cursor=' + fourth['cursor'])
+    eq_(fifth['mappings'], [])
+
+
+@test_context
+def test_get_mapfile_sync_rescan(app, client):
+    insert_some_hashes(app)
+    first = sync(client, '/mapper/proj/mapfile/sync')
+    eq_(first['complete'], True)
+    # a mapping committed behind the cursor is noticed from the high water
+    # mark, and the next call re-scans a window before the cursor
+    add_hash_elsewhere(app, SHA4, SHA4R, date_added=12346)
+    second = sync(client, '/mapper/proj/mapfile/sync?cursor=' + first['cursor'])
+    eq_(second['mappings'], [])
+    third = sync(client, '/mapper/proj/mapfile/sync?cursor=' + second['cursor'])
+    eq_(sorted(third['mappings']), sorted([
+        '%s %s' % (SHA1, SHA1R), '%s %s' % (SHA2, SHA2R), '%s %s' % (SHA3, SHA3R),
+        '%s %s' % (SHA4, SHA4R)]))
+    # after which there is nothing more to re-scan
+    fourth = sync(client, '/mapper/proj/mapfile/sync?cursor=' + third['cursor'])
+    eq_(fourth['mappings'], [])
+
+
+@test_context
+def test_get_mapfile_sync_rescan_window(app, client):
+    insert_some_hashes(app)
+    first = sync(client, '/mapper/proj/mapfile/sync')
+    # a mapping stamped further behind the cursor than the window is not
+    # re-scanned
+    add_hash_elsewhere(app, SHA4, SHA4R, date_added=12347 - 7200)
+    second = sync(client, '/mapper/proj/mapfile/sync?cursor=' + first['cursor'])
+    third = sync(client, '/mapper/proj/mapfile/sync?cursor=' + second['cursor'])
+    assert '%s %s' % (SHA4, SHA4R) not in third['mappings']
+    with mock.patch.dict(app.config, {'MAPPER_SYNC_RESCAN_WINDOW': 10000}):
+        second = sync(client, '/mapper/proj/mapfile/sync?cursor=' + first['cursor'])
+        third = sync(client, '/mapper/proj/mapfile/sync?cursor=' + second['cursor'])
+        assert '%s %s' % (SHA4, SHA4R) in third['mappings']
+
+
+@test_context
+def test_get_mapfile_sync_multiple_projects(app, client):
+    insert_some_hashes(app)
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    other = Project(name='other')
+    session.add(other)
+    session.add(Hash(git_commit=SHA1, hg_changeset=SHA1R, project=other, date_added=12345))
+    session.commit()
+    first = sync(client, '/mapper/proj,other/mapfile/sync?limit=1')
+    eq_(first['mappings'], ['%s %s' % (SHA1, SHA1R)])
+    second = sync(client, '/mapper/proj,other/mapfile/sync?limit=1&cursor=' + first['cursor'])
+    eq_(second['mappings'], ['%s %s' % (SHA1, SHA1R)])
+    third = sync(client, '/mapper/proj,other/mapfile/sync?limit=1&cursor=' + second['cursor'])
+    eq_(third['mappings'], ['%s %s' % (SHA2, SHA2R)])
+
+
+@test_context
+def test_get_mapfile_sync_empty(app, client):
+    rv = sync(client, '/mapper/proj/mapfile/sync')
+    eq_((rv['mappings'], rv['complete']), ([], True))
+    # the cursor starts the next pass
+    eq_(sync(client, '/mapper/proj/mapfile/sync?cursor=' + rv['cursor'])['mappings'], [])
+
+
+@test_context
+def test_get_mapfile_sync_bad_cursor(app, client):
+    for cursor in ['xyz', 'WzEsIDJd', 'WzEsICJ4IiwgMSwgMl0=', 'WzEsIG51bGwsIDEsIDJd']:
+        rv = client.get('/mapper/proj/mapfile/sync?cursor=' + cursor)
+        eq_(rv.status_code, 400)
+
+
+@test_context
+def test_get_mapfile_sync_bad_limit(app, client):
+    for limit in ['0', '1000000', 'x']:
+        rv = client.get('/mapper/proj/mapfile/sync?limit=' + limit)
+        eq_(rv.status_code, 400)
+
+
 @test_context
 def test_insert_one(client):
     # TODO: this should really be POST
@@ -222,6 +870,7 @@ def test_insert_multi_no_dups(app, client):
     rv = client.post('/mapper/proj/insert',
                      content_type='text/plain', data=SHAFILE)
     eq_(rv.status_code, 200)
+    eq_(json.loads(rv.data), {'inserted': 3, 'skipped': 0})
     # TODO: check response when it's JSON
     assert hash_pair_exists(app, SHA1, SHA1R)
     assert hash_pair_exists(app, SHA2, SHA2R)
@@ -246,7 +895,7 @@ def test_insert_multi_ignoredups(app, client):
     rv = client.post('/mapper/proj/insert/ignoredups',
                      content_type='text/plain', data=SHAFILE)
     eq_(rv.status_code, 200)
-    # TODO: check response when it's JSON
+    eq_(json.loads(rv.data), {'inserted': 3, 'skipped': 0})
     assert hash_pair_exists(app, SHA1, SHA1R)
     assert hash_pair_exists(app, SHA2, SHA2R)
     assert hash_pair_exists(app, SHA3, SHA3R)
@@ -259,12 +908,76 @@ def test_insert_multi_ignoredups_with_dups(app, client):
     rv = client.post('/mapper/proj/insert/ignoredups',
                      content_type='text/plain', data=SHAFILE)
     eq_(rv.status_code, 200)
-    # TODO: check response when it's JSON
+    eq_(json.loads(rv.data), {'inserted': 2, 'skipped': 1})
     assert hash_pair_exists(app, SHA1, SHA1R)
     assert hash_pair_exists(app, SHA2, SHA2R)
     assert hash_pair_exists(app, SHA3, SHA3R)
 
 
+@test_context
+def test_insert_multi_ignoredups_dups_in_body(app, client):
+    rv = client.post('/mapper/proj/insert/ignoredups',
+                     content_type='text/plain', data=SHAFILE + SHAFILE)
+    eq_(rv.status_code, 200)
+    eq_(json.loads(rv.data), {'inserted': 3, 'skipped': 3})
+    assert hash_pair_exists(app, SHA1, SHA1R)
+
+
+@test_context
+def test_insert_multi_chunks(app, client):
+    with mock.patch('relengapi.blueprints.mapper.SQLITE_INSERT_CHUNK_SIZE', 2):
+        rv = client.post('/mapper/proj/insert',
+                         content_type='text/plain', data=SHAFILE)
+    eq_(rv.status_code, 200)
+    eq_(json.loads(rv.data), {'inserted': 3, 'skipped': 0})
+    assert hash_pair_exists(app, SHA3, SHA3R)
+
+
+@test_context
+def test_insert_multi_small_blocks(app, client):
+    with mock.patch('relengapi.blueprints.mapper.READ_BLOCK_SIZE', 7):
+        rv = client.post('/mapper/proj/insert',
+                         content_type='text/plain', data=SHAFILE)
+    eq_(rv.status_code, 200)
+    eq_(json.loads(rv.data), {'inserted': 3, 'skipped': 0})
+    assert hash_pair_exists(app, SHA1, SHA1R)
+    assert hash_pair_exists(app, SHA3, SHA3R)
+
+
+@test_context
+def test_insert_multi_no_final_newline(app, client):
+    rv = client.post('/mapper/proj/insert', content_type='text/plain',
+                     data='%s %s\n%s %s' % (SHA1, SHA1R, SHA2, SHA2R))
+    eq_(rv.status_code, 200)
+    eq_(json.loads(rv.data), {'inserted': 2, 'skipped': 0})
+    assert hash_pair_exists(app, SHA2, SHA2R)
+
+
+@test_context
+def test_insert_multi_line_too_long(app, client):
+    with mock.patch('relengapi.blueprints.mapper.READ_BLOCK_SIZE', 16):
+        rv = client.post('/mapper/proj/insert', content_type='text/plain',
+                         data='%s %s\n%s' % (SHA1, SHA1R, 'a' * 2000))
+    eq_(rv.status_code, 400)
+    assert not hash_pair_exists(app, SHA1, SHA1R)
+
+
+@test_context
+def test_insert_multi_no_space(app, client):
+    rv = client.post('/mapper/proj/insert', content_type='text/plain',
+                     data='%s %s\n%s%s\n' % (SHA1, SHA1R, SHA2, SHA2R))
+    eq_(rv.status_code, 400)
+    assert not hash_pair_exists(app, SHA1, SHA1R)
+
+
+@test_context
+def test_insert_multi_malformed_sha(app, client):
+    rv = client.post('/mapper/proj/insert/ignoredups', content_type='text/plain',
+                     data='%s %s\n' % (SHA1, 'x' * 40))
+    eq_(rv.status_code, 400)
+    eq_(app.db.session(DB_DECLARATIVE_BASE).query(Hash).count(), 0)
+
+
 @test_context
 def test_add_project(client):
     rv = client.post('/mapper/proj2')
@@ -310,3 +1023,336 @@ def test_query_all_projects_0_results(app, client):
         "projects": []
         })
 # TODO: also assert content types
+
+
+def get_high_water_mark(app, name):
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    project = session.query(Project).filter(Project.name == name).one()
+    mark = session.query(HighWaterMark).filter(
+        HighWaterMark.project_id == project.id).one()
+    return mark.count, mark.last_insert
+
+
+@test_context
+def test_high_water_mark_inserts(app, client):
+    client.post('/mapper/proj2')
+    eq_(get_high_water_mark(app, 'proj2'), (0, None))
+    client.post('/mapper/proj2/insert/%s/%s' % (SHA1, SHA1R))
+    eq_(get_high_water_mark(app, 'proj2')[0], 1)
+    client.post('/mapper/proj2/insert/ignoredups', content_type='text/plain',
+                data=SHAFILE)
+    eq_(get_high_water_mark(app, 'proj2')[0], 3)
+    # a failed insert doesn't count
+    client.post('/mapper/proj2/insert', content_type='text/plain', data=SHAFILE)
+    count, last_insert = get_high_water_mark(app, 'proj2')
+    eq_(count, 3)
+    assert last_insert > 12347
+
+
+@test_context
+def test_high_water_mark_created(app, client):
+    insert_some_hashes(app)
+    rv = client.get('/mapper/proj/mapfile/full')
+    eq_(rv.status_code, 200)
+    eq_(get_high_water_mark(app, 'proj'), (3, 12347))
+    eq_(rv.headers['Last-Modified'], 'Thu, 01 Jan 1970 03:25:47 GMT')
+    assert rv.headers['ETag']
+
+
+@test_context
+def test_get_mapfile_not_modified(app, client):
+    insert_some_hashes(app)
+    rv = client.get('/mapper/proj/mapfile/full')
+    etag = rv.headers['ETag']
+    # remove the mappings behind the server's back, to show that the hashes
+    # table is not consulted
+    delete_hashes(app)
+    rv = client.get('/mapper/proj/mapfile/full', headers=[('If-None-Match', etag)])
+    eq_(rv.status_code, 304)
+    eq_(rv.headers['ETag'], etag)
+    rv = client.get('/mapper/proj/mapfile/full',
+                    headers=[('If-Modified-Since', 'Thu, 01 Jan 1970 03:25:47 GMT')])
+    eq_(rv.status_code, 304)
+
+
+@test_context
+def test_get_mapfile_modified(app, client):
+    insert_some_hashes(app)
+    rv = client.get('/mapper/proj/mapfile/full')
+    etag = rv.headers['ETag']
+    client.post('/mapper/proj/insert/%s/%s' % (SHA4, SHA4R))
+    rv = client.get('/mapper/proj/mapfile/full', headers=[('If-None-Match', etag)])
+    eq_(rv.status_code, 200)
+    assert rv.headers['ETag'] != etag
+    rv = client.get('/mapper/proj/mapfile/full',
+                    headers=[('If-Modified-Since', 'Thu, 01 Jan 1970 03:25:47 GMT')])
+    eq_(rv.status_code, 200)
+
+
+@test_context
+def test_get_mapfile_etag_gzip(app, client):
+    insert_some_hashes(app)
+    etag = client.get('/mapper/proj/mapfile/full').headers['ETag']
+    rv = client.get('/mapper/proj/mapfile/full',
+                    headers=[('If-None-Match', etag), ('Accept-Encoding', 'gzip')])
+    eq_(rv.status_code, 200)
+    assert rv.headers['ETag'] != etag
+
+
+@snapshot_test_context
+def test_get_mapfile_snapshot_not_modified(app, client):
+    insert_some_hashes(app)
+    etag = client.get('/mapper/proj/mapfile/full').headers['ETag']
+    rv = client.get('/mapper/proj/mapfile/full', headers=[('If-None-Match', etag)])
+    eq_(rv.status_code, 304)
+
+
+@test_context
+def test_get_mapfile_since_not_modified(app, client):
+    insert_some_hashes(app)
+    url = '/mapper/proj,other/mapfile/since/1970-01-01T03:25:46+00:00'
+    rv = client.get(url)
+    eq_(rv.status_code, 200)
+    rv = client.get(url, headers=[('If-None-Match', rv.headers['ETag'])])
+    eq_(rv.status_code, 304)
+
+
+@test_context
+def test_query_all_projects_not_modified(app, client):
+    rv = client.get('/mapper/projects')
+    etag = rv.headers['ETag']
+    rv = client.get('/mapper/projects', headers=[('If-None-Match', etag)])
+    eq_(rv.status_code, 304)
+    client.post('/mapper/proj2')
+    rv = client.get('/mapper/projects', headers=[('If-None-Match', etag)])
+    eq_(rv.status_code, 200)
+
+
+def get_import_job(client, job_id):
+    rv = client.get('/mapper/import/%d' % job_id)
+    eq_(rv.status_code, 200)
+    return json.loads(rv.data)
+
+
+@import_test_context
+def test_import_upload(app, client):
+    rv = client.post('/mapper/proj/import', content_type='text/plain', data=SHAFILE)
+    eq_(rv.status_code, 202)
+    job = json.loads(rv.data)
+    eq_(job['state'], 'PENDING')
+    eq_(job['size'], len(SHAFILE))
+    assert rv.headers['Location'].endswith('/mapper/import/%d' % job['id'])
+    # the task has already run, eagerly
+    job = get_import_job(client, job['id'])
+    eq_(job['state'], 'SUCCESS')
+    eq_((job['offset'], job['processed'], job['inserted'], job['skipped']),
+        (len(SHAFILE), 3, 3, 0))
+    assert job['rows_per_second'] > 0
+    assert hash_pair_exists(app, SHA3, SHA3R)
+    # the uploaded map file is removed once it is imported
+    eq_(os.listdir(import_dir), [])
+
+
+@import_test_context
+def test_import_chunks(app, client):
+    with mock.patch('relengapi.blueprints.mapper.SQLITE_INSERT_CHUNK_SIZE', 2):
+        rv = client.post('/mapper/proj/import/ignoredups', content_type='text/plain',
+                         data=SHAFILE + '%s %s' % (SHA4, SHA4R))
+    job = get_import_job(client, json.loads(rv.data)['id'])
+    eq_(job['state'], 'SUCCESS')
+    eq_((job['processed'], job['inserted'], job['skipped']), (4, 4, 0))
+    assert hash_pair_exists(app, SHA4, SHA4R)
+
+
+@import_test_context
+def test_import_ignore_dups(app, client):
+    insert_some_hashes(app)
+    rv = client.post('/mapper/proj/import/ignoredups', content_type='text/plain',
+                     data=SHAFILE + '%s %s\n' % (SHA4, SHA4R))
+    job = get_import_job(client, json.loads(rv.data)['id'])
+    eq_(job['state'], 'SUCCESS')
+    eq_((job['processed'], job['inserted'], job['skipped']), (4, 1, 3))
+    assert hash_pair_exists(app, SHA4, SHA4R)
+
+
+@import_test_context
+def test_import_dups(app, client):
+    insert_some_hashes(app)
+    rv = client.post('/mapper/proj/import', content_type='text/plain', data=SHAFILE)
+    job = get_import_job(client, json.loads(rv.data)['id'])
+    eq_(job['state'], 'FAILURE')
+    assert 'already exist' in job['error']
+    eq_(job['processed'], 0)
+
+
+@import_test_context
+def test_import_malformed(app, client):
+    with mock.patch('relengapi.blueprints.mapper.SQLITE_INSERT_CHUNK_SIZE', 2):
+        rv = client.post('/mapper/proj/import', content_type='text/plain',
+                         data=SHAFILE + '%s%s\n' % (SHA4, SHA4R))
+    job = get_import_job(client, json.loads(rv.data)['id'])
+    eq_(job['state'], 'FAILURE')
+    assert 'did not contain a space' in job['error']
+    # earlier chunks remain inserted, and the job can be resumed from the bad one
+    eq_((job['offset'], job['processed']), (len(SHAFILE) * 2 // 3, 2))
+    assert hash_pair_exists(app, SHA2, SHA2R)
+    assert not hash_pair_exists(app, SHA3, SHA3R)
+
+
+@import_test_context
+def test_import_resume(app, client):
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    with mock.patch('relengapi.blueprints.mapper._run_import', side_effect=RuntimeError('boom')):
+        rv = client.post('/mapper/proj/import', content_type='text/plain', data=SHAFILE)
+    job_id = json.loads(rv.data)['id']
+    eq_(get_import_job(client, job_id)['state'], 'FAILURE')
+    # pretend that the first line was imported before the failure
+    session.execute(Hash.__table__.insert(), {
+        'git_commit': SHA1, 'hg_changeset': SHA1R,
+        'project_id': session.query(Project).one().id, 'date_added': 12345})
+    job = session.query(ImportJob).get(job_id)
+    job.offset = len(SHAFILE.split('\n')[0]) + 1
+    job.processed = job.inserted = 1
+    session.commit()
+    rv = client.post('/mapper/import/%d/resume' % job_id)
+    eq_(rv.status_code, 202)
+    job = get_import_job(client, job_id)
+    eq_(job['state'], 'SUCCESS')
+    eq_((job['processed'], job['inserted'], job['skipped']), (3, 3, 0))
+    assert hash_pair_exists(app, SHA3, SHA3R)
+    # a successful job can't be resumed
+    eq_(client.post('/mapper/import/%d/resume' % job_id).status_code, 409)
+
+
+@import_test_context
+def test_import_resume_running(app, client):
+    with mock.patch('relengapi.blueprints.mapper.import_mapfile'):
+        rv = client.post('/mapper/proj/import', content_type='text/plain', data=SHAFILE)
+    job_id = json.loads(rv.data)['id']
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    session.query(ImportJob).get(job_id).state = 'STARTED'
+    session.commit()
+    eq_(client.post('/mapper/import/%d/resume' % job_id).status_code, 409)
+
+
+@import_test_context
+def test_import_running_rechecked(app, client):
+    with mock.patch('relengapi.blueprints.mapper.import_mapfile'):
+        rv = client.post('/mapper/proj/import', content_type='text/plain', data=SHAFILE)
+    job_id = json.loads(rv.data)['id']
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    session.query(ImportJob).get(job_id).state = 'STARTED'
+    session.commit()
+    with app.app_context():
+        with mock.patch.object(mapper.import_mapfile, 'apply_async') as apply_async:
+            # a redelivered task leaves a running job alone, checking again later
+            mapper.import_mapfile(job_id)
+            apply_async.assert_called_with((job_id,), {'stalled_only': True},
+                                           countdown=mapper.IMPORT_STALLED_AFTER)
+        job = session.query(ImportJob).get(job_id)
+        job.state = 'PENDING'
+        session.commit()
+        # by which time the job may have been resumed, and run elsewhere
+        mapper.import_mapfile(job_id, stalled_only=True)
+    session.expire_all()
+    eq_(session.query(ImportJob).get(job_id).state, 'PENDING')
+
+
+@import_test_context
+def test_import_superseded(app, client):
+    def resumed_elsewhere(session, job, stream, renew):
+        # another worker claims the job, so this one's claim lapses
+        tbl = ImportJob.__table__
+        session.execute(tbl.update().values(updated=tbl.c.updated + 5))
+        session.commit()
+        renew()
+    with mock.patch('relengapi.blueprints.mapper._run_import', side_effect=resumed_elsewhere):
+        rv = client.post('/mapper/proj/import', content_type='text/plain', data=SHAFILE)
+    job = get_import_job(client, json.loads(rv.data)['id'])
+    # the superseded worker neither fails nor completes the job
+    eq_((job['state'], job['error']), ('STARTED', None))
+    eq_(len(os.listdir(import_dir)), 1)
+
+
+def mock_download(data, **attrs):
+    opts = dict(is_redirect=False)
+    opts.update(attrs)
+    response = mock.Mock(**opts)
+    response.raw = StringIO.StringIO(data)
+    return mock.patch('requests.get', return_value=response)
+
+
+@import_test_context
+def test_import_url(app, client):
+    with mock_download(SHAFILE) as get:
+        rv = client.post('/mapper/proj/import', content_type='application/json',
+                         data=json.dumps({'url': 'https://example.com/proj.map'}))
+    eq_(rv.status_code, 202)
+    get.assert_called_with('https://example.com/proj.map', stream=True, timeout=60,
+                           allow_redirects=False)
+    job = get_import_job(client, json.loads(rv.data)['id'])
+    eq_(job['state'], 'SUCCESS')
+    eq_((job['size'], job['inserted']), (len(SHAFILE), 3))
+
+
+@import_test_context
+def test_import_url_heartbeat(app, client):
+    with mock.patch('relengapi.blueprints.mapper.IMPORT_HEARTBEAT_INTERVAL', 0):
+        with mock.patch('relengapi.blueprints.mapper._renew_claim',
+                        wraps=mapper._renew_claim) as renew_claim:
+            with mock_download(SHAFILE):
+                rv = client.post('/mapper/proj/import', content_type='application/json',
+                                 data=json.dumps({'url': 'https://example.com/proj.map'}))
+    eq_(get_import_job(client, json.loads(rv.data)['id'])['state'], 'SUCCESS')
+    # once per downloaded block, after the download, per chunk, and on success
+    eq_(renew_claim.call_count, 4)
+
+
+@import_test_context
+def test_import_url_redirect(app, client):
+    with mock_download('', is_redirect=True, headers={'Location': 'http://internal/'}):
+        rv = client.post('/mapper/proj/import', content_type='application/json',
+                         data=json.dumps({'url': 'https://example.com/proj.map'}))
+    job = get_import_job(client, json.loads(rv.data)['id'])
+    eq_(job['state'], 'FAILURE')
+    assert 'redirects to http://internal/' in job['error']
+
+
+@import_test_context
+def test_import_url_not_allowed(app, client):
+    for url in ['http://example.com/proj.map', 'https://internal/proj.map',
+                'file:///etc/passwd']:
+        rv = client.post('/mapper/proj/import', content_type='application/json',
+                         data=json.dumps({'url': url}))
+        eq_(rv.status_code, 400)
+
+
+@import_test_context
+def test_import_url_missing(app, client):
+    rv = client.post('/mapper/proj/import', content_type='application/json',
+                     data=json.dumps({'path': '/etc/passwd'}))
+    eq_(rv.status_code, 400)
+
+
+@import_test_context
+def test_import_bad_content_type(app, client):
+    rv = client.post('/mapper/proj/import', content_type='application/octet-stream',
+                     data=SHAFILE)
+    eq_(rv.status_code, 400)
+
+
+@import_test_context
+def test_import_unknown_project(app, client):
+    rv = client.post('/mapper/nosuch/import', content_type='text/plain', data=SHAFILE)
+    eq_(rv.status_code, 404)
+
+
+@test_context
+def test_import_not_enabled(app, client):
+    rv = client.post('/mapper/proj/import', content_type='text/plain', data=SHAFILE)
+    eq_(rv.status_code, 500)
+
+
+@import_test_context
+def test_get_import_job_not_found(app, client):
+    eq_(client.get('/mapper/import/99').status_code, 404)
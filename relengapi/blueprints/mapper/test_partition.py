@@ -0,0 +1,137 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import mock
+import sqlalchemy as sa
+from nose.tools import assert_raises
+from nose.tools import eq_
+
+from relengapi.blueprints.mapper import DB_DECLARATIVE_BASE
+from relengapi.blueprints.mapper import Hash
+from relengapi.blueprints.mapper import Project
+from relengapi.blueprints.mapper import partition
+from relengapi.lib.permissions import p
+from relengapi.lib.testing.context import TestContext
+
+test_context = TestContext(databases=[DB_DECLARATIVE_BASE],
+                           perms=[p.mapper.project.insert])
+partitioned_context = test_context.specialize(config={'MAPPER_PARTITION_HASHES': True})
+
+
+def test_partition_statement():
+    eq_(partition.partition_statement([3, 1]),
+        'ALTER TABLE releng_mapper_hashes PARTITION BY LIST (project_id) '
+        '(PARTITION p1 VALUES IN (1), PARTITION p3 VALUES IN (3))')
+
+
+def test_add_partition_statement():
+    eq_(partition.add_partition_statement(7),
+        'ALTER TABLE releng_mapper_hashes ADD PARTITION (PARTITION p7 VALUES IN (7))')
+
+
+def test_pg_partition_statements():
+    statements = partition.pg_partition_statements([3, 1])
+    eq_(statements[:4], [
+        'ALTER TABLE releng_mapper_hashes RENAME TO releng_mapper_hashes_unpartitioned',
+        'CREATE TABLE releng_mapper_hashes (LIKE releng_mapper_hashes_unpartitioned '
+        'INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY LIST (project_id)',
+        'CREATE TABLE releng_mapper_hashes_p1 PARTITION OF releng_mapper_hashes '
+        'FOR VALUES IN (1)',
+        'CREATE TABLE releng_mapper_hashes_p3 PARTITION OF releng_mapper_hashes '
+        'FOR VALUES IN (3)',
+    ])
+    # the mappings are copied before the old table is dropped
+    eq_(statements[4:6], [
+        'INSERT INTO releng_mapper_hashes SELECT * FROM releng_mapper_hashes_unpartitioned',
+        'DROP TABLE releng_mapper_hashes_unpartitioned',
+    ])
+    assert ('CREATE UNIQUE INDEX project_id__git_commit ON releng_mapper_hashes '
+            '(project_id, git_commit)') in statements
+
+
+def test_unpartition_statements():
+    eq_(partition.unpartition_statements('mysql')[0],
+        'ALTER TABLE releng_mapper_hashes REMOVE PARTITIONING')
+    eq_(partition.unpartition_statements('postgresql')[0],
+        'ALTER TABLE releng_mapper_hashes RENAME TO releng_mapper_hashes_partitioned')
+
+
+@test_context
+def test_not_partitioned(app):
+    """Only MySQL and Postgres tables are partitioned"""
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    conn = session.connection()
+    eq_(partition.partitioned_projects(conn), None)
+    eq_(partition.partition_statements(conn), [])
+
+
+def mock_conn(dialect):
+    conn = mock.Mock()
+    conn.dialect.name = dialect
+    return conn
+
+
+def test_add_partition_not_partitioned():
+    conn = mock_conn('mysql')
+    with mock.patch.object(partition, 'partitioned_projects', return_value=None):
+        eq_(partition.add_partition(conn, 3), False)
+    eq_(conn.execute.call_count, 0)
+
+
+def test_add_partition():
+    conn = mock_conn('mysql')
+    with mock.patch.object(partition, 'partitioned_projects', return_value=set([1, 2])):
+        eq_(partition.add_partition(conn, 2), False)
+        eq_(conn.execute.call_count, 0)
+        eq_(partition.add_partition(conn, 3), True)
+    conn.execute.assert_called_with(partition.add_partition_statement(3))
+
+
+def test_add_partition_postgres():
+    conn = mock_conn('postgresql')
+    with mock.patch.object(partition, 'partitioned_projects', return_value=set()):
+        partition.add_partition(conn, 3)
+    conn.execute.assert_called_with(partition.pg_add_partition_statement(3))
+
+
+@test_context
+def test_add_project_not_partitioned(app, client):
+    """Without MAPPER_PARTITION_HASHES, no partition is added"""
+    with mock.patch.object(partition, 'add_partition') as add_partition:
+        eq_(client.post('/mapper/proj').status_code, 200)
+    eq_(add_partition.call_count, 0)
+
+
+@partitioned_context
+def test_add_project_adds_partition(app, client):
+    with mock.patch.object(partition, 'add_partition') as add_partition:
+        eq_(client.post('/mapper/proj').status_code, 200)
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    eq_(add_partition.call_args[0][1], session.query(Project).one().id)
+
+
+@partitioned_context
+def test_add_project_partition_fails(app, client):
+    """The project is not created if its partition cannot be"""
+    with mock.patch.object(partition, 'add_partition',
+                           side_effect=sa.exc.OperationalError('CREATE', {}, None)):
+        eq_(client.post('/mapper/proj').status_code, 409)
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    eq_(session.query(Project).count(), 0)
+
+
+@test_context
+def test_benchmark_lookups(app):
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    project = Project(name='proj')
+    session.add(project)
+    session.add(Hash(git_commit='1' * 40, hg_changeset='a' * 40, project=project,
+                     date_added=1))
+    session.commit()
+    results = partition.benchmark_lookups(session, 'proj')
+    eq_(results['samples'], 1)
+    eq_(results['full']['count'], 1)
+    assert_raises(ValueError, partition.benchmark_lookups, session, 'nosuch')
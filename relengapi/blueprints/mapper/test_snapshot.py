@@ -0,0 +1,208 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import fcntl
+import os
+import shutil
+import tempfile
+import zlib
+from contextlib import contextmanager
+
+import mock
+from nose.tools import eq_
+
+from relengapi.blueprints.mapper import snapshot
+
+LINE1 = '%s %s\n' % ('1' * 40, 'a' * 40)
+LINE2 = '%s %s\n' % ('2' * 40, 'b' * 40)
+LINE3 = '%s %s\n' % ('3' * 40, 'c' * 40)
+
+
+@contextmanager
+def make_store():
+    directory = tempfile.mkdtemp()
+    try:
+        yield snapshot.SnapshotStore(os.path.join(directory, 'snapshots'))
+    finally:
+        shutil.rmtree(directory)
+
+
+def build(store, lines, count, latest):
+    return list(store.tee(7, iter(lines), count, latest))
+
+
+def test_open_missing():
+    """Opening a snapshot that does not exist returns None"""
+    with make_store() as store:
+        eq_(store.open(7), None)
+
+
+def test_tee_builds_snapshot():
+    """Lines passed through tee become the project's snapshot"""
+    with make_store() as store:
+        eq_(build(store, [LINE1, LINE3], 2, 100), [LINE1, LINE3])
+        snap = store.open(7)
+        assert snap.matches(2, 100)
+        assert not snap.matches(3, 100)
+        eq_(''.join(snap.chunks()), LINE1 + LINE3)
+
+
+def test_tee_writes_gzip():
+    """tee writes a gzipped copy of the snapshot, which is available while
+    there is no delta"""
+    with make_store() as store:
+        build(store, [LINE1, LINE3], 2, 100)
+        snap = store.open(7)
+        assert snap.has_gzip
+        eq_(zlib.decompress(''.join(snap.gzip_chunks()), 16 + zlib.MAX_WBITS),
+            LINE1 + LINE3)
+        store.append(7, [LINE2], 1, 3, 101)
+        snap = store.open(7)
+        assert not snap.has_gzip
+        snap.close()
+
+
+def test_tee_wrong_count():
+    """If tee sees a different number of lines than expected, no snapshot is
+    written"""
+    with make_store() as store:
+        eq_(build(store, [LINE1, LINE3], 3, 100), [LINE1, LINE3])
+        eq_(store.open(7), None)
+        eq_([f for f in os.listdir(store.directory) if f.endswith('.tmp')], [])
+
+
+def test_tee_concurrent_rebuild():
+    """If another rebuild is in progress, tee just passes lines through"""
+    with make_store() as store:
+        with open(os.path.join(store.directory, '7.rebuild'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            eq_(build(store, [LINE1], 1, 100), [LINE1])
+        eq_(store.open(7), None)
+
+
+def test_append_merges_in_order():
+    """Appended lines are merged into the snapshot in hg changeset order"""
+    with make_store() as store:
+        build(store, [LINE1, LINE3], 2, 100)
+        assert store.append(7, [LINE2], 1, 3, 101)
+        snap = store.open(7)
+        assert snap.matches(3, 101)
+        eq_(''.join(snap.chunks()), LINE1 + LINE2 + LINE3)
+
+
+def test_append_out_of_date():
+    """Lines are not appended to a snapshot that is missing other mappings"""
+    with make_store() as store:
+        build(store, [LINE1], 1, 100)
+        assert not store.append(7, [LINE2], 1, 3, 101)
+        assert store.open(7).matches(1, 100)
+
+
+def test_append_no_snapshot():
+    """Lines are not appended when there is no snapshot"""
+    with make_store() as store:
+        assert not store.append(7, [LINE2], 1, 1, 101)
+        eq_(store.open(7), None)
+
+
+def test_needs_compaction():
+    """A snapshot needs compaction when its delta exceeds max_delta"""
+    with make_store() as store:
+        store.max_delta = 1
+        build(store, [LINE1], 1, 100)
+        store.append(7, [LINE2], 1, 2, 101)
+        assert not store.needs_compaction(store.open(7))
+        store.append(7, [LINE3], 1, 3, 102)
+        assert store.needs_compaction(store.open(7))
+
+
+def test_buffered():
+    """buffered groups lines into blocks of at least the given size"""
+    eq_(list(snapshot.buffered(['ab', 'cd', 'e'], size=3)), ['abcd', 'e'])
+
+
+def test_lookup_no_snapshot():
+    """Lookups in a project without a snapshot return None"""
+    with make_store() as store:
+        eq_(store.lookup(7, 'git', '1111', 0, None), None)
+
+
+def test_lookup():
+    """Lookups find full and abbreviated SHAs of either type in the index"""
+    with make_store() as store:
+        build(store, [LINE1, LINE3], 2, 100)
+        eq_(store.lookup(7, 'git', '1' * 40, 2, 100), set([('1' * 40, 'a' * 40)]))
+        eq_(store.lookup(7, 'git', '3', 2, 100), set([('3' * 40, 'c' * 40)]))
+        eq_(store.lookup(7, 'hg', 'aaa', 2, 100), set([('1' * 40, 'a' * 40)]))
+        eq_(store.lookup(7, 'hg', 'b', 2, 100), set())
+        eq_(store.lookup(7, 'git', '0', 2, 100), set())
+        eq_(store.lookup(7, 'git', 'f', 2, 100), set())
+
+
+def test_lookup_stale():
+    """Lookups return None if the index does not reflect the given state"""
+    with make_store() as store:
+        build(store, [LINE1, LINE3], 2, 100)
+        eq_(store.lookup(7, 'git', '1', 3, 100), None)
+        eq_(store.lookup(7, 'git', '1', 2, 101), None)
+
+
+def test_lookup_ambiguous():
+    """Lookups return up to the given number of mappings"""
+    lines = ['%s %s\n' % ('12' + c * 38, c * 40) for c in 'abcd']
+    with make_store() as store:
+        build(store, lines, 4, 100)
+        eq_(len(store.lookup(7, 'git', '12', 4, 100)), 2)
+        eq_(len(store.lookup(7, 'hg', 'c', 4, 100, limit=5)), 1)
+        eq_(len(store.lookup(7, 'git', '1', 4, 100, limit=5)), 4)
+
+
+def test_lookup_delta():
+    """Lookups find appended mappings, including those appended after the index
+    was first used"""
+    line4 = '%s %s\n' % ('3' * 39 + '4', 'd' * 40)
+    with make_store() as store:
+        build(store, [LINE1], 1, 100)
+        eq_(store.lookup(7, 'git', '2', 1, 100), set())
+        store.append(7, [LINE2], 1, 2, 101)
+        eq_(store.lookup(7, 'git', '2', 2, 101), set([('2' * 40, 'b' * 40)]))
+        store.append(7, [LINE3, line4], 2, 4, 102)
+        eq_(store.lookup(7, 'hg', 'd', 4, 102), set([('3' * 39 + '4', 'd' * 40)]))
+        eq_(store.lookup(7, 'git', '333', 4, 102),
+            set([('3' * 40, 'c' * 40), ('3' * 39 + '4', 'd' * 40)]))
+
+
+def test_lookup_rebuilt():
+    """Lookups use the new index after a rebuild"""
+    with make_store() as store:
+        build(store, [LINE1], 1, 100)
+        eq_(store.lookup(7, 'git', '3', 1, 100), set())
+        build(store, [LINE1, LINE3], 2, 101)
+        eq_(store.lookup(7, 'git', '3', 2, 101), set([('3' * 40, 'c' * 40)]))
+
+
+def test_git_index_sorted_in_runs():
+    """The git index is sorted correctly when it is built from several runs"""
+    lines = ['%s %s\n' % (c * 40, h * 40) for c, h in zip('3142', 'abcd')]
+    with make_store() as store:
+        with mock.patch.object(snapshot, 'SORT_RUN_RECORDS', 3):
+            build(store, lines, 4, 100)
+        for c, h in zip('3142', 'abcd'):
+            eq_(store.lookup(7, 'git', c, 4, 100), set([(c * 40, h * 40)]))
+        gitidx = open(os.path.join(store.directory, '7.gitidx'), 'rb').read()
+        eq_([gitidx[i] for i in range(0, len(gitidx), 40)], ['\x11', '\x22', '\x33', '\x44'])
+
+
+def test_gzipped():
+    """gzipped compresses a stream of chunks"""
+    chunks = list(snapshot.gzipped(['abc' * 1000, 'def' * 1000]))
+    eq_(zlib.decompress(''.join(chunks), 16 + zlib.MAX_WBITS), 'abc' * 1000 + 'def' * 1000)
+
+
+def test_merged():
+    """merged interleaves sorted iterables of lines in hg changeset order"""
+    eq_(list(snapshot.merged([LINE1, LINE3], [], [LINE2, LINE3])),
+        [LINE1, LINE2, LINE3, LINE3])
@@ -5,11 +5,11 @@
 from __future__ import absolute_import
 
 import datetime
-import random
 import re
 
 import sqlalchemy as sa
 import structlog
+import wsme
 from flask import Blueprint
 from flask import current_app
 from flask import g
@@ -22,12 +22,18 @@ from werkzeug.exceptions import BadRequest
 from werkzeug.exceptions import Forbidden
 from werkzeug.exceptions import NotFound
 
+from relengapi.blueprints.tooltool import blobcache
+from relengapi.blueprints.tooltool import cache
+from relengapi.blueprints.tooltool import downloads
 from relengapi.blueprints.tooltool import grooming
+from relengapi.blueprints.tooltool import notifications
+from relengapi.blueprints.tooltool import search
 from relengapi.blueprints.tooltool import tables
 from relengapi.blueprints.tooltool import types
 from relengapi.blueprints.tooltool import util
 from relengapi.lib import angular
 from relengapi.lib import api
+from relengapi.lib import locality
 from relengapi.lib import time
 from relengapi.lib.permissions import p
 
@@ -55,16 +61,18 @@ p.tooltool.manage.doc("Manage tooltool files, including deleting and changing vi
 # after it had been verified.
 UPLOAD_EXPIRES_IN = 60
 GET_EXPIRES_IN = 60
+# signed download URLs are re-used for only half of their lifetime, so that
+# clients always have at least 30 seconds in which to begin the download
+GET_CACHE_SECONDS = GET_EXPIRES_IN // 2
+MAX_MANIFEST_FILES = 1000
 
 logger = structlog.get_logger()
 
 
 def get_region_and_bucket(region_arg):
     cfg = current_app.config['TOOLTOOL_REGIONS']
-    if region_arg and region_arg in cfg:
-        return region_arg, cfg[region_arg]
-    # no region specified, so return one at random
-    return random.choice(cfg.items())
+    region = locality.select_region(cfg, region_arg)
+    return region, cfg[region]
 
 bp.root_widget_template(
     'tooltool_root_widget.html', priority=100,
@@ -80,15 +88,17 @@ def root():
 
 
 @bp.route('/upload')
-@api.apimethod([types.UploadBatch], unicode)
-def search_batches(q):
+@api.apimethod([types.UploadBatch], unicode, int, int)
+def search_batches(q, page=None, per_page=None):
     """Search upload batches.  The required query parameter ``q`` can match a
-    substring of an author's email or a batch message."""
-    tbl = tables.Batch
-    q = tbl.query.filter(sa.or_(
-        tbl.author.contains(q),
-        tbl.message.contains(q)))
-    return [row.to_json() for row in q.all()]
+    substring of an author's email or a batch message.  Batches matching both
+    come first, followed by the most recent.
+
+    All matching batches are returned, unless ``page`` or ``per_page`` is
+    given: then ``page`` (default 1) selects a page of ``per_page`` results
+    (default 100, at most 1000)."""
+    session = g.db.session(tables.DB_DECLARATIVE_BASE)
+    return [row.to_json() for row in search.search_batches(session, q, page, per_page)]
 
 
 @bp.route('/upload/<int:id>')
@@ -146,22 +156,30 @@ def upload_batch(region=None, body=None):
         if not prm or not prm.can():
             raise Forbidden("no permission to upload {} files".format(v))
 
+    for info in body.files.itervalues():
+        if info.algorithm != 'sha512':
+            raise BadRequest("'sha512' is the only allowed digest algorithm")
+        if not is_valid_sha512(info.digest):
+            raise BadRequest("Invalid sha512 digest")
+
     session = g.db.session(tables.DB_DECLARATIVE_BASE)
     batch = tables.Batch(
         uploaded=time.now(),
         author=body.author,
         message=body.message)
 
-    s3 = current_app.aws.connect_to('s3', region)
+    # Batches can contain hundreds of files, so rather than handling the files
+    # one at a time, look up all of the existing files (and their instances)
+    # at once, then insert the new files and pending uploads in bulk.  The
+    # number of statements executed does not depend on the size of the batch.
+    digests = set(info.digest for info in body.files.itervalues())
+    files = {f.sha512: f for f in session.query(tables.File).filter(
+        tables.File.sha512.in_(digests)).options(sa.orm.subqueryload(tables.File.instances))}
+
+    new_files = {}
+    to_upload = {}
     for filename, info in body.files.iteritems():
-        log = logger.bind(tooltool_sha512=info.digest, tooltool_operation='upload',
-                          tooltool_batch_id=batch.id, mozdef=True)
-        if info.algorithm != 'sha512':
-            raise BadRequest("'sha512' is the only allowed digest algorithm")
-        if not is_valid_sha512(info.digest):
-            raise BadRequest("Invalid sha512 digest")
-        digest = info.digest
-        file = tables.File.query.filter(tables.File.sha512 == digest).first()
+        file = files.get(info.digest)
         if file and file.visibility != info.visibility:
             raise BadRequest("Cannot change a file's visibility level")
         if file and file.instances != []:
@@ -169,31 +187,45 @@ def upload_batch(region=None, body=None):
                 raise BadRequest("Size mismatch for {}".format(filename))
         else:
             if not file:
-                file = tables.File(
-                    sha512=digest,
-                    visibility=info.visibility,
-                    size=info.size)
-                session.add(file)
-            log.info("generating signed S3 PUT URL to {} for {}; expiring in {}s".format(
-                info.digest[:10], current_user, UPLOAD_EXPIRES_IN))
-            info.put_url = s3.generate_url(
-                method='PUT', expires_in=UPLOAD_EXPIRES_IN, bucket=bucket,
-                key=util.keyname(info.digest),
-                headers={'Content-Type': 'application/octet-stream'})
-            # The PendingUpload row needs to reflect the updated expiration
-            # time, even if there's an existing pending upload that expires
-            # earlier.  The `merge` method does a SELECT and then either UPDATEs
-            # or INSERTs the row.  However, merge needs the file_id, rather than
-            # just a reference to the file object; and for that, we need to flush
-            # the inserted file.
-            session.flush()
-            pu = tables.PendingUpload(
-                file_id=file.id,
-                region=region,
-                expires=time.now() + datetime.timedelta(seconds=UPLOAD_EXPIRES_IN))
-            session.merge(pu)
-        session.add(tables.BatchFile(filename=filename, file=file, batch=batch))
+                new_files[info.digest] = {
+                    'sha512': info.digest,
+                    'visibility': info.visibility,
+                    'size': info.size,
+                }
+            to_upload[filename] = info
+
+    if new_files:
+        session.execute(tables.File.__table__.insert(), new_files.values())
+        files.update((f.sha512, f) for f in session.query(tables.File).filter(
+            tables.File.sha512.in_(new_files)))
+
+    s3 = current_app.aws.connect_to('s3', region)
+    for filename, info in to_upload.iteritems():
+        log = logger.bind(tooltool_sha512=info.digest, tooltool_operation='upload',
+                          tooltool_batch_id=batch.id, mozdef=True)
+        log.info("generating signed S3 PUT URL to {} for {}; expiring in {}s".format(
+            info.digest[:10], current_user, UPLOAD_EXPIRES_IN))
+        info.put_url = s3.generate_url(
+            method='PUT', expires_in=UPLOAD_EXPIRES_IN, bucket=bucket,
+            key=util.keyname(info.digest),
+            headers={'Content-Type': 'application/octet-stream'})
+
+    # The PendingUpload rows need to reflect the updated expiration time, even
+    # if there's an existing pending upload that expires earlier, so any
+    # existing rows are replaced.
+    if to_upload:
+        file_ids = set(files[info.digest].id for info in to_upload.itervalues())
+        pu_table = tables.PendingUpload.__table__
+        session.execute(pu_table.delete().where(pu_table.c.file_id.in_(file_ids)))
+        expires = time.now() + datetime.timedelta(seconds=UPLOAD_EXPIRES_IN)
+        session.execute(pu_table.insert(), [
+            {'file_id': file_id, 'region': region, 'expires': expires}
+            for file_id in file_ids])
+
+    for filename, info in body.files.iteritems():
+        session.add(tables.BatchFile(filename=filename, file=files[info.digest], batch=batch))
     session.add(batch)
+    search.index_batch(session, batch)
     session.commit()
 
     body.id = batch.id
@@ -236,16 +268,15 @@ def upload_complete(digest):
 
 
 @bp.route('/file')
-@api.apimethod([types.File], unicode)
-def search_files(q):
+@api.apimethod([types.File], unicode, int, int)
+def search_files(q, page=None, per_page=None):
     """Search for files matching the query ``q``.  The query matches against
-    prefixes of hashes (at least 8 characters) or against filenames."""
+    prefixes of hashes (at least 8 characters) or against filenames.  Hash
+    matches come first, followed by the most recently added files.
+
+    Results are paginated as for ``GET /upload``."""
     session = g.db.session(tables.DB_DECLARATIVE_BASE)
-    query = session.query(tables.File).join(tables.BatchFile)
-    query = query.filter(sa.or_(
-        tables.BatchFile.filename.contains(q),
-        tables.File.sha512.startswith(q)))
-    return [row.to_json() for row in query.all()]
+    return [row.to_json() for row in search.search_files(session, q, page, per_page)]
 
 
 @bp.route('/file/sha512/<digest>')
@@ -306,6 +337,7 @@ def patch_file(digest, body):
         else:
             raise BadRequest("unknown op")
     session.commit()
+    cache.invalidate(digest)
     return file.to_json(include_instances=True)
 
 
@@ -317,41 +349,110 @@ def download_file(digest, region=None):
 
     The query argument ``region=us-west-1`` indicates a preference for a URL in
     that region, although if the file is not available in tht region then a URL
-    from another region may be returned."""
+    from another region may be returned.
+
+    If this server is configured with a blob cache, the response is instead the
+    file itself, served from the cache."""
     log = logger.bind(tooltool_sha512=digest, tooltool_operation='download')
     if not is_valid_sha512(digest):
         raise BadRequest("Invalid sha512 digest")
 
-    # see where the file is..
-    tbl = tables.File
-    file_row = tbl.query.filter(tbl.sha512 == digest).first()
-    if not file_row or not file_row.instances:
+    # see where the file is (possibly from the cache)..
+    entry = cache.file_entry(digest)
+    if not entry:
         raise NotFound
+    visibility, instance_regions = entry
+
+    check_download_permission(visibility)
+    selected_region = locality.select_region(instance_regions, region)
+    downloads.record(digest, selected_region)
+    response = blobcache.serve(digest, selected_region)
+    if response:
+        return response
+    return redirect(signed_get_url(digest, selected_region, log))
+
+
+@bp.route('/download', methods=['POST'])
+@api.apimethod({unicode: types.File}, unicode, body=[types.ManifestFile])
+def resolve_manifest(region=None, body=None):
+    """Resolve the files in a manifest to download URLs, all at once.  The
+    body is a list of ManifestFile objects, and the response maps each digest
+    to a File with a signed ``get_url`` and the file's ``instances``.  If this
+    server is configured with a blob cache, each ``get_url`` is instead this
+    server's ``/sha512/<digest>`` URL.
+
+    The query argument ``region`` indicates a preference for URLs in that
+    region, as for ``GET /sha512/<digest>``.
+
+    If any of the files does not exist or has no instances, the response is a
+    404; if the user does not have permission to download any of them, it is a
+    403; and if a given size does not match, it is a 400."""
+    if len(body) > MAX_MANIFEST_FILES:
+        raise BadRequest("Manifests can contain at most {} files".format(MAX_MANIFEST_FILES))
+    sizes = {}
+    for info in body:
+        if info.algorithm not in (wsme.Unset, 'sha512'):
+            raise BadRequest("'sha512' is the only allowed digest algorithm")
+        if not is_valid_sha512(info.digest):
+            raise BadRequest("Invalid sha512 digest")
+        sizes[info.digest] = info.size
+
+    # find all of the files, with their instances, in a single query
+    session = g.db.session(tables.DB_DECLARATIVE_BASE)
+    files = session.query(tables.File).filter(tables.File.sha512.in_(sizes)).options(
+        sa.orm.joinedload(tables.File.instances)).all()
+    files = {f.sha512: f for f in files if f.instances}
+    missing = sorted(set(sizes) - set(files))
+    if missing:
+        raise NotFound("No such file(s): {}".format(', '.join(missing)))
+    for digest, file in files.iteritems():
+        if sizes[digest] is not wsme.Unset and sizes[digest] != file.size:
+            raise BadRequest("Size mismatch for {}".format(digest))
+
+    # check each visibility level only once
+    for visibility in set(f.visibility for f in files.itervalues()):
+        check_download_permission(visibility)
+
+    result = {}
+    for digest, file in files.iteritems():
+        log = logger.bind(tooltool_sha512=digest, tooltool_operation='download')
+        rv = file.to_json(include_instances=True)
+        if current_app.tooltool_blob_cache:
+            rv.get_url = url_for('.download_file', digest=digest, region=region,
+                                 _external=True)
+        else:
+            selected_region = locality.select_region(rv.instances, region)
+            downloads.record(digest, selected_region)
+            rv.get_url = signed_get_url(digest, selected_region, log)
+        result[digest] = rv
+    return result
+
 
-    # check visibility
+def check_download_permission(visibility):
     allow_pub_dl = current_app.config.get('TOOLTOOL_ALLOW_ANONYMOUS_PUBLIC_DOWNLOAD')
-    if file_row.visibility != 'public' or not allow_pub_dl:
-        if not p.get('tooltool.download.{}'.format(file_row.visibility)).can():
+    if visibility != 'public' or not allow_pub_dl:
+        if not p.get('tooltool.download.{}'.format(visibility)).can():
             raise Forbidden
 
-    # figure out which region to use, and from there which bucket
-    cfg = current_app.config['TOOLTOOL_REGIONS']
-    selected_region = None
-    for inst in file_row.instances:
-        if inst.region == region:
-            selected_region = inst.region
-            break
-    else:
-        # preferred region not found, so pick one from the available set
-        selected_region = random.choice([inst.region for inst in file_row.instances])
-    bucket = cfg[selected_region]
 
+def signed_get_url(digest, region, log):
+    """Return a signed URL to download the given file from the given region,
+    possibly from the cache."""
+    bucket = current_app.config['TOOLTOOL_REGIONS'][region]
     key = util.keyname(digest)
 
-    s3 = current_app.aws.connect_to('s3', selected_region)
-    log.info("generating signed S3 GET URL for {}.. expiring in {}s".format(
-        digest[:10], GET_EXPIRES_IN))
-    signed_url = s3.generate_url(
-        method='GET', expires_in=GET_EXPIRES_IN, bucket=bucket, key=key)
-
-    return redirect(signed_url)
+    def sign():
+        s3 = current_app.aws.connect_to('s3', region)
+        log.info("generating signed S3 GET URL for {}.. expiring in {}s".format(
+            digest[:10], GET_EXPIRES_IN))
+        return s3.generate_url(
+            method='GET', expires_in=GET_EXPIRES_IN, bucket=bucket, key=key)
+    return cache.signed_url(digest, region, GET_CACHE_SECONDS, sign)
+
+
+@bp.record
+def init_blueprint(state):
+    blobcache.init_app(state.app)
+    cache.init_app(state.app)
+    downloads.init_app(state.app)
+    notifications.init_app(state.app)
@@ -0,0 +1,291 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import errno
+import fcntl
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+
+import structlog
+from flask import Response
+from flask import current_app
+from flask import send_file
+
+from relengapi.blueprints.tooltool import util
+
+logger = structlog.get_logger()
+
+# For build machines far from S3, TOOLTOOL_BLOB_CACHE can name a local
+# directory in which download_file keeps copies of the files it serves,
+# named by their digest.  The directory may be shared by several processes.
+#
+# A request for a file that is not in the directory starts downloading it
+# from S3 into a ".part" file, unless another thread or process is already
+# doing so, as shown by an exclusive lock on the part file.  Either way, the
+# request streams the file to its client from the part file as it grows.
+# Once downloaded, the file's digest is verified and the part file is renamed
+# into place; the last chunk of each stream is held back until then, so that
+# no client receives a complete but incorrect file.  Cached files are served
+# with `send_file`, so the WSGI server can use sendfile(2).
+#
+# Before each download, the least recently used files are deleted to make
+# room for it, according to the files' modification times, which are updated
+# as they are served.
+#
+# If a file cannot be cached, download_file falls back to redirecting to S3.
+
+FILL_CHUNK_SIZE = 1024 * 1024
+STALE_PART_SECONDS = 86400
+# how often a stream checks for more of a part file, and how long it waits
+# for more before giving up on the download
+FOLLOW_INTERVAL = 0.1
+FOLLOW_TIMEOUT = 60
+
+_is_digest = re.compile(r'^[0-9a-f]{128}$').match
+
+
+def _same_file(path, st):
+    try:
+        other = os.stat(path)
+    except OSError:
+        return False
+    return (other.st_dev, other.st_ino) == (st.st_dev, st.st_ino)
+
+
+class BlobCache(object):
+
+    """A size-bounded, content-addressed cache of tooltool files on local
+    disk, which may be shared by several processes."""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._evict()
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _part(self, digest):
+        return self.path(digest) + '.part'
+
+    def _evict(self, room=0, keep=None):
+        """Delete the least recently used files until those remaining, and
+        `room` more bytes, fit in the cache; and delete part files left behind
+        by interrupted downloads.  The directory is scanned each time, under
+        a lock, since other processes may be using it too."""
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            found = []
+            total = 0
+            for dirpath, _, filenames in os.walk(self.directory):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        # deleted by another process
+                        continue
+                    if _is_digest(filename):
+                        found.append((st.st_mtime, path, st.st_size))
+                        total += st.st_size
+                    elif filename.endswith('.part') and \
+                            st.st_mtime < time.time() - STALE_PART_SECONDS:
+                        self._unlink(path)
+            for _, path, size in sorted(found):
+                if total + room <= self.max_size:
+                    break
+                if path != keep:
+                    self._unlink(path)
+                    total -= size
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            # already deleted by another process
+            pass
+
+    def get(self, digest):
+        """Return the path of the cached file with the given digest, or None
+        if it is not cached."""
+        path = self.path(digest)
+        try:
+            # record the use, for eviction
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def fetch(self, digest, bucket):
+        """Start downloading the file with the given digest from the given boto
+        S3 bucket into the cache, unless it is already being downloaded, and
+        return a tuple (size, iterator over the file's contents as they are
+        downloaded).  Returns None if the file cannot be cached.  The iterator
+        raises IOError if the download fails."""
+        log = logger.bind(tooltool_sha512=digest)
+        key = bucket.get_key(util.keyname(digest))
+        if not key:
+            log.warning("{} not found in {}; not caching".format(digest, bucket.name))
+            return None
+        if key.size > self.max_size:
+            log.info("{} is larger than the blob cache; not caching".format(digest))
+            return None
+
+        fill = self._claim_fill(digest, key, bucket.name)
+        # open the file before starting the download, so that it is found even
+        # if the download fails right away; another process's download may
+        # already have finished, or failed
+        for path in self._part(digest), self.path(digest):
+            try:
+                # (not a built-in file, whose end-of-file is sticky)
+                f = io.open(path, 'rb')
+            except IOError:
+                continue
+            if fill:
+                fill.start()
+            return key.size, self._follow(digest, f, key.size)
+        return None
+
+    def _claim_fill(self, digest, key, bucket_name):
+        """Return a thread, not yet started, to download the given file into its
+        part file, or None if another thread or process is already doing so."""
+        part = self._part(digest)
+        try:
+            os.makedirs(os.path.dirname(part))
+        except OSError:
+            # already exists
+            pass
+        while True:
+            f = os.fdopen(os.open(part, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                f.close()
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    # being downloaded by another thread or process
+                    return None
+                raise
+            st = os.fstat(f.fileno())
+            if not _same_file(part, st):
+                # that download finished (or failed) before the lock was taken
+                f.close()
+                return None
+            if st.st_size:
+                # left behind by an interrupted download; start afresh
+                os.unlink(part)
+                f.close()
+                continue
+            break
+        thd = threading.Thread(target=self._fill, args=(digest, key, bucket_name, f),
+                               name='blobcache-fill')
+        thd.daemon = True
+        return thd
+
+    def _fill(self, digest, key, bucket_name, f):
+        """Make room for the given file, and download it into the locked part
+        file `f`; then move it into place if its digest is correct, or delete
+        it if not; and release the lock."""
+        log = logger.bind(tooltool_sha512=digest)
+        part = self._part(digest)
+        try:
+            self._evict(room=key.size)
+            sha512 = hashlib.sha512()
+            while True:
+                chunk = key.read(FILL_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha512.update(chunk)
+                f.write(chunk)
+                # make the chunk visible to the streams following the file
+                f.flush()
+            if sha512.hexdigest() != digest:
+                log.warning("{} in {} has the wrong digest; not caching".format(
+                    digest, bucket_name))
+                self._unlink(part)
+                return
+            os.rename(part, self.path(digest))
+        except Exception:
+            log.exception("caching {} from {} failed".format(digest, bucket_name))
+            self._unlink(part)
+            return
+        finally:
+            f.close()
+        log.info("cached {} from {} ({} bytes)".format(digest, bucket_name, key.size))
+
+    def _follow(self, digest, f, size):
+        """Yield the contents of the open file `f`, which is either the cached
+        file with the given digest or its part file, as it is downloaded."""
+        with f:
+            st = os.fstat(f.fileno())
+            sent = 0
+            last = ''
+            idle_since = time.time()
+            while True:
+                # whether the download had finished (or failed) before this
+                # read, in which case the file is now complete
+                finished = not _same_file(self._part(digest), st)
+                chunk = f.read(FILL_CHUNK_SIZE)
+                if chunk:
+                    idle_since = time.time()
+                    sent += len(chunk)
+                    if sent > size:
+                        break
+                    elif sent < size:
+                        yield chunk
+                    else:
+                        # held back until the file is verified
+                        last = chunk
+                    continue
+                if finished:
+                    if sent == size and _same_file(self.path(digest), st):
+                        # verified, and moved into place
+                        if last:
+                            yield last
+                        return
+                    break
+                if time.time() - idle_since > FOLLOW_TIMEOUT:
+                    break
+                time.sleep(FOLLOW_INTERVAL)
+        raise IOError("downloading {} into the blob cache failed".format(digest))
+
+
+def serve(digest, region):
+    """Return a response serving the file with the given digest from the blob
+    cache, filling it from the given region if necessary; or None if the blob
+    cache is not configured or cannot supply the file."""
+    blob_cache = current_app.tooltool_blob_cache
+    if not blob_cache:
+        return None
+    path = blob_cache.get(digest)
+    if not path:
+        s3 = current_app.aws.connect_to('s3', region)
+        bucket = s3.get_bucket(current_app.config['TOOLTOOL_REGIONS'][region],
+                               validate=False)
+        fill = blob_cache.fetch(digest, bucket)
+        if not fill:
+            return None
+        size, chunks = fill
+        return Response(chunks, mimetype='application/octet-stream',
+                        headers={'Content-Length': str(size)})
+    # the file may still be evicted by another thread before it is opened
+    try:
+        return send_file(path, mimetype='application/octet-stream')
+    except (IOError, OSError):
+        return None
+
+
+def init_app(app):
+    config = app.config.get('TOOLTOOL_BLOB_CACHE')
+    if config:
+        app.tooltool_blob_cache = BlobCache(config['directory'], config['size'])
+    else:
+        app.tooltool_blob_cache = None
@@ -0,0 +1,152 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import collections
+import threading
+import time
+
+import structlog
+from flask import current_app
+
+from relengapi.blueprints.tooltool import tables
+
+logger = structlog.get_logger()
+
+# Downloads of the same files are very common, so if TOOLTOOL_DOWNLOAD_CACHE
+# is set to a memcached configuration, download_file caches each file's
+# visibility and instance regions, along with the signed URLs it generates, in
+# memcached.  Each process also keeps recently-used entries in memory for a few
+# seconds, so a hot download needs neither a DB query nor a memcached request.
+#
+# Anything that changes a file's visibility or instances must call
+# `invalidate`.  That deletes the entries from memcached and from this
+# process's memory; other processes may use their in-memory copies for up to
+# LOCAL_CACHE_SECONDS longer.
+
+FILE_CACHE_SECONDS = 3600
+LOCAL_CACHE_SIZE = 1000
+LOCAL_CACHE_SECONDS = 5
+
+
+class LRUCache(object):
+
+    """A small, thread-safe, in-memory cache, discarding the least recently
+    used entry when full, and entries older than `ttl` seconds."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            self._entries[key] = expires, value
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self.lock:
+            self._entries.pop(key, None)
+            self._entries[key] = time.time() + ttl, value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self._entries.pop(key, None)
+
+
+class DownloadCache(object):
+
+    """A two-level cache: an LRUCache in front of memcached."""
+
+    def __init__(self, app, config):
+        self.app = app
+        self.config = config
+        self.local = LRUCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_SECONDS)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None:
+            with self.app.memcached.cache(self.config) as mc:
+                value = mc.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value, ttl):
+        with self.app.memcached.cache(self.config) as mc:
+            mc.set(key, value, time=ttl)
+        self.local.set(key, value, ttl)
+
+    def delete(self, keys):
+        with self.app.memcached.cache(self.config) as mc:
+            mc.delete_multi(keys)
+        for key in keys:
+            self.local.delete(key)
+
+
+def _file_key(digest):
+    # memcached keys must be str, not unicode
+    return str('tooltool:file:{}'.format(digest))
+
+
+def _url_key(digest, region):
+    return str('tooltool:url:{}:{}'.format(digest, region))
+
+
+def file_entry(digest):
+    """Return the visibility and the list of instance regions of the file with
+    the given digest, or None if it does not exist or has no instances."""
+    cache = current_app.tooltool_download_cache
+    if cache:
+        entry = cache.get(_file_key(digest))
+        if entry is not None:
+            return entry
+
+    tbl = tables.File
+    file_row = tbl.query.filter(tbl.sha512 == digest).first()
+    if not file_row or not file_row.instances:
+        return None
+    entry = file_row.visibility, sorted(i.region for i in file_row.instances)
+    if cache:
+        cache.set(_file_key(digest), entry, FILE_CACHE_SECONDS)
+    return entry
+
+
+def signed_url(digest, region, ttl, sign):
+    """Return a signed URL for the given file in the given region, calling
+    `sign` to generate one if there is no cached URL.  The URL is cached for
+    `ttl` seconds, which should leave the client ample time to use it."""
+    cache = current_app.tooltool_download_cache
+    if cache:
+        url = cache.get(_url_key(digest, region))
+        if url is not None:
+            return url
+    url = sign()
+    if cache:
+        cache.set(_url_key(digest, region), url, ttl)
+    return url
+
+
+def invalidate(digest):
+    """Forget any cached information about the file with the given digest."""
+    cache = current_app.tooltool_download_cache
+    if cache:
+        cache.delete([_file_key(digest)] +
+                     [_url_key(digest, region) for region in tables.allowed_regions])
+
+
+def init_app(app):
+    config = app.config.get('TOOLTOOL_DOWNLOAD_CACHE')
+    app.tooltool_download_cache = DownloadCache(app, config) if config else None
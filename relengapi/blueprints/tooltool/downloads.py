@@ -0,0 +1,165 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import atexit
+import os
+import threading
+import time
+
+import sqlalchemy as sa
+import structlog
+from flask import current_app
+
+from relengapi.blueprints.tooltool import tables
+from relengapi.lib import db
+from relengapi.lib.time import now
+
+logger = structlog.get_logger()
+
+# Each process counts the downloads it serves in memory, by file and region,
+# and adds the counts to the FileDownloads table in a single batch every
+# TOOLTOOL_DOWNLOAD_FLUSH_INTERVAL seconds, so that a download costs no more
+# than a dictionary update.  The batch is written by a background thread, with
+# a DB session of its own, which is started by the process's first download
+# (so that it runs in each worker of a pre-forking server), and once more when
+# the process exits.
+
+DEFAULT_FLUSH_INTERVAL = 60
+
+
+class DownloadCounter(object):
+
+    """Thread-safe in-memory download counts, with the time of the last
+    download, keyed by (digest, region)."""
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self._counts = {}
+        # the process in which the flushing thread is running
+        self._pid = None
+
+    def add(self, digest, region, count=1, last_access=None):
+        """Add to the count for the given file and region."""
+        last_access = last_access or now()
+        with self.lock:
+            old_count, old_last_access = self._counts.get((digest, region), (0, last_access))
+            self._counts[digest, region] = (old_count + count,
+                                            max(old_last_access, last_access))
+
+    def start(self, app):
+        """Start the thread that flushes the counts periodically, unless it is
+        already running in this process, and flush them when the process
+        exits."""
+        with self.lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # forked: the parent process writes its own counts
+                self._counts = {}
+            self._pid = os.getpid()
+        thd = threading.Thread(target=_flush_periodically, args=(app, self),
+                               name='tooltool-download-counts')
+        thd.daemon = True
+        thd.start()
+        atexit.register(flush_in_thread, app, self)
+
+    def take(self):
+        """Return the current counts, and start counting again from zero."""
+        with self.lock:
+            counts, self._counts = self._counts, {}
+        return counts
+
+
+def write_counts(session, counts):
+    """Add the given counts, as returned from DownloadCounter.take, to the
+    FileDownloads table, using one query for each of the files, the existing
+    rows, updates, and inserts.  Counts for unknown files are ignored."""
+    ids = dict(session.query(tables.File.sha512, tables.File.id).filter(
+        tables.File.sha512.in_(set(digest for digest, _ in counts))))
+    rows = [{'file_id': ids[digest], 'region': region, 'count': count,
+             'last_access': last_access}
+            for (digest, region), (count, last_access) in counts.iteritems()
+            if digest in ids]
+    if not rows:
+        return
+
+    dl_tbl = tables.FileDownloads
+    existing = set(session.query(dl_tbl.file_id, dl_tbl.region).filter(
+        dl_tbl.file_id.in_(set(r['file_id'] for r in rows))))
+    updates = [r for r in rows if (r['file_id'], r['region']) in existing]
+    inserts = [r for r in rows if (r['file_id'], r['region']) not in existing]
+
+    tbl = dl_tbl.__table__
+    if updates:
+        # bind parameters for executemany cannot share names with columns
+        last_access = sa.bindparam('b_last_access', type_=db.UTCDateTime)
+        update = tbl.update().where(sa.and_(
+            tbl.c.file_id == sa.bindparam('b_file_id'),
+            tbl.c.region == sa.bindparam('b_region')))
+        update = update.values(
+            count=tbl.c.count + sa.bindparam('b_count'),
+            last_access=sa.case([(tbl.c.last_access < last_access, last_access)],
+                                else_=tbl.c.last_access))
+        session.execute(update, [{'b_' + k: v for k, v in r.iteritems()} for r in updates])
+    if inserts:
+        session.execute(tbl.insert(), inserts)
+
+
+def flush(counter):
+    """Write the counts in the given counter to the DB.  If that fails, the
+    counts are kept for the next flush."""
+    counts = counter.take()
+    if not counts:
+        return
+    session = current_app.db.session(tables.DB_DECLARATIVE_BASE)
+    try:
+        try:
+            write_counts(session, counts)
+            session.commit()
+        except sa.exc.IntegrityError:
+            # another process inserted some of the same rows; they will be
+            # updated this time
+            session.rollback()
+            write_counts(session, counts)
+            session.commit()
+    except Exception:
+        session.rollback()
+        logger.exception("writing download counts failed")
+        for (digest, region), (count, last_access) in counts.iteritems():
+            counter.add(digest, region, count, last_access)
+        return
+    logger.info("wrote {} download counts".format(len(counts)))
+
+
+def flush_in_thread(app, counter):
+    """Flush the counts in the given counter, from a thread other than a
+    request's, with a DB session of that thread's own."""
+    with app.app_context():
+        session = app.db.session(tables.DB_DECLARATIVE_BASE)
+        try:
+            flush(counter)
+        finally:
+            # remove this thread's session, returning its connection to the pool
+            session.remove()
+
+
+def _flush_periodically(app, counter):
+    while True:
+        time.sleep(counter.flush_interval)
+        flush_in_thread(app, counter)
+
+
+def record(digest, region):
+    """Count a download of the given file from the given region."""
+    counter = current_app.tooltool_download_counter
+    counter.add(digest, region)
+    counter.start(current_app._get_current_object())
+
+
+def init_app(app):
+    app.tooltool_download_counter = DownloadCounter(
+        app.config.get('TOOLTOOL_DOWNLOAD_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL))
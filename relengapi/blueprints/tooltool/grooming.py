@@ -4,13 +4,18 @@
 
 from __future__ import absolute_import
 
+import functools
 import hashlib
+import Queue
 from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 
 import sqlalchemy as sa
 import structlog
+from boto.s3 import multipart
 from flask import current_app
 
+from relengapi.blueprints.tooltool import cache
 from relengapi.blueprints.tooltool import tables
 from relengapi.blueprints.tooltool import util
 from relengapi.lib import badpenny
@@ -20,24 +25,150 @@ from relengapi.lib import time
 logger = structlog.get_logger()
 
 
+# Verifying an upload requires reading and hashing the whole file, which can
+# take minutes for large files, so pending uploads are checked in parallel, by
+# up to this many threads per region (configurable with
+# TOOLTOOL_VERIFY_CONCURRENCY).
+DEFAULT_VERIFY_CONCURRENCY = 4
+
+# Replication copies up to this many objects at a time into each region
+# (configurable with TOOLTOOL_REPLICATION_CONCURRENCY), loading under-replicated
+# files from the DB in chunks of REPLICATION_CHUNK_SIZE.
+DEFAULT_REPLICATION_CONCURRENCY = 4
+REPLICATION_CHUNK_SIZE = 500
+
+# S3 cannot copy objects larger than 5GB in a single operation, so those are
+# copied in parts, several parts at a time.
+MULTIPART_COPY_THRESHOLD = 5 * 1024 ** 3
+MULTIPART_COPY_PART_SIZE = 512 * 1024 ** 2
+MULTIPART_COPY_CONCURRENCY = 4
+
+# Listing a bucket returns up to this many keys per request, so finding the
+# completed uploads by listing a region's bucket only beats looking for each
+# upload's key when there are more uploads to find than listing requests.
+LIST_KEYS_PER_REQUEST = 1000
+
+
 @badpenny.periodic_task(seconds=600)
 def check_pending_uploads(job_status):
     """Check for any pending uploads and verify them if found."""
     session = current_app.db.session(tables.DB_DECLARATIVE_BASE)
-    for pu in tables.PendingUpload.query.all():
-        check_pending_upload(session, pu)
+    now = time.now()
+    pending = {}
+    q = session.query(tables.PendingUpload.file_id, tables.PendingUpload.region,
+                      tables.PendingUpload.expires, tables.File.sha512)
+    for file_id, region, expires, sha512 in q.join(tables.File):
+        # (if the URL is not expired yet, there's nothing to check)
+        if now >= expires:
+            pending.setdefault(region, []).append((file_id, sha512, expires))
+    # the number of files in each region approximates the size of its bucket
+    instances = {}
+    if pending:
+        fi_tbl = tables.FileInstance
+        instances = dict(session.query(fi_tbl.region, sa.func.count('*'))
+                         .group_by(fi_tbl.region))
     session.commit()
 
+    # where there are enough pending uploads, rather than looking for each
+    # one's key, list the region's bucket once and only check the uploads
+    # that have arrived, along with those that will be deleted (abandoned, or
+    # to an un-configured region)
+    cfg = current_app.config.get('TOOLTOOL_REGIONS') or {}
+    by_region = {}
+    for region, uploads in pending.iteritems():
+        abandoned = set(file_id for file_id, _, expires in uploads
+                        if expires + timedelta(days=1) < now)
+        present = None
+        list_requests = instances.get(region, 0) // LIST_KEYS_PER_REQUEST + 1
+        if region in cfg and len(uploads) - len(abandoned) > list_requests:
+            try:
+                present = uploaded_digests(region)
+            except Exception:
+                logger.exception("listing the tooltool bucket in {} failed; checking "
+                                 "its pending uploads individually".format(region))
+        file_ids = [file_id for file_id, sha512, _ in uploads
+                    if present is None or file_id in abandoned or sha512 in present]
+        if file_ids:
+            by_region[region] = file_ids
+
+    concurrency = current_app.config.get('TOOLTOOL_VERIFY_CONCURRENCY',
+                                         DEFAULT_VERIFY_CONCURRENCY)
+    app = current_app._get_current_object()
+    pools = []
+    for region, file_ids in sorted(by_region.iteritems()):
+        pool = ThreadPool(min(concurrency, len(file_ids)))
+        pool.map_async(functools.partial(check_pending_upload_in_thread, app), file_ids)
+        pool.close()
+        pools.append(pool)
+    for pool in pools:
+        pool.join()
+
+
+def uploaded_digests(region):
+    """Return the set of digests of the files in the given region's bucket.
+    This lists the bucket, which takes one request per thousand files."""
+    cfg = current_app.config['TOOLTOOL_REGIONS']
+    s3 = current_app.aws.connect_to('s3', region)
+    bucket = s3.get_bucket(cfg[region], validate=False)
+    prefix = util.keyname('')
+    return set(key.name[len(prefix):] for key in bucket.list(prefix=prefix))
+
+
+def check_pending_upload_in_thread(app, file_id):
+    """Check the pending upload for the given file, in a thread of its own.
+    Each thread has its own DB session and S3 connection."""
+    with app.app_context():
+        session = app.db.session(tables.DB_DECLARATIVE_BASE)
+        try:
+            pu = session.query(tables.PendingUpload).get(file_id)
+            # (the pending upload may have been handled by a concurrent
+            # check_file_pending_uploads task)
+            if pu:
+                check_pending_upload(session, pu)
+            session.commit()
+        except Exception:
+            logger.exception("checking pending upload for file {} failed".format(file_id))
+            session.rollback()
+        finally:
+            # remove this thread's session, returning its connection to the pool
+            session.remove()
+
 
 @badpenny.periodic_task(seconds=3600)
 def replicate(job_status):
     """Replicate objects between regions as necessary"""
-    # fetch all files with at least one instance, but not a full complement
-    # of instances
+    session = current_app.db.session(tables.DB_DECLARATIVE_BASE)
+    backlog = _under_replicated_query(session).count()
+    concurrency = current_app.config.get('TOOLTOOL_REPLICATION_CONCURRENCY',
+                                         DEFAULT_REPLICATION_CONCURRENCY)
+    replicator = Replicator(current_app._get_current_object(), concurrency)
+    start = time.now()
+    try:
+        for files in _under_replicated_chunks(session):
+            for file in files:
+                replicate_file(session, file, replicator=replicator)
+            # commit before waiting for the copies, as replicate_file would
+            session.commit()
+            # keep at most about two chunks of copies in flight
+            replicator.wait(session, max_outstanding=REPLICATION_CHUNK_SIZE)
+    finally:
+        replicator.close(session)
+    session.commit()
+
+    elapsed = (time.now() - start).total_seconds()
+    rate = replicator.bytes / elapsed / 1024 / 1024 if elapsed else 0
+    job_status.log_message(
+        "{} files under-replicated; made {} copies ({} bytes, {:.1f} MB/s) "
+        "in {:.0f}s; {} copies failed; {} files under-replicated remain".format(
+            backlog, replicator.copied, replicator.bytes, rate, elapsed,
+            replicator.failed, _under_replicated_query(session).count()))
+
+
+def _under_replicated_query(session):
+    # files with at least one instance, but not a full complement of instances
     num_regions = len(current_app.config['TOOLTOOL_REGIONS'])
     fi_tbl = tables.FileInstance
     f_tbl = tables.File
-    session = current_app.db.session(tables.DB_DECLARATIVE_BASE)
     subq = session.query(
         fi_tbl.file_id,
         sa.func.count('*').label('instance_count'))
@@ -45,14 +176,82 @@ def replicate(job_status):
     subq = subq.subquery()
     q = session.query(f_tbl)
     q = q.join(subq, f_tbl.id == subq.c.file_id)
-    q = q.filter(subq.c.instance_count < num_regions)
-    q = q.all()
-    for file in q:
-        replicate_file(session, file)
-    session.commit()
+    return q.filter(subq.c.instance_count < num_regions)
 
 
-def replicate_file(session, file, _test_shim=lambda: None):
+def _under_replicated_chunks(session):
+    """Yield lists of under-replicated files, in order by id, rather than
+    loading them all at once."""
+    f_tbl = tables.File
+    last_id = 0
+    while True:
+        q = _under_replicated_query(session).filter(f_tbl.id > last_id)
+        q = q.options(sa.orm.subqueryload(f_tbl.instances))
+        files = q.order_by(f_tbl.id).limit(REPLICATION_CHUNK_SIZE).all()
+        if not files:
+            return
+        last_id = files[-1].id
+        yield files
+
+
+class Replicator(object):
+
+    """Copy files between regions, with a pool of up to `concurrency` threads
+    for each target region.  The copies are made in the pool threads, while the
+    resulting file instances are added by the thread calling `wait`."""
+
+    def __init__(self, app, concurrency):
+        self.app = app
+        self.concurrency = concurrency
+        self._pools = {}
+        self._results = Queue.Queue()
+        self.outstanding = 0
+        self.copied = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def copy(self, file, source_region, target_region):
+        if target_region not in self._pools:
+            self._pools[target_region] = ThreadPool(self.concurrency)
+        file_id, size = file.id, file.size
+
+        def done(success):
+            self._results.put((file_id, size, target_region, success))
+        self._pools[target_region].apply_async(
+            self._copy, (file.sha512, size, source_region, target_region), callback=done)
+        self.outstanding += 1
+
+    def _copy(self, sha512, size, source_region, target_region):
+        with self.app.app_context():
+            try:
+                copy_object(sha512, size, source_region, target_region)
+                return True
+            except Exception:
+                logger.exception("copying {} from {} to {} failed".format(
+                    sha512, source_region, target_region))
+                return False
+
+    def wait(self, session, max_outstanding=0):
+        """Wait until no more than `max_outstanding` copies are in progress,
+        adding a file instance for each successful copy."""
+        while self.outstanding > max_outstanding:
+            file_id, size, region, success = self._results.get()
+            self.outstanding -= 1
+            if not success:
+                self.failed += 1
+                continue
+            self.copied += 1
+            self.bytes += size
+            add_file_instance(session, session.query(tables.File).get(file_id), region)
+
+    def close(self, session):
+        self.wait(session)
+        for pool in self._pools.itervalues():
+            pool.close()
+            pool.join()
+
+
+def replicate_file(session, file, _test_shim=lambda: None, replicator=None):
     log = logger.bind(tooltool_sha512=file.sha512, mozdef=True)
     config = current_app.config['TOOLTOOL_REGIONS']
     regions = set(config)
@@ -66,31 +265,76 @@ def replicate_file(session, file, _test_shim=lambda: None):
         log.warning("no source regions for {}".format(file.sha512))
         return
     source_region = source_regions.pop()
-    source_bucket = config[source_region]
     target_regions = regions - file_regions
     log.info("replicating {} from {} to {}".format(
         file.sha512, source_region, ', '.join(target_regions)))
 
-    key_name = util.keyname(file.sha512)
     for target_region in target_regions:
-        target_bucket = config[target_region]
-        conn = current_app.aws.connect_to('s3', target_region)
-        bucket = conn.get_bucket(target_bucket)
+        if replicator:
+            replicator.copy(file, source_region, target_region)
+            continue
 
         # commit the session before replicating, since the DB connection may
         # otherwise go away while we're distracted.
         session.commit()
         _test_shim()
+        copy_object(file.sha512, file.size, source_region, target_region)
+        add_file_instance(session, file, target_region)
+
+
+def copy_object(sha512, size, source_region, target_region):
+    """Copy the object for the given file from one region's bucket to
+    another's, using a multipart copy for objects too large to copy at once."""
+    config = current_app.config['TOOLTOOL_REGIONS']
+    key_name = util.keyname(sha512)
+    if size > MULTIPART_COPY_THRESHOLD:
+        multipart_copy(target_region, key_name, config[source_region], size)
+    else:
+        conn = current_app.aws.connect_to('s3', target_region)
+        bucket = conn.get_bucket(config[target_region])
         bucket.copy_key(new_key_name=key_name,
                         src_key_name=key_name,
-                        src_bucket_name=source_bucket,
+                        src_bucket_name=config[source_region],
                         storage_class='STANDARD',
                         preserve_acl=False)
-        try:
-            session.add(tables.FileInstance(file=file, region=target_region))
-            session.commit()
-        except sa.exc.IntegrityError:
-            session.rollback()
+
+
+def multipart_copy(region, key_name, src_bucket_name, size):
+    """Copy the given key from another bucket into the given region's bucket
+    in parts of MULTIPART_COPY_PART_SIZE bytes, several at a time."""
+    aws = current_app.aws
+    bucket_name = current_app.config['TOOLTOOL_REGIONS'][region]
+    mp = aws.connect_to('s3', region).get_bucket(bucket_name).initiate_multipart_upload(key_name)
+    parts = [(num, first, min(first + MULTIPART_COPY_PART_SIZE, size) - 1)
+             for num, first in enumerate(xrange(0, size, MULTIPART_COPY_PART_SIZE), 1)]
+
+    def copy_part(part):
+        # each pool thread copies over its own connection
+        num, first, last = part
+        bucket = aws.connect_to('s3', region).get_bucket(bucket_name, validate=False)
+        thread_mp = multipart.MultiPartUpload(bucket)
+        thread_mp.key_name, thread_mp.id = mp.key_name, mp.id
+        thread_mp.copy_part_from_key(src_bucket_name, key_name, num, first, last)
+    pool = ThreadPool(min(MULTIPART_COPY_CONCURRENCY, len(parts)))
+    try:
+        pool.map(copy_part, parts)
+        mp.complete_upload()
+    except Exception:
+        mp.cancel_upload()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+
+def add_file_instance(session, file, region):
+    # add a file instance, but it's OK if it already exists
+    try:
+        session.add(tables.FileInstance(file=file, region=region))
+        session.commit()
+    except sa.exc.IntegrityError:
+        session.rollback()
+    cache.invalidate(file.sha512)
 
 
 @celery.task
@@ -194,6 +438,7 @@ def check_pending_upload(session, pu, _test_shim=lambda: None):
         session.commit()
     except sa.exc.IntegrityError:
         session.rollback()
+    cache.invalidate(sha512)
 
     # and delete the pending upload
     session.delete(pu)
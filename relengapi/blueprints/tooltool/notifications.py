@@ -0,0 +1,83 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import functools
+import json
+import math
+import urllib
+
+import structlog
+from boto.sqs.message import RawMessage
+from flask import current_app
+
+from relengapi.blueprints.tooltool import grooming
+from relengapi.blueprints.tooltool import tables
+from relengapi.blueprints.tooltool import util
+from relengapi.lib import time
+
+logger = structlog.get_logger()
+
+# The tooltool buckets can be configured to send S3 ObjectCreated event
+# notifications to an SQS queue in each region.  The `relengapi sqs-listen`
+# process reads those queues, and schedules verification of each uploaded file
+# for the moment its upload URL expires, rather than waiting for the client to
+# call upload_complete or for the next check_pending_uploads run.
+
+
+def uploaded_objects(event):
+    """Yield (digest, region) for each tooltool object created in the given S3
+    event notification.  Objects in other buckets or keyspaces are ignored, as
+    are S3 test events (which have no records)."""
+    regions = dict((bucket, region) for region, bucket
+                   in current_app.config['TOOLTOOL_REGIONS'].iteritems())
+    prefix = util.keyname('')
+    for record in event.get('Records', []):
+        if not record.get('eventName', '').startswith('ObjectCreated:'):
+            continue
+        s3 = record.get('s3', {})
+        region = regions.get(s3.get('bucket', {}).get('name'))
+        # keys are URL-encoded in event notifications
+        key = urllib.unquote_plus(s3.get('object', {}).get('key', '').encode('utf-8'))
+        if region and key.startswith(prefix):
+            yield key[len(prefix):], region
+
+
+def schedule_verification(sha512, region):
+    """Schedule a check of the pending upload of the given file to the given
+    region, to run as soon as its upload URL expires."""
+    log = logger.bind(tooltool_sha512=sha512, mozdef=True)
+    file = tables.File.query.filter(tables.File.sha512 == sha512).first()
+    pending_uploads = [pu for pu in file.pending_uploads
+                       if pu.region == region] if file else []
+    if not pending_uploads:
+        log.info("Ignoring notification of upload of {} to {} with no pending "
+                 "upload".format(sha512, region))
+        return
+    # add 1 second to avoid rounding / skew errors, as for upload_complete
+    until = max((pu.expires - time.now()).total_seconds() for pu in pending_uploads)
+    countdown = int(math.ceil(max(0, until))) + 1
+    log.info("Scheduling verification of upload of {} to {} in {}s".format(
+        sha512, region, countdown))
+    grooming.check_file_pending_uploads.apply_async((sha512,), countdown=countdown)
+
+
+def handle_notification(app, msg):
+    """Handle an SQS message containing an S3 event notification."""
+    with app.app_context():
+        session = app.db.session(tables.DB_DECLARATIVE_BASE)
+        try:
+            for sha512, region in uploaded_objects(json.loads(msg.get_body())):
+                schedule_verification(sha512, region)
+        finally:
+            # remove the listener thread's session, as a request would
+            session.remove()
+
+
+def init_app(app):
+    queues = app.config.get('TOOLTOOL_UPLOAD_NOTIFICATION_QUEUES', {})
+    for region, queue_name in queues.iteritems():
+        app.aws.sqs_listen(region, queue_name, message_class=RawMessage)(
+            functools.partial(handle_notification, app))
@@ -0,0 +1,166 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+import structlog
+from flask import current_app
+
+from relengapi.blueprints.tooltool import tables
+from relengapi.lib import subcommands
+
+logger = structlog.get_logger()
+
+# Searches for substrings of batch authors, messages and filenames use an index
+# of the trigrams (three-character substrings, lower-cased) in each.  A
+# substring can only occur in text that contains all of its trigrams, so the
+# index narrows the search to a few candidates, which are then checked for the
+# substring itself.  Queries of fewer than three characters have no trigrams,
+# and are matched against every row.
+#
+# The index is maintained as batches are uploaded, and the Alembic migration
+# that adds it indexes the existing batches (except offline); `relengapi
+# tooltool-search-index` rebuilds it.
+
+DEFAULT_PER_PAGE = 100
+MAX_PER_PAGE = 1000
+
+
+def trigrams(text):
+    text = text.lower()
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+def index_rows(batch_id, author, message, files):
+    """Return the index rows for a batch, given its author, message, and a list
+    of (filename, file_id) pairs for its files."""
+    texts = [('author', author, None), ('message', message, None)]
+    texts.extend(('filename', filename, file_id) for filename, file_id in files)
+    return [{'trigram': trigram, 'field': field, 'batch_id': batch_id, 'file_id': file_id}
+            for field, text, file_id in texts
+            for trigram in trigrams(text)]
+
+
+def index_batch(session, batch):
+    """Add index rows for a new batch and its filenames.  The caller must
+    commit the session."""
+    session.flush()
+    rows = index_rows(batch.id, batch.author, batch.message,
+                      [(bf.filename, bf.file_id) for bf in batch._files])
+    if rows:
+        session.execute(tables.SearchTrigram.__table__.insert(), rows)
+
+
+def _candidates(session, q, fields, *columns):
+    """Query for the values of `columns` for which the index has every trigram
+    in `q`, in any of the given fields; or None if `q` has no trigrams."""
+    q_trigrams = trigrams(q)
+    if not q_trigrams:
+        return None
+    tbl = tables.SearchTrigram
+    query = session.query(*columns)
+    query = query.filter(tbl.trigram.in_(q_trigrams), tbl.field.in_(fields))
+    query = query.group_by(*columns)
+    return query.having(sa.func.count(sa.distinct(tbl.trigram)) == len(q_trigrams))
+
+
+def _page(query, page, per_page):
+    # without either parameter, return every result, as searches did before
+    # they were paginated
+    if page is None and per_page is None:
+        return query
+    page = 1 if page is None else page
+    per_page = DEFAULT_PER_PAGE if per_page is None else per_page
+    per_page = min(max(per_page, 1), MAX_PER_PAGE)
+    return query.limit(per_page).offset((max(page, 1) - 1) * per_page)
+
+
+def search_batches(session, q, page=None, per_page=None):
+    """Return the batches (or a page of them) with an author or message containing `q`.
+    Batches matching in both come first, then the most recent."""
+    tbl = tables.Batch
+    query = session.query(tbl)
+    candidates = _candidates(session, q, ['author', 'message'],
+                             tables.SearchTrigram.batch_id)
+    if candidates is not None:
+        query = query.filter(tbl.id.in_(candidates.subquery()))
+    in_author = tbl.author.contains(q)
+    in_message = tbl.message.contains(q)
+    query = query.filter(sa.or_(in_author, in_message))
+    rank = (sa.case([(in_author, 1)], else_=0) +
+            sa.case([(in_message, 1)], else_=0))
+    query = query.order_by(rank.desc(), tbl.uploaded.desc(), tbl.id.desc())
+    return _page(query, page, per_page).all()
+
+
+def search_files(session, q, page=None, per_page=None):
+    """Return the files (or a page of them) with a digest beginning with `q`, or with a
+    filename containing `q`.  Digest matches come first, then the most recently
+    added files."""
+    bf_tbl = tables.BatchFile
+    f_tbl = tables.File
+    candidates = _candidates(session, q, ['filename'], tables.SearchTrigram.batch_id,
+                             tables.SearchTrigram.file_id)
+    by_filename = session.query(bf_tbl.file_id)
+    if candidates is not None:
+        candidates = candidates.subquery()
+        by_filename = by_filename.join(candidates, sa.and_(
+            bf_tbl.batch_id == candidates.c.batch_id,
+            bf_tbl.file_id == candidates.c.file_id))
+    by_filename = by_filename.filter(bf_tbl.filename.contains(q))
+    by_digest = session.query(f_tbl.id).filter(f_tbl.sha512.startswith(q))
+    ids = by_filename.union(by_digest).subquery()
+
+    query = session.query(f_tbl).filter(f_tbl.id.in_(ids))
+    rank = sa.case([(f_tbl.sha512.startswith(q), 1)], else_=0)
+    query = query.order_by(rank.desc(), f_tbl.id.desc())
+    return _page(query, page, per_page).all()
+
+
+def rebuild_index(conn):
+    """Rebuild the whole search index, reading the batches 100 at a time, and
+    return the number of batches indexed.  The old index rows are deleted and
+    the new ones inserted in the connection's current transaction, so until
+    the caller commits, searches continue to use the old index."""
+    b_tbl = tables.Batch.__table__
+    bf_tbl = tables.BatchFile.__table__
+    st_tbl = tables.SearchTrigram.__table__
+    conn.execute(st_tbl.delete())
+    last_id = 0
+    count = 0
+    while True:
+        batches = conn.execute(
+            sa.select([b_tbl.c.id, b_tbl.c.author, b_tbl.c.message])
+            .where(b_tbl.c.id > last_id).order_by(b_tbl.c.id).limit(100)).fetchall()
+        if not batches:
+            break
+        files = {}
+        for batch_id, filename, file_id in conn.execute(
+                sa.select([bf_tbl.c.batch_id, bf_tbl.c.filename, bf_tbl.c.file_id])
+                .where(bf_tbl.c.batch_id.in_([b.id for b in batches]))):
+            files.setdefault(batch_id, []).append((filename, file_id))
+        rows = []
+        for b in batches:
+            rows.extend(index_rows(b.id, b.author, b.message, files.get(b.id, [])))
+        if rows:
+            conn.execute(st_tbl.insert(), rows)
+        last_id = batches[-1].id
+        count += len(batches)
+    return count
+
+
+class TooltoolSearchIndexSubcommand(subcommands.Subcommand):
+
+    def make_parser(self, subparsers):
+        parser = subparsers.add_parser(
+            'tooltool-search-index',
+            help='Rebuild the tooltool search index for all upload batches')
+        return parser
+
+    def run(self, parser, args):
+        session = current_app.db.session(tables.DB_DECLARATIVE_BASE)
+        count = rebuild_index(session.connection())
+        session.commit()
+        logger.info("indexed %d upload batches" % count)
@@ -57,6 +57,24 @@ class FileInstance(db.declarative_base(DB_DECLARATIVE_BASE)):
         sa.Enum(*allowed_regions), primary_key=True)
 
 
+class FileDownloads(db.declarative_base(DB_DECLARATIVE_BASE)):
+
+    """The number of times a file has been downloaded from a single region,
+    and when it was last downloaded.  Downloads are counted in memory and
+    added to this table in batches, so it may lag behind by a few minutes."""
+
+    __tablename__ = 'releng_tooltool_file_downloads'
+
+    file_id = sa.Column(
+        sa.Integer, sa.ForeignKey('releng_tooltool_files.id'), primary_key=True)
+    region = sa.Column(
+        sa.Enum(*allowed_regions), primary_key=True)
+    count = sa.Column(sa.Integer, nullable=False)
+    last_access = sa.Column(db.UTCDateTime, index=True, nullable=False)
+
+    file = sa.orm.relationship('File', backref='downloads')
+
+
 class BatchFile(db.declarative_base(DB_DECLARATIVE_BASE)):
 
     """An association of upload batches to files, with filenames"""
@@ -97,6 +115,27 @@ class Batch(db.declarative_base(DB_DECLARATIVE_BASE)):
             files={n: f.to_json() for n, f in self.files.iteritems()})
 
 
+class SearchTrigram(db.declarative_base(DB_DECLARATIVE_BASE)):
+
+    """A search index of the trigrams (three-character substrings) in batch
+    authors, messages, and filenames.  Rows for filenames also identify the
+    file."""
+
+    __tablename__ = 'releng_tooltool_search_trigrams'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    trigram = sa.Column(sa.Unicode(3), nullable=False)
+    field = sa.Column(sa.Enum('author', 'message', 'filename'), nullable=False)
+    batch_id = sa.Column(sa.Integer, sa.ForeignKey('releng_tooltool_batches.id'),
+                         nullable=False, index=True)
+    file_id = sa.Column(sa.Integer, sa.ForeignKey('releng_tooltool_files.id'),
+                        nullable=True)
+
+    __table_args__ = (
+        sa.Index('ix_releng_tooltool_search_trigrams_trigram', 'trigram', 'field'),
+    )
+
+
 class PendingUpload(db.declarative_base(DB_DECLARATIVE_BASE)):
 
     """Files for which upload URLs have been generated, but which haven't yet
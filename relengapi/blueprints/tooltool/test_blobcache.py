@@ -0,0 +1,251 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import fcntl
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import mock
+from nose.tools import assert_raises
+from nose.tools import eq_
+
+from relengapi.blueprints.tooltool import blobcache
+from relengapi.blueprints.tooltool import util
+
+ONE = 'one' * 10
+ONE_DIGEST = hashlib.sha512(ONE).hexdigest()
+TWO = 'two' * 10
+TWO_DIGEST = hashlib.sha512(TWO).hexdigest()
+THREE = 'three' * 6
+THREE_DIGEST = hashlib.sha512(THREE).hexdigest()
+
+
+@contextmanager
+def temp_dir():
+    directory = tempfile.mkdtemp()
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory)
+
+
+class FakeKey(object):
+
+    def __init__(self, data, block=None):
+        self.data = data
+        self.size = len(data)
+        self.block = block
+
+    def read(self, size):
+        if self.block:
+            self.block.wait()
+        rv, self.data = self.data[:size], self.data[size:]
+        return rv
+
+
+def fake_bucket(contents, block=None):
+    bucket = mock.Mock(name='bucket')
+    bucket.name = 'tt-use1'
+
+    def get_key(keyname):
+        for data in contents:
+            if util.keyname(hashlib.sha512(data).hexdigest()) == keyname:
+                return FakeKey(data, block)
+    bucket.get_key.side_effect = get_key
+    return bucket
+
+
+def write_blob(directory, data, mtime=None):
+    digest = hashlib.sha512(data).hexdigest()
+    os.makedirs(os.path.join(directory, digest[:2]))
+    path = os.path.join(directory, digest[:2], digest)
+    open(path, 'w').write(data)
+    if mtime:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def cached_files(directory):
+    return sorted(f for _, _, files in os.walk(directory) for f in files if f != '.lock')
+
+
+def test_fetch():
+    """fetch downloads a file from the bucket into the cache, streaming it as
+    it does so; the file is then found there"""
+    with temp_dir() as directory:
+        cache = blobcache.BlobCache(directory, 1000)
+        bucket = fake_bucket([ONE])
+        size, chunks = cache.fetch(ONE_DIGEST, bucket)
+        eq_(size, len(ONE))
+        eq_(''.join(chunks), ONE)
+        path = cache.get(ONE_DIGEST)
+        eq_(path, os.path.join(directory, ONE_DIGEST[:2], ONE_DIGEST))
+        eq_(open(path).read(), ONE)
+        eq_(cached_files(directory), [ONE_DIGEST])
+
+
+def test_fetch_not_cacheable():
+    """fetch returns None, leaving nothing on disk, for a missing file or a
+    file larger than the cache"""
+    with temp_dir() as directory:
+        cache = blobcache.BlobCache(directory, 40)
+        bucket = fake_bucket([])
+        bucket.get_key.side_effect = None
+        bucket.get_key.return_value = None
+        eq_(cache.fetch(ONE_DIGEST, bucket), None)
+        bucket.get_key.return_value = FakeKey('x' * 41)
+        eq_(cache.fetch(hashlib.sha512('x' * 41).hexdigest(), bucket), None)
+        eq_(cached_files(directory), [])
+
+
+def test_fetch_wrong_digest():
+    """A stream of a file with the wrong digest fails before its last chunk,
+    and nothing is left on disk"""
+    with temp_dir() as directory:
+        cache = blobcache.BlobCache(directory, 1000)
+        bucket = fake_bucket([])
+        bucket.get_key.side_effect = None
+        bucket.get_key.return_value = FakeKey(TWO)
+        with mock.patch('relengapi.blueprints.tooltool.blobcache.FILL_CHUNK_SIZE', 10):
+            size, chunks = cache.fetch(ONE_DIGEST, bucket)
+            received = []
+            with assert_raises(IOError):
+                for chunk in chunks:
+                    received.append(chunk)
+        eq_(''.join(received), TWO[:20])
+        eq_(cached_files(directory), [])
+
+
+def test_fetch_single_flight():
+    """Concurrent fetches of the same file download it only once, and all
+    stream it as it is downloaded"""
+    with temp_dir() as directory:
+        cache = blobcache.BlobCache(directory, 1000)
+        block = threading.Event()
+        bucket = fake_bucket([ONE], block=block)
+        results = []
+
+        def fetch():
+            size, chunks = cache.fetch(ONE_DIGEST, bucket)
+            results.append(''.join(chunks))
+        with mock.patch.object(cache, '_fill', wraps=cache._fill) as fill:
+            threads = [threading.Thread(target=fetch) for _ in range(4)]
+            for thd in threads:
+                thd.start()
+            # wait until every thread is following the first one's download
+            while bucket.get_key.call_count < 4:
+                time.sleep(0.01)
+            block.set()
+            for thd in threads:
+                thd.join()
+        eq_(results, [ONE] * 4)
+        eq_(fill.call_count, 1)
+
+
+def test_fetch_other_process():
+    """A fetch of a file that another process is downloading follows that
+    download, rather than starting its own"""
+    with temp_dir() as directory:
+        cache = blobcache.BlobCache(directory, 1000)
+        os.makedirs(os.path.dirname(cache.path(ONE_DIGEST)))
+        part = cache.path(ONE_DIGEST) + '.part'
+        # (each open file has its own lock, even in the same process)
+        other = open(part, 'w')
+        fcntl.flock(other, fcntl.LOCK_EX)
+        with mock.patch.object(cache, '_fill') as fill:
+            size, chunks = cache.fetch(ONE_DIGEST, fake_bucket([ONE]))
+        eq_(fill.call_count, 0)
+        other.write(ONE[:10])
+        other.flush()
+        eq_(next(chunks), ONE[:10])
+        other.write(ONE[10:])
+        other.flush()
+        os.rename(part, cache.path(ONE_DIGEST))
+        other.close()
+        eq_(''.join(chunks), ONE[10:])
+
+
+def test_fetch_interrupted():
+    """A fetch replaces a part file left behind by an interrupted download"""
+    with temp_dir() as directory:
+        cache = blobcache.BlobCache(directory, 1000)
+        os.makedirs(os.path.dirname(cache.path(ONE_DIGEST)))
+        open(cache.path(ONE_DIGEST) + '.part', 'w').write('junk')
+        size, chunks = cache.fetch(ONE_DIGEST, fake_bucket([ONE]))
+        eq_(''.join(chunks), ONE)
+        eq_(open(cache.path(ONE_DIGEST)).read(), ONE)
+
+
+def test_follow_stalled():
+    """A stream gives up if the download it follows makes no progress"""
+    with temp_dir() as directory:
+        cache = blobcache.BlobCache(directory, 1000)
+        os.makedirs(os.path.dirname(cache.path(ONE_DIGEST)))
+        part = cache.path(ONE_DIGEST) + '.part'
+        open(part, 'w').write(ONE[:10])
+        with mock.patch('relengapi.blueprints.tooltool.blobcache.FOLLOW_TIMEOUT', -1):
+            chunks = cache._follow(ONE_DIGEST, io.open(part, 'rb'), len(ONE))
+            eq_(next(chunks), ONE[:10])
+            assert_raises(IOError, next, chunks)
+
+
+def test_eviction():
+    """Before a file is downloaded, the least recently used files are deleted
+    to make room for it"""
+    with temp_dir() as directory:
+        now = time.time()
+        cache = blobcache.BlobCache(directory, 70)
+        write_blob(directory, ONE, mtime=now - 20)
+        write_blob(directory, TWO, mtime=now - 10)
+        cache.get(ONE_DIGEST)
+        size, chunks = cache.fetch(THREE_DIGEST, fake_bucket([THREE]))
+        eq_(''.join(chunks), THREE)
+        eq_(cache.get(TWO_DIGEST), None)
+        assert not os.path.exists(cache.path(TWO_DIGEST))
+        eq_(cache.get(ONE_DIGEST), cache.path(ONE_DIGEST))
+        eq_(cache.get(THREE_DIGEST), cache.path(THREE_DIGEST))
+
+
+def test_init_evicts():
+    """A new cache evicts the least recently used files if the directory is too
+    large, and removes stale part files"""
+    with temp_dir() as directory:
+        now = time.time()
+        write_blob(directory, ONE, mtime=now - 30)
+        write_blob(directory, TWO, mtime=now - 20)
+        write_blob(directory, THREE, mtime=now - 10)
+        stale = os.path.join(directory, TWO_DIGEST[:2], TWO_DIGEST + '.part')
+        open(stale, 'w').write('junk')
+        os.utime(stale, (0, 0))
+        fresh = os.path.join(directory, THREE_DIGEST[:2], THREE_DIGEST + '.part')
+        open(fresh, 'w').write('junk')
+
+        blobcache.BlobCache(directory, 70)
+        eq_(cached_files(directory),
+            sorted([TWO_DIGEST, THREE_DIGEST, THREE_DIGEST + '.part']))
+
+
+def test_get_deleted():
+    """get returns None for a file deleted by another process"""
+    with temp_dir() as directory:
+        cache = blobcache.BlobCache(directory, 1000)
+        write_blob(directory, ONE)
+        eq_(cache.get(ONE_DIGEST), cache.path(ONE_DIGEST))
+        os.unlink(cache.path(ONE_DIGEST))
+        eq_(cache.get(ONE_DIGEST), None)
+
+
+def test_init_creates_directory():
+    """A cache creates its directory if it does not exist"""
+    with temp_dir() as directory:
+        cache = blobcache.BlobCache(os.path.join(directory, 'blobs'), 1000)
+        assert os.path.isdir(cache.directory)
@@ -0,0 +1,154 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import hashlib
+from contextlib import contextmanager
+
+import mock
+from flask import current_app
+from nose.tools import eq_
+
+from relengapi.blueprints.tooltool import cache
+from relengapi.blueprints.tooltool import tables
+from relengapi.lib.testing.context import TestContext
+
+DATA_DIGEST = hashlib.sha512('data').hexdigest()
+
+NOW = 1425592922
+
+cfg = {
+    'TOOLTOOL_REGIONS': {
+        'us-east-1': 'tt-use1',
+        'us-west-2': 'tt-usw2',
+    },
+    'TOOLTOOL_DOWNLOAD_CACHE': 'mock://tooltool',
+}
+test_context = TestContext(config=cfg, databases=[tables.DB_DECLARATIVE_BASE])
+
+
+@contextmanager
+def set_time(now=NOW):
+    with mock.patch('time.time') as fake:
+        fake.return_value = now
+        yield
+
+
+def add_file_row(regions, visibility='public'):
+    session = current_app.db.session(tables.DB_DECLARATIVE_BASE)
+    file_row = tables.File(size=4, visibility=visibility, sha512=DATA_DIGEST)
+    session.add(file_row)
+    for region in regions:
+        session.add(tables.FileInstance(file=file_row, region=region))
+    session.commit()
+    return file_row
+
+
+def test_lru_evicts_least_recently_used():
+    """LRUCache discards the least recently used entry when full"""
+    lru = cache.LRUCache(2, 10)
+    with set_time():
+        lru.set('a', 1)
+        lru.set('b', 2)
+        eq_(lru.get('a'), 1)
+        lru.set('c', 3)
+        eq_((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+
+
+def test_lru_expires():
+    """LRUCache entries expire after the cache's ttl, or a shorter ttl given
+    to set"""
+    lru = cache.LRUCache(10, 10)
+    with set_time():
+        lru.set('a', 1)
+        lru.set('b', 2, ttl=60)
+        lru.set('c', 3, ttl=5)
+    with set_time(NOW + 6):
+        eq_((lru.get('a'), lru.get('b'), lru.get('c')), (1, 2, None))
+    with set_time(NOW + 11):
+        eq_((lru.get('a'), lru.get('b')), (None, None))
+
+
+def test_lru_delete():
+    """LRUCache.delete removes an entry, if present"""
+    lru = cache.LRUCache(10, 10)
+    lru.set('a', 1)
+    lru.delete('a')
+    lru.delete('b')
+    eq_(lru.get('a'), None)
+
+
+@test_context
+def test_download_cache_memcached(app):
+    """DownloadCache gets entries from memcached when they are not in memory,
+    keeping them in memory afterward"""
+    with app.app_context():
+        dc = app.tooltool_download_cache
+        with app.memcached.cache('mock://tooltool') as mc:
+            mc.set('k', 'v')
+        eq_(dc.local.get('k'), None)
+        eq_(dc.get('k'), 'v')
+        eq_(dc.local.get('k'), 'v')
+
+
+@test_context
+def test_file_entry_cached(app):
+    """file_entry caches the file's visibility and instance regions"""
+    with app.app_context():
+        add_file_row(['us-west-2', 'us-east-1'])
+        eq_(cache.file_entry(DATA_DIGEST), ('public', ['us-east-1', 'us-west-2']))
+        tables.FileInstance.query.delete()
+        eq_(cache.file_entry(DATA_DIGEST), ('public', ['us-east-1', 'us-west-2']))
+
+
+@test_context
+def test_file_entry_no_instances(app):
+    """file_entry returns None, and caches nothing, for a file that does not
+    exist or has no instances"""
+    with app.app_context():
+        eq_(cache.file_entry(DATA_DIGEST), None)
+        add_file_row([])
+        eq_(cache.file_entry(DATA_DIGEST), None)
+        session = app.db.session(tables.DB_DECLARATIVE_BASE)
+        session.add(tables.FileInstance(file=tables.File.query.first(), region='us-east-1'))
+        session.commit()
+        eq_(cache.file_entry(DATA_DIGEST), ('public', ['us-east-1']))
+
+
+@test_context.specialize(config={'TOOLTOOL_REGIONS': cfg['TOOLTOOL_REGIONS']})
+def test_file_entry_no_cache(app):
+    """Without TOOLTOOL_DOWNLOAD_CACHE, file_entry always queries the DB"""
+    with app.app_context():
+        eq_(app.tooltool_download_cache, None)
+        add_file_row(['us-east-1'])
+        eq_(cache.file_entry(DATA_DIGEST), ('public', ['us-east-1']))
+        tables.FileInstance.query.delete()
+        eq_(cache.file_entry(DATA_DIGEST), None)
+
+
+@test_context
+def test_signed_url(app):
+    """signed_url calls sign only when there is no cached URL"""
+    with app.app_context():
+        sign = mock.Mock(side_effect=['url1', 'url2'])
+        with set_time():
+            eq_(cache.signed_url(DATA_DIGEST, 'us-east-1', 30, sign), 'url1')
+            eq_(cache.signed_url(DATA_DIGEST, 'us-east-1', 30, sign), 'url1')
+            eq_(cache.signed_url(DATA_DIGEST, 'us-west-2', 30, sign), 'url2')
+        eq_(sign.call_count, 2)
+
+
+@test_context
+def test_invalidate(app):
+    """invalidate forgets the file entry and signed URLs for a file, in memory
+    and in memcached"""
+    with app.app_context():
+        add_file_row(['us-east-1'])
+        cache.file_entry(DATA_DIGEST)
+        cache.signed_url(DATA_DIGEST, 'us-east-1', 30, lambda: 'url1')
+        tables.FileInstance.query.delete()
+        cache.invalidate(DATA_DIGEST)
+        eq_(cache.file_entry(DATA_DIGEST), None)
+        eq_(cache.signed_url(DATA_DIGEST, 'us-east-1', 30, lambda: 'url2'), 'url2')
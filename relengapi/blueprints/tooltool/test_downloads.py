@@ -0,0 +1,183 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import datetime
+import hashlib
+from contextlib import contextmanager
+
+import mock
+import pytz
+import sqlalchemy as sa
+from flask import current_app
+from nose.tools import eq_
+
+from relengapi.blueprints.tooltool import downloads
+from relengapi.blueprints.tooltool import tables
+from relengapi.lib.testing.context import TestContext
+
+ONE_DIGEST = hashlib.sha512('one').hexdigest()
+TWO_DIGEST = hashlib.sha512('two').hexdigest()
+
+NOW = 1425592922
+T0 = datetime.datetime.fromtimestamp(NOW, pytz.UTC)
+T1 = T0 + datetime.timedelta(seconds=10)
+T2 = T0 + datetime.timedelta(seconds=20)
+
+test_context = TestContext(databases=[tables.DB_DECLARATIVE_BASE])
+
+
+@contextmanager
+def set_time(now=NOW):
+    with mock.patch('time.time') as fake_time, \
+            mock.patch('relengapi.blueprints.tooltool.downloads.now') as fake_now:
+        fake_time.return_value = now
+        fake_now.return_value = datetime.datetime.fromtimestamp(now, pytz.UTC)
+        yield
+
+
+def add_file_rows(*digests):
+    session = current_app.db.session(tables.DB_DECLARATIVE_BASE)
+    files = [tables.File(size=3, visibility='public', sha512=digest) for digest in digests]
+    session.add_all(files)
+    session.commit()
+    return [f.id for f in files]
+
+
+def download_rows():
+    return sorted((r.file.sha512, r.region, r.count, r.last_access)
+                  for r in tables.FileDownloads.query.all())
+
+
+def test_counter_add():
+    """DownloadCounter aggregates counts and the latest access time"""
+    counter = downloads.DownloadCounter(60)
+    counter.add(ONE_DIGEST, 'us-east-1', last_access=T1)
+    counter.add(ONE_DIGEST, 'us-east-1', count=2, last_access=T0)
+    counter.add(ONE_DIGEST, 'us-west-2', last_access=T0)
+    eq_(counter.take(), {
+        (ONE_DIGEST, 'us-east-1'): (3, T1),
+        (ONE_DIGEST, 'us-west-2'): (1, T0),
+    })
+    eq_(counter.take(), {})
+
+
+def test_counter_start():
+    """DownloadCounter.start starts one flushing thread per process, and
+    flushes the counts at exit"""
+    counter = downloads.DownloadCounter(60)
+    app = mock.Mock(name='app')
+    with mock.patch('threading.Thread') as Thread, \
+            mock.patch('atexit.register') as register, \
+            mock.patch('os.getpid', return_value=100):
+        counter.start(app)
+        counter.start(app)
+        eq_(Thread.call_count, 1)
+        eq_(Thread.call_args[1]['args'], (app, counter))
+        register.assert_called_once_with(downloads.flush_in_thread, app, counter)
+        counter.add(ONE_DIGEST, 'us-east-1', last_access=T0)
+    # a forked child starts its own thread, without its parent's counts
+    with mock.patch('threading.Thread') as Thread, \
+            mock.patch('atexit.register'), \
+            mock.patch('os.getpid', return_value=101):
+        counter.start(app)
+        eq_(Thread.call_count, 1)
+    eq_(counter.take(), {})
+
+
+class Stop(Exception):
+    pass
+
+
+def test_flush_periodically():
+    """The flushing thread flushes the counts every flush interval"""
+    counter = downloads.DownloadCounter(60)
+    with mock.patch('time.sleep') as sleep, \
+            mock.patch('relengapi.blueprints.tooltool.downloads.flush_in_thread') as fit:
+        sleep.side_effect = [None, None, Stop]
+        try:
+            downloads._flush_periodically('app', counter)
+        except Stop:
+            pass
+    sleep.assert_called_with(60)
+    eq_(fit.call_count, 2)
+
+
+@test_context
+def test_write_counts(app):
+    """write_counts inserts new rows, adds to existing rows, keeping the latest
+    access time, and ignores unknown files"""
+    with app.app_context():
+        add_file_rows(ONE_DIGEST, TWO_DIGEST)
+        session = app.db.session(tables.DB_DECLARATIVE_BASE)
+        downloads.write_counts(session, {
+            (ONE_DIGEST, 'us-east-1'): (3, T1),
+            (TWO_DIGEST, 'us-east-1'): (1, T1),
+        })
+        session.commit()
+        downloads.write_counts(session, {
+            (ONE_DIGEST, 'us-east-1'): (2, T2),
+            (TWO_DIGEST, 'us-east-1'): (1, T0),
+            (TWO_DIGEST, 'us-west-2'): (5, T0),
+            (hashlib.sha512('x').hexdigest(), 'us-east-1'): (1, T0),
+        })
+        session.commit()
+        eq_(download_rows(), sorted([
+            (ONE_DIGEST, 'us-east-1', 5, T2),
+            (TWO_DIGEST, 'us-east-1', 2, T1),
+            (TWO_DIGEST, 'us-west-2', 5, T0),
+        ]))
+
+
+@test_context
+def test_record(app):
+    """record counts a download, and starts the flushing thread"""
+    with app.app_context():
+        app.tooltool_download_counter = downloads.DownloadCounter(60)
+        with mock.patch.object(app.tooltool_download_counter, 'start') as start, set_time():
+            downloads.record(ONE_DIGEST, 'us-east-1')
+        start.assert_called_once_with(app)
+        eq_(app.tooltool_download_counter.take(), {(ONE_DIGEST, 'us-east-1'): (1, T0)})
+
+
+@test_context
+def test_flush_in_thread(app):
+    """flush_in_thread writes the counts with the thread's own session, and
+    removes it afterward"""
+    with app.app_context():
+        add_file_rows(ONE_DIGEST)
+    counter = downloads.DownloadCounter(60)
+    counter.add(ONE_DIGEST, 'us-east-1', last_access=T0)
+    with mock.patch('sqlalchemy.orm.scoped_session.remove') as remove:
+        downloads.flush_in_thread(app, counter)
+        remove.assert_called_with()
+    with app.app_context():
+        eq_(download_rows(), [(ONE_DIGEST, 'us-east-1', 1, T0)])
+    eq_(counter.take(), {})
+
+
+@test_context
+def test_flush_retries_integrity_error(app):
+    """flush retries once if another process inserted the same rows"""
+    with app.app_context():
+        counter = downloads.DownloadCounter(60)
+        counter.add(ONE_DIGEST, 'us-east-1', last_access=T0)
+        with mock.patch('relengapi.blueprints.tooltool.downloads.write_counts') as write:
+            write.side_effect = [sa.exc.IntegrityError('stmt', {}, None), None]
+            downloads.flush(counter)
+        eq_(write.call_count, 2)
+        eq_(counter.take(), {})
+
+
+@test_context
+def test_flush_failure_keeps_counts(app):
+    """If writing the counts fails, flush keeps them for next time"""
+    with app.app_context():
+        counter = downloads.DownloadCounter(60)
+        counter.add(ONE_DIGEST, 'us-east-1', last_access=T0)
+        with mock.patch('relengapi.blueprints.tooltool.downloads.write_counts') as write:
+            write.side_effect = RuntimeError('oops')
+            downloads.flush(counter)
+        eq_(counter.take(), {(ONE_DIGEST, 'us-east-1'): (1, T0)})
@@ -6,14 +6,17 @@ from __future__ import absolute_import
 
 import hashlib
 import os
+import threading
 from contextlib import contextmanager
 from datetime import datetime
 from datetime import timedelta
+from time import sleep
 
 import boto
 import mock
 import moto
 from flask import current_app
+from nose.tools import assert_raises
 from nose.tools import eq_
 
 from relengapi.blueprints.tooltool import grooming
@@ -264,16 +267,178 @@ def test_check_pending_upload_success(app):
 
 @test_context
 def test_check_pending_uploads(app):
-    """check_pending_uploads calls check_pending_upload for each PU"""
+    """check_pending_uploads calls check_pending_upload for each PU, without
+    listing the bucket for a single PU"""
     with app.app_context(), set_time():
         expires = time.now() - timedelta(seconds=90)
         pu_row, file_row = add_pending_upload_and_file_row(
             len(DATA), DATA_DIGEST, expires, 'us-west-2')
-        with mock.patch('relengapi.blueprints.tooltool.grooming.check_pending_upload') as cpu:
-            pending_uploads = []
-            cpu.side_effect = lambda sess, pu: pending_uploads.append(pu)
+        with mock.patch('relengapi.blueprints.tooltool.grooming.'
+                        'check_pending_upload_in_thread') as cpu, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.uploaded_digests') as ud:
+            file_ids = []
+            cpu.side_effect = lambda app, file_id: file_ids.append(file_id)
             grooming.check_pending_uploads(None)  # job_status is unsed
-            assert len(pending_uploads) == 1
+            eq_(file_ids, [file_row.id])
+            eq_(ud.call_count, 0)
+
+
+@test_context
+def test_check_pending_uploads_skips_missing(app):
+    """check_pending_uploads lists each region once, and only checks PUs
+    that are present, abandoned, or in an un-configured region"""
+    with app.app_context(), set_time():
+        expired = time.now() - timedelta(seconds=90)
+        file_ids = {}
+        for name, expires, region in [
+                ('present', expired, 'us-west-2'),
+                ('missing', expired, 'us-west-2'),
+                ('unexpired', time.now() + timedelta(seconds=90), 'us-west-2'),
+                ('abandoned', time.now() - timedelta(days=2), 'us-east-1'),
+                ('unconfigured', expired, 'us-west-1')]:
+            pu_row, file_row = add_pending_upload_and_file_row(
+                len(name), hashlib.sha512(name).hexdigest(), expires, region)
+            file_ids[file_row.id] = name
+
+        with mock.patch('relengapi.blueprints.tooltool.grooming.'
+                        'check_pending_upload_in_thread') as cpu, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.uploaded_digests') as ud:
+            checked = []
+            cpu.side_effect = lambda app, file_id: checked.append(file_ids[file_id])
+            ud.return_value = set([hashlib.sha512('present').hexdigest()])
+            grooming.check_pending_uploads(None)
+        eq_(sorted(checked), ['abandoned', 'present', 'unconfigured'])
+        # us-east-1 has only an abandoned upload, so it is not listed
+        ud.assert_called_once_with('us-west-2')
+
+
+def add_pending_uploads(names, region):
+    file_ids = {}
+    for name in names:
+        pu_row, file_row = add_pending_upload_and_file_row(
+            len(name), hashlib.sha512(name).hexdigest(),
+            time.now() - timedelta(seconds=90), region)
+        file_ids[file_row.id] = name
+    return file_ids
+
+
+@test_context
+def test_check_pending_uploads_large_bucket(app):
+    """check_pending_uploads checks PUs individually when listing the bucket
+    would take more requests"""
+    with app.app_context(), set_time():
+        file_ids = add_pending_uploads(['one', 'two'], 'us-west-2')
+        add_file_row(3, hashlib.sha512('old').hexdigest(), instances=['us-west-2'])
+        with mock.patch('relengapi.blueprints.tooltool.grooming.'
+                        'check_pending_upload_in_thread') as cpu, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.uploaded_digests') as ud, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.LIST_KEYS_PER_REQUEST', 1):
+            checked = []
+            cpu.side_effect = lambda app, file_id: checked.append(file_ids[file_id])
+            grooming.check_pending_uploads(None)
+        eq_(sorted(checked), ['one', 'two'])
+        eq_(ud.call_count, 0)
+
+
+@test_context
+def test_check_pending_uploads_list_fails(app):
+    """check_pending_uploads checks PUs individually if listing the bucket
+    fails"""
+    with app.app_context(), set_time():
+        file_ids = add_pending_uploads(['one', 'two'], 'us-west-2')
+        with mock.patch('relengapi.blueprints.tooltool.grooming.'
+                        'check_pending_upload_in_thread') as cpu, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.uploaded_digests') as ud:
+            checked = []
+            cpu.side_effect = lambda app, file_id: checked.append(file_ids[file_id])
+            ud.side_effect = RuntimeError('slow down')
+            grooming.check_pending_uploads(None)
+        eq_(sorted(checked), ['one', 'two'])
+
+
+@moto.mock_s3
+@test_context
+def test_uploaded_digests(app):
+    """uploaded_digests lists the digests of the files in a region's bucket"""
+    with app.app_context():
+        key = make_key(app, 'us-east-1', 'tt-use1', DATA_KEY, DATA)
+        make_key(app, 'us-east-1', 'tt-use1', 'other/thing', 'xyz')
+        eq_(grooming.uploaded_digests('us-east-1'), set([DATA_DIGEST]))
+        key.delete()
+        eq_(grooming.uploaded_digests('us-east-1'), set())
+
+
+@test_context.specialize(config={'TOOLTOOL_VERIFY_CONCURRENCY': 2})
+def test_check_pending_uploads_concurrency(app):
+    """check_pending_uploads verifies PUs concurrently, with at most
+    TOOLTOOL_VERIFY_CONCURRENCY threads per region"""
+    with app.app_context(), set_time():
+        expires = time.now() - timedelta(seconds=90)
+        regions = {}
+        for i in range(6):
+            region = 'us-east-1' if i % 3 else 'us-west-2'
+            data = 'data %d' % i
+            pu_row, file_row = add_pending_upload_and_file_row(
+                len(data), hashlib.sha512(data).hexdigest(), expires, region)
+            regions[file_row.id] = region
+
+        lock = threading.Lock()
+        running = {'us-east-1': 0, 'us-west-2': 0}
+        max_running = running.copy()
+        checked = []
+
+        def check(app, file_id):
+            region = regions[file_id]
+            with lock:
+                running[region] += 1
+                max_running[region] = max(max_running[region], running[region])
+            sleep(0.05)
+            with lock:
+                running[region] -= 1
+                checked.append(file_id)
+
+        with mock.patch('relengapi.blueprints.tooltool.grooming.'
+                        'check_pending_upload_in_thread') as cpu, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.uploaded_digests') as ud:
+            cpu.side_effect = check
+            ud.return_value = set(hashlib.sha512('data %d' % i).hexdigest() for i in range(6))
+            grooming.check_pending_uploads(None)
+        eq_(sorted(checked), sorted(regions))
+        eq_(max_running, {'us-east-1': 2, 'us-west-2': 2})
+
+
+@test_context
+def test_check_pending_upload_in_thread(app):
+    """check_pending_upload_in_thread checks the PU with its own session, and
+    removes that session when finished"""
+    with app.app_context(), set_time():
+        expires = time.now() - timedelta(seconds=90)
+        pu_row, file_row = add_pending_upload_and_file_row(
+            len(DATA), DATA_DIGEST, expires, 'us-west-2')
+        file_id = file_row.id
+    with mock.patch('relengapi.blueprints.tooltool.grooming.check_pending_upload') as cpu:
+        checked = []
+        cpu.side_effect = lambda sess, pu: checked.append(pu.file_id)
+        with mock.patch('sqlalchemy.orm.scoped_session.remove') as remove:
+            grooming.check_pending_upload_in_thread(app, file_id)
+            remove.assert_called_with()
+    eq_(checked, [file_id])
+
+
+@test_context
+def test_check_pending_upload_in_thread_exception(app):
+    """check_pending_upload_in_thread logs and rolls back exceptions rather
+    than propagating them"""
+    with app.app_context(), set_time():
+        expires = time.now() - timedelta(seconds=90)
+        pu_row, file_row = add_pending_upload_and_file_row(
+            len(DATA), DATA_DIGEST, expires, 'us-west-2')
+        file_id = file_row.id
+    with mock.patch('relengapi.blueprints.tooltool.grooming.check_pending_upload') as cpu:
+        cpu.side_effect = RuntimeError('uhoh')
+        grooming.check_pending_upload_in_thread(app, file_id)
+    with app.app_context():
+        eq_(tables.PendingUpload.query.count(), 1)
 
 
 @test_context
@@ -304,12 +469,101 @@ def test_replicate(app):
                                        data_digest,
                                        instances=regions[:i]),
                           0 < i < len(regions)))
+        job_status = mock.Mock()
         with mock.patch('relengapi.blueprints.tooltool.grooming.replicate_file') as rep_file:
-            grooming.replicate(None)
+            grooming.replicate(job_status)
         replicated_files = [call[1][1] for call in rep_file.mock_calls]
         exp_replicated_files = [
             file for file, should_replicate in files if should_replicate]
         eq_(replicated_files, exp_replicated_files)
+        assert job_status.log_message.called
+
+
+@test_context
+def test_replicate_chunks(app):
+    """The periodic replication loads files in chunks, and copies them in
+    parallel, adding file instances as the copies complete"""
+    with app.app_context():
+        for i in range(5):
+            data = 'data %d' % i
+            add_file_row(len(data), hashlib.sha512(data).hexdigest(),
+                         instances=['us-east-1'])
+        job_status = mock.Mock()
+        copied = []
+        with mock.patch('relengapi.blueprints.tooltool.grooming.copy_object') as copy, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.'
+                           'REPLICATION_CHUNK_SIZE', 2):
+            copy.side_effect = lambda sha512, size, src, tgt: copied.append((size, src, tgt))
+            grooming.replicate(job_status)
+        eq_(sorted(copied), [(6, 'us-east-1', 'us-west-2')] * 5)
+        for i in range(5):
+            assert_file_instances(app, hashlib.sha512('data %d' % i).hexdigest(),
+                                  ['us-east-1', 'us-west-2'])
+        msg = job_status.log_message.call_args[0][0]
+        assert msg.startswith('5 files under-replicated; made 5 copies (30 bytes'), msg
+        assert msg.endswith('0 copies failed; 0 files under-replicated remain'), msg
+
+
+@test_context
+def test_replicate_copy_failure(app):
+    """If a copy fails during periodic replication, no file instance is added,
+    and the failure is counted"""
+    with app.app_context():
+        add_file_row(len(DATA), DATA_DIGEST, instances=['us-east-1'])
+        job_status = mock.Mock()
+        with mock.patch('relengapi.blueprints.tooltool.grooming.copy_object') as copy:
+            copy.side_effect = RuntimeError('uhoh')
+            grooming.replicate(job_status)
+        assert_file_instances(app, DATA_DIGEST, ['us-east-1'])
+        msg = job_status.log_message.call_args[0][0]
+        assert msg.endswith('1 copies failed; 1 files under-replicated remain'), msg
+
+
+def test_multipart_copy():
+    """multipart_copy copies each part of the object, then completes the
+    upload"""
+    bucket = mock.Mock()
+    mp = bucket.initiate_multipart_upload.return_value
+    with mock.patch('relengapi.blueprints.tooltool.grooming.MULTIPART_COPY_PART_SIZE', 10):
+        grooming.multipart_copy(bucket, 'sha512/abcd', 'src-bucket', 25)
+    bucket.initiate_multipart_upload.assert_called_once_with('sha512/abcd')
+    eq_(sorted(mp.copy_part_from_key.mock_calls), [
+        mock.call('src-bucket', 'sha512/abcd', 1, 0, 9),
+        mock.call('src-bucket', 'sha512/abcd', 2, 10, 19),
+        mock.call('src-bucket', 'sha512/abcd', 3, 20, 24),
+    ])
+    mp.complete_upload.assert_called_once_with()
+    eq_(mp.cancel_upload.mock_calls, [])
+
+
+def test_multipart_copy_failure():
+    """If a part copy fails, multipart_copy cancels the upload"""
+    bucket = mock.Mock()
+    mp = bucket.initiate_multipart_upload.return_value
+    mp.copy_part_from_key.side_effect = RuntimeError('uhoh')
+    with mock.patch('relengapi.blueprints.tooltool.grooming.MULTIPART_COPY_PART_SIZE', 10):
+        assert_raises(RuntimeError, grooming.multipart_copy,
+                      bucket, 'sha512/abcd', 'src-bucket', 25)
+    mp.cancel_upload.assert_called_once_with()
+    eq_(mp.complete_upload.mock_calls, [])
+
+
+@test_context
+def test_copy_object_multipart(app):
+    """copy_object uses a multipart copy for objects over
+    MULTIPART_COPY_THRESHOLD"""
+    with app.app_context():
+        with mock.patch.object(app.aws, 'connect_to') as connect_to, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.multipart_copy') as mpc:
+            bucket = connect_to.return_value.get_bucket.return_value
+            grooming.copy_object(DATA_DIGEST, grooming.MULTIPART_COPY_THRESHOLD + 1,
+                                 'us-east-1', 'us-west-2')
+            mpc.assert_called_once_with(bucket, DATA_KEY, 'tt-use1',
+                                        grooming.MULTIPART_COPY_THRESHOLD + 1)
+            grooming.copy_object(DATA_DIGEST, 100, 'us-east-1', 'us-west-2')
+            bucket.copy_key.assert_called_once_with(
+                new_key_name=DATA_KEY, src_key_name=DATA_KEY, src_bucket_name='tt-use1',
+                storage_class='STANDARD', preserve_acl=False)
 
 
 @test_context
@@ -0,0 +1,164 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+from contextlib import contextmanager
+from datetime import timedelta
+
+import mock
+import moto
+from boto.sqs.message import RawMessage
+from flask import current_app
+from nose.tools import eq_
+
+from relengapi.blueprints.tooltool import notifications
+from relengapi.blueprints.tooltool import tables
+from relengapi.blueprints.tooltool import util
+from relengapi.lib import aws
+from relengapi.lib import time
+from relengapi.lib.testing.context import TestContext
+
+DATA = 'uploaded data'
+DATA_DIGEST = hashlib.sha512(DATA).hexdigest()
+
+NOW = 1425592922
+
+cfg = {
+    'AWS': {
+        'access_key_id': 'aa',
+        'secret_access_key': 'ss',
+    },
+    'TOOLTOOL_REGIONS': {
+        'us-east-1': 'tt-use1',
+        'us-west-2': 'tt-usw2',
+    },
+    'TOOLTOOL_UPLOAD_NOTIFICATION_QUEUES': {
+        'us-east-1': 'tt-use1-uploads',
+    },
+}
+test_context = TestContext(config=cfg, databases=[tables.DB_DECLARATIVE_BASE],
+                           reuse_app=False)
+
+
+def event(bucket, key, name='ObjectCreated:Put'):
+    return {'Records': [{
+        'eventName': name,
+        's3': {'bucket': {'name': bucket}, 'object': {'key': key, 'size': len(DATA)}},
+    }]}
+
+
+def add_pending_upload(expires, region):
+    session = current_app.db.session(tables.DB_DECLARATIVE_BASE)
+    file_row = tables.File(size=len(DATA), visibility='public', sha512=DATA_DIGEST)
+    session.add(tables.PendingUpload(file=file_row, expires=expires, region=region))
+    session.commit()
+
+
+@contextmanager
+def set_time(now=NOW):
+    with mock.patch('time.time') as fake:
+        fake.return_value = now
+        yield
+
+
+@contextmanager
+def mock_check():
+    with mock.patch('relengapi.blueprints.tooltool.grooming.'
+                    'check_file_pending_uploads') as check:
+        yield check.apply_async
+
+
+@test_context
+def test_init_app(app):
+    """The blueprint registers a listener for each configured queue, which
+    reads raw messages"""
+    eq_([l[:4] for l in app.aws._listeners],
+        [('us-east-1', 'tt-use1-uploads', {}, RawMessage)])
+
+
+@test_context
+def test_uploaded_objects(app):
+    """uploaded_objects yields the digest and region of each tooltool object
+    created in a tooltool bucket"""
+    key = util.keyname(DATA_DIGEST)
+    events = [
+        event('tt-usw2', key),
+        event('tt-use1', key, name='ObjectCreated:CompleteMultipartUpload'),
+        event('tt-use1', key, name='ObjectRemoved:Delete'),
+        event('other-bucket', key),
+        event('tt-use1', 'other/' + DATA_DIGEST),
+        {'Service': 'Amazon S3', 'Event': 's3:TestEvent'},
+    ]
+    with app.app_context():
+        eq_([o for e in events for o in notifications.uploaded_objects(e)],
+            [(DATA_DIGEST, 'us-west-2'), (DATA_DIGEST, 'us-east-1')])
+
+
+@test_context
+def test_uploaded_objects_encoded_key(app):
+    """uploaded_objects decodes URL-encoded keys"""
+    with app.app_context():
+        eq_(list(notifications.uploaded_objects(event('tt-use1', 'sha512%2Fabcd'))),
+            [('abcd', 'us-east-1')])
+
+
+@test_context
+def test_schedule_verification_unexpired(app):
+    """A notification of an upload whose URL has not expired schedules a check
+    for just after it expires"""
+    with app.app_context(), set_time(), mock_check() as apply_async:
+        add_pending_upload(time.now() + timedelta(seconds=30), 'us-east-1')
+        notifications.schedule_verification(DATA_DIGEST, 'us-east-1')
+        apply_async.assert_called_once_with((DATA_DIGEST,), countdown=31)
+
+
+@test_context
+def test_schedule_verification_expired(app):
+    """A notification of an upload whose URL has expired schedules an
+    immediate check"""
+    with app.app_context(), set_time(), mock_check() as apply_async:
+        add_pending_upload(time.now() - timedelta(seconds=30), 'us-east-1')
+        notifications.schedule_verification(DATA_DIGEST, 'us-east-1')
+        apply_async.assert_called_once_with((DATA_DIGEST,), countdown=1)
+
+
+@test_context
+def test_schedule_verification_no_pending_upload(app):
+    """A notification of an upload with no pending upload, or a pending upload
+    to a different region, is ignored"""
+    with app.app_context(), set_time(), mock_check() as apply_async:
+        notifications.schedule_verification(DATA_DIGEST, 'us-east-1')
+        add_pending_upload(time.now() - timedelta(seconds=30), 'us-west-2')
+        notifications.schedule_verification(DATA_DIGEST, 'us-east-1')
+        eq_(apply_async.call_count, 0)
+
+
+@test_context
+def test_handle_notification(app):
+    """handle_notification schedules verification for the uploads in the
+    message"""
+    msg = RawMessage(body=json.dumps(event('tt-use1', util.keyname(DATA_DIGEST))))
+    with mock.patch('relengapi.blueprints.tooltool.notifications.'
+                    'schedule_verification') as schedule:
+        notifications.handle_notification(app, msg)
+        schedule.assert_called_once_with(DATA_DIGEST, 'us-east-1')
+
+
+@moto.mock_sqs
+@test_context
+def test_listen(app):
+    """The SQS listener reads S3 notifications and schedules verification"""
+    conn = app.aws.connect_to('sqs', 'us-east-1')
+    queue = conn.create_queue('tt-use1-uploads')
+    queue.write(RawMessage(body=json.dumps(event('tt-use1', util.keyname(DATA_DIGEST)))))
+    with app.app_context():
+        add_pending_upload(time.now() - timedelta(seconds=30), 'us-east-1')
+    region, queue_name, read_args, message_class, listener = app.aws._listeners[0]
+    with mock_check() as apply_async:
+        apply_async.side_effect = aws._StopListening
+        app.aws._listen_thd(region, queue_name, read_args, listener, message_class)
+        apply_async.assert_called_once_with((DATA_DIGEST,), countdown=1)
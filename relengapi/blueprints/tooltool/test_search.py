@@ -0,0 +1,156 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import hashlib
+
+from flask import current_app
+from nose.tools import eq_
+
+from relengapi.blueprints.tooltool import search
+from relengapi.blueprints.tooltool import tables
+from relengapi.lib import time
+from relengapi.lib.testing.context import TestContext
+
+test_context = TestContext(databases=[tables.DB_DECLARATIVE_BASE])
+
+
+def add_batch(author, message, filenames=(), index=True):
+    session = current_app.db.session(tables.DB_DECLARATIVE_BASE)
+    batch = tables.Batch(author=author, message=message, uploaded=time.now())
+    session.add(batch)
+    for filename in filenames:
+        file = tables.File(size=1, visibility='public',
+                           sha512=hashlib.sha512(filename).hexdigest())
+        session.add(tables.BatchFile(filename=filename, batch=batch, file=file))
+    if index:
+        search.index_batch(session, batch)
+    session.commit()
+    return batch
+
+
+def batch_messages(q, **kwargs):
+    session = current_app.db.session(tables.DB_DECLARATIVE_BASE)
+    return [b.message for b in search.search_batches(session, q, **kwargs)]
+
+
+def file_digests(q, **kwargs):
+    session = current_app.db.session(tables.DB_DECLARATIVE_BASE)
+    return [f.sha512 for f in search.search_files(session, q, **kwargs)]
+
+
+def test_trigrams():
+    """trigrams returns the lower-cased three-character substrings of a
+    string"""
+    eq_(search.trigrams(u'ABcdb'), set([u'abc', u'bcd', u'cdb']))
+    eq_(search.trigrams(u'ab'), set())
+
+
+@test_context
+def test_index_batch(app):
+    """index_batch indexes a batch's author, message and filenames"""
+    with app.app_context():
+        batch = add_batch(u'me', u'Four', [u'x.tgz'])
+        rows = tables.SearchTrigram.query.all()
+        eq_(sorted((r.field, r.trigram, r.batch_id, r.file_id) for r in rows), [
+            ('filename', u'.tg', batch.id, batch._files[0].file_id),
+            ('filename', u'tgz', batch.id, batch._files[0].file_id),
+            ('filename', u'x.t', batch.id, batch._files[0].file_id),
+            ('message', u'fou', batch.id, None),
+            ('message', u'our', batch.id, None),
+        ])
+
+
+@test_context
+def test_search_batches_substring(app):
+    """Batches are only found if the query is a substring of the author or
+    message, even if the message has all of its trigrams"""
+    with app.app_context():
+        add_batch(u'me@me.com', u'abcd bcde')
+        add_batch(u'me@me.com', u'abcde')
+        eq_(batch_messages(u'bcde'), [u'abcde', u'abcd bcde'])
+        eq_(batch_messages(u'abcde'), [u'abcde'])
+        eq_(batch_messages(u'ABCDE'), [u'abcde'])
+
+
+@test_context
+def test_search_batches_unindexed(app):
+    """Batches missing from the index are not found by queries of three or more
+    characters, but are found by shorter queries"""
+    with app.app_context():
+        add_batch(u'me@me.com', u'unindexed', index=False)
+        eq_(batch_messages(u'unindexed'), [])
+        eq_(batch_messages(u'un'), [u'unindexed'])
+
+
+@test_context
+def test_search_batches_pages(app):
+    """Batch searches return the requested page, with at most MAX_PER_PAGE
+    results per page"""
+    with app.app_context():
+        for i in range(3):
+            add_batch(u'me@me.com', u'batch %d' % i)
+        eq_(batch_messages(u'batch', per_page=2), [u'batch 2', u'batch 1'])
+        eq_(batch_messages(u'batch', per_page=2, page=2), [u'batch 0'])
+        eq_(batch_messages(u'batch', per_page=0), [u'batch 2'])
+        eq_(batch_messages(u'batch', page=0), [u'batch 2', u'batch 1', u'batch 0'])
+
+
+@test_context
+def test_search_batches_unpaged(app):
+    """Without page or per_page, batch searches return every result"""
+    with app.app_context():
+        for i in range(search.DEFAULT_PER_PAGE + 1):
+            add_batch(u'me@me.com', u'batch %d' % i)
+        eq_(len(batch_messages(u'batch')), search.DEFAULT_PER_PAGE + 1)
+        eq_(len(batch_messages(u'batch', page=1)), search.DEFAULT_PER_PAGE)
+
+
+@test_context
+def test_search_files(app):
+    """Files are found by filename or digest prefix, with digest matches
+    first"""
+    with app.app_context():
+        add_batch(u'me@me.com', u'first', [u'gcc.tar.xz', u'clang.tar.xz'])
+        add_batch(u'me@me.com', u'second', [u'gcc-4.tar.xz'])
+        gcc, clang, gcc4 = [hashlib.sha512(n).hexdigest()
+                            for n in ['gcc.tar.xz', 'clang.tar.xz', 'gcc-4.tar.xz']]
+        eq_(file_digests(u'gcc'), [gcc4, gcc])
+        eq_(file_digests(u'tar.xz'), [gcc4, clang, gcc])
+        eq_(file_digests(clang[:10]), [clang])
+        eq_(file_digests(u'tar.xz', per_page=1, page=3), [gcc])
+
+
+@test_context
+def test_rebuild_index(app):
+    """rebuild_index indexes every batch, replacing any existing index rows"""
+    with app.app_context():
+        add_batch(u'me@me.com', u'indexed')
+        add_batch(u'me@me.com', u'unindexed', index=False)
+        session = app.db.session(tables.DB_DECLARATIVE_BASE)
+        before = tables.SearchTrigram.query.count()
+        eq_(search.rebuild_index(session.connection()), 2)
+        session.commit()
+        eq_(batch_messages(u'indexed'), [u'unindexed', u'indexed'])
+        eq_(tables.SearchTrigram.query.count(),
+            before + len(search.trigrams(u'unindexed') | search.trigrams(u'me@me.com')))
+
+
+@test_context
+def test_rebuild_index_transaction(app):
+    """rebuild_index changes nothing unless its transaction is committed, and
+    then reproduces the index built as batches are uploaded"""
+    with app.app_context():
+        add_batch(u'me@me.com', u'indexed', [u'gcc.tar.xz'])
+        session = app.db.session(tables.DB_DECLARATIVE_BASE)
+        before = sorted((r.trigram, r.field, r.batch_id, r.file_id)
+                        for r in tables.SearchTrigram.query.all())
+        search.rebuild_index(session.connection())
+        session.rollback()
+        eq_(tables.SearchTrigram.query.count(), len(before))
+        search.rebuild_index(session.connection())
+        session.commit()
+        eq_(sorted((r.trigram, r.field, r.batch_id, r.file_id)
+                   for r in tables.SearchTrigram.query.all()), before)
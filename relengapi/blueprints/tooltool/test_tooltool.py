@@ -7,6 +7,9 @@ from __future__ import absolute_import
 import datetime
 import hashlib
 import json
+import os
+import shutil
+import tempfile
 import time
 import urlparse
 from contextlib import contextmanager
@@ -15,9 +18,12 @@ import boto.exception
 import mock
 import moto
 import pytz
+import sqlalchemy as sa
 from nose.tools import eq_
 
 from relengapi.blueprints import tooltool
+from relengapi.blueprints.tooltool import blobcache
+from relengapi.blueprints.tooltool import search
 from relengapi.blueprints.tooltool import tables
 from relengapi.blueprints.tooltool import util
 from relengapi.lib import auth
@@ -48,6 +54,12 @@ test_context = TestContext(config=cfg, databases=[tables.DB_DECLARATIVE_BASE],
 allow_anon_cfg = cfg.copy()
 allow_anon_cfg['TOOLTOOL_ALLOW_ANONYMOUS_PUBLIC_DOWNLOAD'] = True
 
+cache_cfg = cfg.copy()
+cache_cfg['TOOLTOOL_DOWNLOAD_CACHE'] = 'mock://tooltool'
+
+locality_cfg = cfg.copy()
+locality_cfg['REGION_NETWORKS'] = {'us-west-2': ['10.2.0.0/16']}
+
 ONE = '1\n'
 ONE_DIGEST = hashlib.sha512(ONE).hexdigest()
 TWO = '22\n'
@@ -115,6 +127,7 @@ def add_batch_to_db(app, author, message, files):
         session.add(batch)
         for filename, file in files.iteritems():
             session.add(tables.BatchFile(filename=filename, batch=batch, file=file))
+        search.index_batch(session, batch)
         session.commit()
         return batch
 
@@ -142,6 +155,20 @@ def set_time(now=NOW):
         yield
 
 
+@contextmanager
+def blob_cache(app, *contents):
+    directory = tempfile.mkdtemp()
+    try:
+        for content in contents:
+            digest = hashlib.sha512(content).hexdigest()
+            os.makedirs(os.path.join(directory, digest[:2]))
+            open(os.path.join(directory, digest[:2], digest), 'w').write(content)
+        app.tooltool_blob_cache = blobcache.BlobCache(directory, 1000)
+        yield app.tooltool_blob_cache
+    finally:
+        shutil.rmtree(directory)
+
+
 @contextmanager
 def not_so_random_choice():
     with mock.patch('random.choice') as choice:
@@ -496,6 +523,52 @@ def test_upload_batch_success_some_existing_files(client, app):
     assert_pending_upload(app, TWO_DIGEST, 'us-west-2')
 
 
+@contextmanager
+def count_statements(app):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    engine = app.db.engine(tables.DB_DECLARATIVE_BASE)
+    sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@moto.mock_s3
+@test_context
+def test_upload_batch_constant_statements(client, app):
+    """The number of statements executed by a POST to /upload does not depend
+    on the number of files in the batch."""
+    def batch_of(contents, message):
+        batch = mkbatch(message)
+        batch['files'] = {c: {'algorithm': 'sha512', 'size': len(c),
+                              'digest': hashlib.sha512(c).hexdigest(),
+                              'visibility': 'public'} for c in contents}
+        return batch
+
+    add_file_to_db(app, 'pending', regions=[], pending_regions=['us-east-1'])
+    add_file_to_db(app, 'present', regions=['us-east-1'])
+    with count_statements(app) as small:
+        resp = upload_batch(client, batch_of(['a', 'present'], 'small'), region='us-east-1')
+        eq_(resp.status_code, 200)
+    with count_statements(app) as large:
+        resp = upload_batch(client, batch_of(
+            ['b', 'c', 'd', 'e', 'pending', 'present'], 'large'), region='us-east-1')
+        eq_(resp.status_code, 200)
+    eq_(len(large), len(small), (large, small))
+    result = json.loads(resp.data)['result']
+    assert 'put_url' in result['files']['pending']
+    assert 'put_url' not in result['files']['present']
+    assert_batch_row(app, result['id'], message='large', files=[
+        (c, len(c), hashlib.sha512(c).hexdigest(), ['us-east-1'] if c == 'present' else [])
+        for c in ['b', 'c', 'd', 'e', 'pending', 'present']])
+    for c in ['b', 'pending']:
+        assert_pending_upload(app, hashlib.sha512(c).hexdigest(), 'us-east-1')
+
+
 @test_context
 def test_upload_change_visibility(client, app):
     """Uploading a file that already exists with a different visibility level
@@ -649,6 +722,242 @@ def test_download_file_exists_region_choice(app, client):
         assert_signed_302(resp, ONE_DIGEST, region='us-west-2')
 
 
+@moto.mock_s3
+@test_context.specialize(config=locality_cfg)
+def test_download_file_nearest_region(app, client):
+    """Getting /sha512/<digest> with no region returns a signed URL in the
+    region nearest the client, where the file exists there"""
+    add_file_to_db(app, ONE, regions=['us-west-2', 'us-east-1'])
+    with set_time():
+        resp = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST),
+                          environ_base={'REMOTE_ADDR': '10.2.3.4'})
+        assert_signed_302(resp, ONE_DIGEST, region='us-west-2')
+    eq_(app.locality.picks, {('us-west-2', 'nearest'): 1})
+
+
+@moto.mock_s3
+@test_context.specialize(config=locality_cfg)
+def test_upload_batch_nearest_region(app, client):
+    """Uploading a batch with no region uploads to the region nearest the
+    client"""
+    batch = mkbatch()
+    with set_time():
+        resp = client.post('/tooltool/upload', data=json.dumps(batch),
+                           headers=[('Content-Type', 'application/json')],
+                           environ_base={'REMOTE_ADDR': '10.2.3.4'})
+        eq_(resp.status_code, 200, resp.data)
+        result = json.loads(resp.data)['result']
+        assert_signed_url(result['files']['one']['put_url'], ONE_DIGEST,
+                          method='PUT', region='us-west-2')
+
+
+@moto.mock_s3
+@test_context
+def test_download_file_counted(app, client):
+    """Getting /sha512/<digest>, or resolving a manifest, counts a download of
+    the file from the selected region, without writing to the DB"""
+    add_file_to_db(app, ONE, regions=['us-west-2'])
+    add_file_to_db(app, TWO)
+    with set_time():
+        client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+        resolve_manifest(client, [{'digest': ONE_DIGEST}, {'digest': TWO_DIGEST}])
+        counts = app.tooltool_download_counter.take()
+    eq_(sorted((k, c) for k, (c, _) in counts.iteritems()),
+        [((ONE_DIGEST, 'us-west-2'), 2), ((TWO_DIGEST, 'us-east-1'), 1)])
+    with app.app_context():
+        eq_(tables.FileDownloads.query.all(), [])
+
+
+@test_context
+def test_download_file_blob_cache_hit(app, client):
+    """With a blob cache, getting /sha512/<digest> for a cached file returns
+    the file itself"""
+    add_file_to_db(app, ONE)
+    with blob_cache(app, ONE):
+        resp = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+        eq_(resp.status_code, 200)
+        eq_(resp.headers['Content-Type'], 'application/octet-stream')
+        eq_(resp.data, ONE)
+
+
+@test_context
+def test_download_file_blob_cache_miss(app, client):
+    """With a blob cache, getting /sha512/<digest> for an uncached file fills
+    the cache from the selected region's bucket, streaming the file as it
+    does so"""
+    add_file_to_db(app, ONE, regions=['us-west-2'])
+    with blob_cache(app) as cache:
+        def fetch(digest, bucket):
+            eq_(bucket.name, 'tt-usw2')
+            return len(ONE), iter([ONE[:10], ONE[10:]])
+        with mock.patch.object(cache, 'fetch', side_effect=fetch):
+            resp = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+        eq_(resp.status_code, 200)
+        eq_(resp.headers['Content-Length'], str(len(ONE)))
+        eq_(resp.data, ONE)
+
+
+@moto.mock_s3
+@test_context
+def test_download_file_blob_cache_fallback(app, client):
+    """With a blob cache, getting /sha512/<digest> for a file that cannot be
+    cached redirects to S3"""
+    add_file_to_db(app, ONE)
+    with blob_cache(app) as cache, set_time():
+        with mock.patch.object(cache, 'fetch', return_value=None):
+            resp = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+        assert_signed_302(resp, ONE_DIGEST)
+
+
+@test_context
+def test_resolve_manifest_blob_cache(app, client):
+    """With a blob cache, resolving a manifest returns URLs on this server"""
+    add_file_to_db(app, ONE)
+    with blob_cache(app):
+        resp = resolve_manifest(client, [{'digest': ONE_DIGEST}])
+    eq_(resp.status_code, 200, resp.data)
+    result = json.loads(resp.data)['result']
+    eq_(result[ONE_DIGEST]['get_url'],
+        'http://localhost/tooltool/sha512/{}'.format(ONE_DIGEST))
+
+
+@moto.mock_s3
+@test_context.specialize(config=cache_cfg)
+def test_download_file_cached(app, client):
+    """With TOOLTOOL_DOWNLOAD_CACHE set, a repeated download of a file uses the
+    cached instances and signed URL, without any DB queries"""
+    add_file_to_db(app, ONE, regions=['us-west-2'])
+    with set_time():
+        first = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+        assert_signed_302(first, ONE_DIGEST, region='us-west-2')
+    with set_time(NOW + 5), count_statements(app) as statements:
+        second = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+    eq_(statements, [])
+    eq_(second.headers['Location'], first.headers['Location'])
+
+
+@moto.mock_s3
+@test_context.specialize(config=cache_cfg)
+def test_download_file_cached_url_expires(app, client):
+    """Cached signed URLs are replaced after half of their lifetime"""
+    add_file_to_db(app, ONE, regions=['us-west-2'])
+    # mockcache uses datetime, rather than time.time, for expiration
+    with mock.patch('mockcache.datetime') as mc_datetime:
+        mc_datetime.timedelta = datetime.timedelta
+        mc_datetime.datetime.now.return_value = datetime.datetime.fromtimestamp(NOW)
+        with set_time():
+            first = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+        later = NOW + tooltool.GET_CACHE_SECONDS + 1
+        mc_datetime.datetime.now.return_value = datetime.datetime.fromtimestamp(later)
+        with set_time(later):
+            second = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+            assert_signed_302(second, ONE_DIGEST, region='us-west-2')
+    assert second.headers['Location'] != first.headers['Location']
+
+
+@moto.mock_s3
+@test_context.specialize(config=cache_cfg,
+                         user=userperms([p.tooltool.download.public, p.tooltool.manage]))
+def test_download_file_cache_invalidated_by_patch(app, client):
+    """A PATCH to a file invalidates its cached download information"""
+    add_file_to_db(app, ONE, regions=['us-west-2'], visibility='public')
+    with set_time():
+        eq_(client.get('/tooltool/sha512/{}'.format(ONE_DIGEST)).status_code, 302)
+        resp = do_patch(client, 'sha512', ONE_DIGEST,
+                        [{'op': 'set_visibility', 'visibility': 'internal'}])
+        eq_(resp.status_code, 200, resp.data)
+        eq_(client.get('/tooltool/sha512/{}'.format(ONE_DIGEST)).status_code, 403)
+
+
+def resolve_manifest(client, files, region=None):
+    region_arg = '?region={}'.format(region) if region else ''
+    return client.post_json('/tooltool/download' + region_arg, data=files)
+
+
+@moto.mock_s3
+@test_context
+def test_resolve_manifest(app, client):
+    """POSTing a manifest to /download returns signed URLs for all of its
+    files, in the preferred region where possible, with a constant number of
+    queries"""
+    add_file_to_db(app, ONE, regions=['us-west-2', 'us-east-1'])
+    add_file_to_db(app, TWO, regions=['us-east-1'])
+    with set_time(), count_statements(app) as statements:
+        resp = resolve_manifest(client, [
+            {'digest': ONE_DIGEST, 'size': len(ONE), 'algorithm': 'sha512'},
+            {'digest': TWO_DIGEST},
+        ], region='us-west-2')
+    eq_(resp.status_code, 200, resp.data)
+    eq_(len(statements), 1, statements)
+    result = json.loads(resp.data)['result']
+    eq_(sorted(result), sorted([ONE_DIGEST, TWO_DIGEST]))
+    eq_(sorted(result[ONE_DIGEST]['instances']), ['us-east-1', 'us-west-2'])
+    eq_(result[ONE_DIGEST]['size'], len(ONE))
+    with set_time():
+        assert_signed_url(result[ONE_DIGEST]['get_url'], ONE_DIGEST, region='us-west-2')
+        assert_signed_url(result[TWO_DIGEST]['get_url'], TWO_DIGEST, region='us-east-1')
+
+
+@moto.mock_s3
+@test_context
+def test_resolve_manifest_missing(app, client):
+    """A manifest containing a file that does not exist, or has no instances,
+    returns 404"""
+    add_file_to_db(app, ONE, regions=[])
+    resp = resolve_manifest(client, [{'digest': ONE_DIGEST}, {'digest': TWO_DIGEST}])
+    eq_(resp.status_code, 404, resp.data)
+    assert ONE_DIGEST in resp.data and TWO_DIGEST in resp.data, resp.data
+
+
+@moto.mock_s3
+@test_context
+def test_resolve_manifest_bad_size(app, client):
+    """A manifest giving the wrong size for a file returns 400"""
+    add_file_to_db(app, ONE)
+    resp = resolve_manifest(client, [{'digest': ONE_DIGEST, 'size': 99}])
+    eq_(resp.status_code, 400, resp.data)
+
+
+@moto.mock_s3
+@test_context
+def test_resolve_manifest_bad_digest(app, client):
+    """A manifest with an invalid digest or algorithm returns 400"""
+    resp = resolve_manifest(client, [{'digest': 'abcd'}])
+    eq_(resp.status_code, 400, resp.data)
+    resp = resolve_manifest(client, [{'digest': ONE_DIGEST, 'algorithm': 'md5'}])
+    eq_(resp.status_code, 400, resp.data)
+
+
+@moto.mock_s3
+@test_context
+def test_resolve_manifest_too_large(app, client):
+    """A manifest with more than MAX_MANIFEST_FILES files returns 400"""
+    files = [{'digest': hashlib.sha512(str(i)).hexdigest()}
+             for i in range(tooltool.MAX_MANIFEST_FILES + 1)]
+    resp = resolve_manifest(client, files)
+    eq_(resp.status_code, 400, resp.data)
+
+
+@moto.mock_s3
+@test_context
+def test_resolve_manifest_no_permission(app, client):
+    """A manifest containing a file the user cannot download returns 403"""
+    add_file_to_db(app, ONE)
+    add_file_to_db(app, TWO, visibility='internal')
+    resp = resolve_manifest(client, [{'digest': ONE_DIGEST}, {'digest': TWO_DIGEST}])
+    eq_(resp.status_code, 403, resp.data)
+
+
+@moto.mock_s3
+@test_context.specialize(user=None, config=allow_anon_cfg)
+def test_resolve_manifest_anonymous_allowed(app, client):
+    """Anonymously resolving a manifest of public files is allowed if
+    TOOLTOOL_ALLOW_ANONYMOUS_PUBLIC_DOWNLOAD is set"""
+    add_file_to_db(app, ONE)
+    resp = resolve_manifest(client, [{'digest': ONE_DIGEST}])
+    eq_(resp.status_code, 200, resp.data)
+
+
 @moto.mock_s3
 @test_context
 def test_search_batches(app, client):
@@ -709,6 +1018,39 @@ def test_search_batches(app, client):
             "got: {}\nexp: {}".format(resp.data, exp_batches))
 
 
+@moto.mock_s3
+@test_context
+def test_search_batches_paginated(app, client):
+    """Batch search results are ranked and paginated"""
+    with set_time():
+        for i in range(5):
+            add_batch_to_db(app, 'me@me.com', 'batch %d' % i, {})
+        add_batch_to_db(app, 'batch@me.com', 'batch 5', {})
+
+    def ids(url):
+        resp = client.get(url)
+        eq_(resp.status_code, 200, resp.data)
+        return [b['id'] for b in json.loads(resp.data)['result']]
+    # the batch matching in both author and message comes first, then the
+    # most recent
+    eq_(ids('/tooltool/upload?q=batch&per_page=4'), [6, 5, 4, 3])
+    eq_(ids('/tooltool/upload?q=batch&per_page=4&page=2'), [2, 1])
+    eq_(ids('/tooltool/upload?q=batch&per_page=4&page=3'), [])
+
+
+@moto.mock_s3
+@test_context
+def test_upload_batch_indexed(app, client):
+    """Uploaded batches can be found by author, message and filename"""
+    batch = mkbatch('a searchable message')
+    with set_time():
+        eq_(upload_batch(client, batch).status_code, 200)
+    resp = client.get('/tooltool/upload?q=searchable')
+    eq_([b['id'] for b in json.loads(resp.data)['result']], [1])
+    resp = client.get('/tooltool/file?q=one')
+    eq_([f['digest'] for f in json.loads(resp.data)['result']], [ONE_DIGEST])
+
+
 @moto.mock_s3
 @test_context
 def test_get_batch_not_found(client):
@@ -71,3 +71,19 @@ class UploadBatch(wsme.types.Base):
     #: filenames containing path separators (``\`` and ``/``) will be rejected the
     #: tooltool client.
     files = wsme.types.wsattr({unicode: File}, mandatory=True)
+
+
+class ManifestFile(wsme.types.Base):
+
+    """A file listed in a tooltool manifest, to be resolved to a download
+    URL."""
+
+    #: The sha512 digest of the file contents
+    digest = wsme.types.wsattr(unicode, mandatory=True)
+
+    #: The digest algorithm (must be 'sha512' if given)
+    algorithm = wsme.types.wsattr(unicode, mandatory=False)
+
+    #: The size of the file, in bytes.  If given, this must match the size of
+    #: the file on the server.
+    size = wsme.types.wsattr(int, mandatory=False)
@@ -27,14 +27,16 @@ class AWS(object):
 
     def __init__(self, config):
         self.config = config
-        self._connections = {}
+        # boto connections are not thread-safe, so each thread has its own
+        self._local = threading.local()
         self._queues = {}
         self._listeners = []
 
     def connect_to(self, service_name, region_name):
+        connections = self._local.__dict__.setdefault('connections', {})
         key = service_name, region_name
-        if key in self._connections:
-            return self._connections[key]
+        if key in connections:
+            return connections[key]
 
         # handle special cases
         try:
@@ -42,7 +44,7 @@ class AWS(object):
         except AttributeError:
             fn = self.connect_to_default
         conn = fn(service_name, region_name)
-        self._connections[key] = conn
+        connections[key] = conn
         return conn
 
     def connect_to_default(self, service_name, region_name):
@@ -88,14 +90,14 @@ class AWS(object):
         m = sqs_message.Message(body=json.dumps(body))
         queue.write(m)
 
-    def sqs_listen(self, region_name, queue_name, read_args=None):
+    def sqs_listen(self, region_name, queue_name, read_args=None, message_class=None):
         def decorate(func):
             self._listeners.append(
-                (region_name, queue_name, read_args or {}, func))
+                (region_name, queue_name, read_args or {}, message_class, func))
             return func
         return decorate
 
-    def _listen_thd(self, region_name, queue_name, read_args, listener):
+    def _listen_thd(self, region_name, queue_name, read_args, listener, message_class=None):
         logger.info(
             "Listening to SQS queue %r in region %s", queue_name, region_name)
         try:
@@ -104,6 +106,8 @@ class AWS(object):
             logger.exception("While getting queue %r in region %s; listening cancelled",
                              queue_name, region_name)
             return
+        if message_class:
+            queue.set_message_class(message_class)
 
         while True:
             msg = queue.read(wait_time_seconds=20, **read_args)
@@ -123,11 +127,11 @@ class AWS(object):
     def _spawn_sqs_listeners(self, _testing=False):
         # launch a listening thread for each SQS queue
         threads = []
-        for region_name, queue_name, read_args, listener in self._listeners:
+        for region_name, queue_name, read_args, message_class, listener in self._listeners:
             thd = threading.Thread(
                 name="%s/%r -> %r" % (region_name, queue_name, listener),
                 target=self._listen_thd,
-                args=(region_name, queue_name, read_args, listener))
+                args=(region_name, queue_name, read_args, listener, message_class))
             # set the thread to daemon so that SIGINT will kill the process
             thd.daemon = True
             thd.start()
@@ -0,0 +1,144 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import bisect
+import collections
+import random
+import threading
+
+import IPy
+import structlog
+from flask import current_app
+from flask import has_request_context
+from flask import request
+
+logger = structlog.get_logger()
+
+
+class NetworkIndex(object):
+
+    """An index mapping IP addresses to regions, built from a dictionary
+    mapping each region to a list of CIDR networks.  Where networks are
+    nested, the most specific network containing an address determines its
+    region."""
+
+    def __init__(self, networks):
+        entries = []
+        for region, cidrs in networks.iteritems():
+            for cidr in cidrs:
+                net = IPy.IP(cidr, make_net=True)
+                entries.append((net.version(), net.int(), net.broadcast().int(), region))
+        # sort by start address, with containing networks before the networks
+        # they contain
+        entries.sort(key=lambda e: (e[0], e[1], -e[2]))
+        self._entries = entries
+        self._keys = [(version, start) for version, start, _, _ in entries]
+
+        # since CIDR networks are either nested or disjoint, the networks
+        # containing an entry are exactly the chain of its parents
+        self._parents = []
+        stack = []
+        for i, (version, start, end, _) in enumerate(entries):
+            while stack and not (entries[stack[-1]][0] == version and
+                                 entries[stack[-1]][2] >= end):
+                stack.pop()
+            self._parents.append(stack[-1] if stack else None)
+            stack.append(i)
+
+    def lookup(self, address):
+        """Return the region for the given address, or None if it is not in
+        any network (or is not a valid address)."""
+        try:
+            ip = IPy.IP(address)
+        except (TypeError, ValueError):
+            return None
+        version, addr = ip.version(), ip.int()
+        # the last network starting at or before this address either contains
+        # it or is contained in every network that does
+        i = bisect.bisect_right(self._keys, (version, addr)) - 1
+        if i < 0:
+            return None
+        while i is not None:
+            entry_version, start, end, region = self._entries[i]
+            if entry_version == version and start <= addr <= end:
+                return region
+            i = self._parents[i]
+        return None
+
+
+class Locality(object):
+
+    """Select regions for clients, preferring the region they ask for, then
+    the region nearest them, then the first available region in the nearest
+    region's configured order of preference, then a random region chosen
+    according to the configured weights.  The number of times each region is
+    selected, and why, is counted in ``picks``."""
+
+    def __init__(self, networks, weights, preferences=None):
+        self.index = NetworkIndex(networks)
+        self.weights = weights
+        # clients outside every network use the order given for None
+        self.preferences = preferences or {}
+        self.lock = threading.Lock()
+        self.picks = collections.Counter()
+
+    def select(self, regions, preferred=None, address=None):
+        regions = sorted(regions)
+        if preferred in regions:
+            region, reason = preferred, 'preferred'
+        else:
+            nearest = self.index.lookup(address) if address else None
+            if nearest in regions:
+                region, reason = nearest, 'nearest'
+            else:
+                fallbacks = [r for r in self.preferences.get(nearest, []) if r in regions]
+                if fallbacks:
+                    region, reason = fallbacks[0], 'fallback'
+                else:
+                    region, reason = self._weighted_choice(regions), 'random'
+        with self.lock:
+            self.picks[region, reason] += 1
+        return region
+
+    def picks_by_region(self):
+        """Return the counts in ``picks`` as a dictionary of dictionaries,
+        keyed by region and then by reason."""
+        with self.lock:
+            picks = self.picks.items()
+        result = {}
+        for (region, reason), count in picks:
+            result.setdefault(region, {})[reason] = count
+        return result
+
+    def _weighted_choice(self, regions):
+        weights = [self.weights.get(r, 1) for r in regions]
+        total = sum(weights)
+        if not self.weights or total <= 0:
+            return random.choice(regions)
+        x = random.uniform(0, total)
+        for region, weight in zip(regions, weights):
+            x -= weight
+            if x < 0:
+                return region
+        return regions[-1]
+
+
+def select_region(regions, preferred=None):
+    """Select one of the given regions for the current request's client.
+
+    :param regions: regions to choose from (any iterable, such as a dictionary
+        keyed by region)
+    :param preferred: the region the client asked for, if any
+    :returns: a region
+    """
+    address = request.remote_addr if has_request_context() else None
+    return current_app.locality.select(regions, preferred, address)
+
+
+def init_app(app):
+    app.locality = Locality(app.config.get('REGION_NETWORKS', {}),
+                            app.config.get('REGION_WEIGHTS', {}),
+                            app.config.get('REGION_PREFERENCES', {}))
@@ -68,6 +68,15 @@ def test_robots(client):
     eq_(resp.status_code, 200, resp.data)
 
 
+@test_context
+def test_region_picks(app, client):
+    """The /region-picks API method returns the counts of region selections"""
+    app.locality.picks['us-east-1', 'nearest'] += 2
+    resp = client.get('/region-picks')
+    eq_(resp.status_code, 200, resp.data)
+    eq_(json.loads(resp.data)['result'], {'us-east-1': {'nearest': 2}})
+
+
 @test_context
 def test_versions(client):
     """The /versions API method returns information about the base
@@ -7,10 +7,12 @@ from __future__ import absolute_import
 import json
 import logging
 import Queue
+import threading
 from logging import handlers
 
 import mock
 import moto
+from boto.sqs import message as sqs_message
 from moto import mock_sqs
 from nose.plugins.skip import SkipTest
 from nose.tools import assert_raises
@@ -55,6 +57,20 @@ def test_connect_to(app):
     eq_(app.aws.connect_to('sqs', 'us-east-1'), 'sqs_conn')
 
 
+@test_context.specialize(config=aws_cfg)
+def test_connect_to_per_thread(app):
+    """Each thread has its own connections"""
+    with mock.patch('boto.connect_sqs', side_effect=lambda **kw: object()):
+        conn = app.aws.connect_to('sqs', 'us-east-1')
+        other = []
+        thd = threading.Thread(target=lambda: other.append(
+            app.aws.connect_to('sqs', 'us-east-1')))
+        thd.start()
+        thd.join()
+    assert other[0] is not conn
+    eq_(app.aws.connect_to('sqs', 'us-east-1'), conn)
+
+
 @mock_sqs
 @test_context
 def test_connect_to_no_creds(app):
@@ -163,3 +179,19 @@ def test_sqs_listen(app):
         # good way to programmatically verify that messages are being deleted
     finally:
         logging.getLogger().removeHandler(log_buffer)
+
+
+@test_context
+def test_sqs_listen_message_class(app):
+    queue = mock.Mock()
+
+    @app.aws.sqs_listen('us-east-1', 'my-sqs-queue', message_class=sqs_message.RawMessage)
+    def listener(msg):
+        raise aws._StopListening
+
+    eq_(app.aws._listeners,
+        [('us-east-1', 'my-sqs-queue', {}, sqs_message.RawMessage, listener)])
+    queue.read.return_value = sqs_message.RawMessage(body='raw')
+    with mock.patch.object(app.aws, 'get_sqs_queue', return_value=queue):
+        app.aws._listen_thd('us-east-1', 'my-sqs-queue', {}, listener, sqs_message.RawMessage)
+    queue.set_message_class.assert_called_once_with(sqs_message.RawMessage)
@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import mock
+from nose.tools import eq_
+
+from relengapi.lib import locality
+from relengapi.lib.testing.context import TestContext
+
+NETWORKS = {
+    'us-east-1': ['10.0.0.0/8', '10.2.1.0/24', '2001:db8::/32'],
+    'us-west-2': ['10.2.0.0/16', '192.168.0.0/24'],
+    'us-west-1': ['10.2.1.128/25'],
+}
+
+test_context = TestContext(config={'REGION_NETWORKS': NETWORKS})
+
+
+def test_index_lookup():
+    """NetworkIndex finds the region of the most specific network containing
+    an address"""
+    index = locality.NetworkIndex(NETWORKS)
+    eq_(index.lookup('10.1.2.3'), 'us-east-1')
+    eq_(index.lookup('10.2.0.1'), 'us-west-2')
+    eq_(index.lookup('10.2.1.1'), 'us-east-1')
+    eq_(index.lookup('10.2.1.200'), 'us-west-1')
+    eq_(index.lookup('10.2.2.1'), 'us-west-2')
+    eq_(index.lookup('10.3.0.0'), 'us-east-1')
+    eq_(index.lookup('192.168.0.255'), 'us-west-2')
+    eq_(index.lookup('2001:db8::1'), 'us-east-1')
+
+
+def test_index_lookup_not_found():
+    """NetworkIndex returns None for addresses outside every network, and for
+    invalid addresses"""
+    index = locality.NetworkIndex(NETWORKS)
+    eq_(index.lookup('9.255.255.255'), None)
+    eq_(index.lookup('11.0.0.0'), None)
+    eq_(index.lookup('192.168.1.0'), None)
+    eq_(index.lookup('2001:db9::1'), None)
+    eq_(index.lookup('not-an-address'), None)
+    eq_(locality.NetworkIndex({}).lookup('10.0.0.1'), None)
+
+
+def test_select_preferred():
+    """A preferred region is selected if it is available"""
+    loc = locality.Locality(NETWORKS, {})
+    eq_(loc.select(['us-east-1', 'us-west-2'], 'us-west-2', '10.1.2.3'), 'us-west-2')
+    eq_(loc.picks, {('us-west-2', 'preferred'): 1})
+
+
+def test_select_nearest():
+    """Without an available preferred region, the region nearest the client
+    is selected"""
+    loc = locality.Locality(NETWORKS, {})
+    eq_(loc.select(['us-east-1', 'us-west-2'], 'eu-central-1', '10.2.0.1'), 'us-west-2')
+    eq_(loc.select(['us-east-1', 'us-west-2'], None, '10.2.0.1'), 'us-west-2')
+    eq_(loc.picks, {('us-west-2', 'nearest'): 2})
+
+
+def test_select_fallback():
+    """If the nearest region is not available, the first available region in
+    its order of preference is selected"""
+    loc = locality.Locality(NETWORKS, {}, {
+        'us-west-1': ['eu-central-1', 'us-west-2', 'us-east-1'],
+        None: ['us-east-1'],
+    })
+    eq_(loc.select(['us-east-1', 'us-west-2'], None, '10.2.1.200'), 'us-west-2')
+    eq_(loc.select(['us-east-1'], None, '10.2.1.200'), 'us-east-1')
+    # clients outside every network use the order given for None
+    eq_(loc.select(['us-east-1', 'us-west-2'], None, '11.0.0.0'), 'us-east-1')
+    eq_(loc.picks_by_region(), {'us-west-2': {'fallback': 1}, 'us-east-1': {'fallback': 2}})
+
+
+def test_select_weighted():
+    """If neither the nearest region nor any of its preferences is available,
+    a region is chosen at random according to the configured weights"""
+    loc = locality.Locality(NETWORKS, {'us-east-1': 0, 'us-west-2': 3})
+    with mock.patch('random.uniform') as uniform:
+        uniform.return_value = 2.9
+        eq_(loc.select(['us-west-2', 'us-east-1'], None, '10.2.1.200'), 'us-west-2')
+        uniform.assert_called_once_with(0, 3)
+    eq_(loc.picks, {('us-west-2', 'random'): 1})
+
+
+def test_select_unweighted():
+    """Without weights, a region is chosen uniformly at random"""
+    loc = locality.Locality(NETWORKS, {})
+    with mock.patch('random.choice') as choice:
+        choice.side_effect = lambda seq: seq[-1]
+        eq_(loc.select(['us-west-2', 'us-east-1'], None, '11.0.0.0'), 'us-west-2')
+        eq_(loc.select(['us-west-2', 'us-east-1']), 'us-west-2')
+
+
+@test_context
+def test_select_region_request(app):
+    """select_region uses the address of the client of the current request"""
+    with app.test_request_context(environ_base={'REMOTE_ADDR': '10.2.1.200'}):
+        eq_(locality.select_region({'us-east-1': 'b1', 'us-west-1': 'b2'}), 'us-west-1')
+    eq_(app.locality.picks, {('us-west-1', 'nearest'): 1})
+
+
+@test_context
+def test_select_region_no_request(app):
+    """select_region works outside of a request"""
+    with app.app_context():
+        eq_(locality.select_region(['us-east-1'], 'us-west-2'), 'us-east-1')